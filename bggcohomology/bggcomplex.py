@@ -135,6 +135,9 @@ class BGGComplex:
         else:
             self._maps = dict()
 
+        # Signed maps compiled for the action kernels, keyed by (dominant weight, edge)
+        self._map_programs = dict()
+
         self.rho = self.domain.rho()
 
         self._action_dic = dict()
@@ -259,6 +262,7 @@ class BGGComplex:
                 return self.signs
 
         self.signs = compute_signs(self)
+        self._map_programs = dict()  # compiled maps include the signs
         return self.signs
 
     def compute_maps(self, root, column=None, check=False, pbar=None):
@@ -2,172 +2,1420 @@
 """
 Module to compute the differentials of the BGG complex. Implemented in Cython for extra speed, since it
 is relatively critical for performance.
+
+The kernels acting on rows of action images release the GIL and are parallelized with OpenMP.
+The number of threads can be set with `set_num_threads`.
+
+Action images are stored as a struct of arrays, see `ActionImage`. Every array has the narrowest
+dtype that can hold its entries: the index columns are usually `np.uint8` or `np.uint16`, and the
+coefficients are `np.int32` when they are small, which is the common case, and `np.int64`
+otherwise. Before every operation that can make coefficients grow, a bound on the result is
+computed from the largest coefficient and the structure constants, and the coefficients are
+promoted if needed. Coefficients that don't fit in 64 bits are computed exactly with Python
+integers (`object` dtype).
+
+Large temporary arrays of the kernels are drawn from a per-thread `ScratchArena` and returned to it
+when they are no longer needed, so that the same memory is reused instead of allocated again. The
+size of the arenas can be capped with `set_scratch_limit`, and `get_scratch_stats` reports how
+well the buffers are reused.
+
+Modules with `wedge_bitmasks` or `sym_multiplicities` set store wedge powers of small modules as
+bitmasks, and symmetric powers as multiplicity vectors, while acting on them, see `ComponentLayout`.
 """
 
+from collections import defaultdict
+from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd, prod
+import os
+import threading
+import weakref
+
 import numpy as np
+from scipy import sparse
+
+cimport cython
+from cython.parallel cimport prange
+from libc.stdint cimport uint8_t, uint16_t, int32_t, int64_t, uint64_t
+from libc.stdlib cimport malloc, realloc, free
 
-from sage.matrix.constructor import matrix
 from sage.rings.integer_ring import ZZ
-from sage.rings.rational import Rational
 
-cpdef compute_action(acting_element, action_source, module, comp_num):
-    """Computes action of a single lie algebra element on a list of elements of the module. 
-    Outputs a new array where indices and coefficients are replaced as per the action. 
-    The output is unsorted, and may contain duplicate entries. """
+from .differential import SparseDifferential, blackbox_rank
 
-    # Initialize array for output
-    action_image = np.zeros_like(action_source)
+# Kernels acting on fewer rows than this run on a single thread
+PARALLEL_MIN_ROWS = 4096
 
-    # Get component types. Each type has a different action of the Lie algebra
-    type_list = module.type_lists[comp_num]
-    cdef image_row = 0 # counter for which row to edit in output
-    cdef max_rows = len(action_image)
-
-    cdef int row,j
-    for col,mod_type in enumerate(type_list): # compute the action one column at a time
-        action_tensor = module.action_tensor_dic[mod_type] # retrieve the structure coefficient tensor
-        for row in range(len(action_source)):
-            j = action_source[row,col]
-            s,k,Cijk = action_tensor[acting_element,j]
+cdef int _num_threads = os.cpu_count() or 1
+
+def set_num_threads(num_threads):
+    """Sets the number of threads used by the parallel kernels. If `None`, use all cores."""
+    global _num_threads
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads < 1:
+        raise ValueError("Number of threads must be positive, got %d" % num_threads)
+    _num_threads = num_threads
+
+def get_num_threads():
+    """Returns the number of threads used by the parallel kernels."""
+    return _num_threads
+
+# Maximum number of bytes of unmerged images kept by `action_on_basis` before merging them
+cdef Py_ssize_t _memory_limit = 2**28
+
+def set_memory_limit(memory_limit):
+    """Sets the maximum number of bytes of unmerged images kept by `action_on_basis`.
+    Larger values mean fewer merges, smaller values mean lower peak memory."""
+    global _memory_limit
+    if memory_limit < 1:
+        raise ValueError("Memory limit must be positive, got %d" % memory_limit)
+    _memory_limit = memory_limit
+
+def get_memory_limit():
+    """Returns the maximum number of bytes of unmerged images kept by `action_on_basis`."""
+    return _memory_limit
+
+# Maximum number of bytes of images of a chunk of a weight component in `compute_diff`
+cdef Py_ssize_t _diff_memory_budget = 2**30
+
+def set_diff_memory_budget(memory_budget):
+    """Sets the memory budget for the images of a chunk of rows of a weight component in
+    `compute_diff`. Weight components are split into chunks of rows whose images are expected
+    to take at most this many bytes. The result does not depend on the budget."""
+    global _diff_memory_budget
+    if memory_budget < 1:
+        raise ValueError("Memory budget must be positive, got %d" % memory_budget)
+    _diff_memory_budget = memory_budget
+
+def get_diff_memory_budget():
+    """Returns the memory budget for the images of a chunk of rows in `compute_diff`."""
+    return _diff_memory_budget
+
+# Maximum number of bytes of unused buffers kept by the scratch arena of each thread
+cdef Py_ssize_t _scratch_limit = 2**28
+
+def set_scratch_limit(scratch_limit):
+    """Sets the maximum number of bytes of unused buffers kept by the scratch arena of each thread.
+    Buffers released when the arena is full are freed instead."""
+    global _scratch_limit
+    if scratch_limit < 0:
+        raise ValueError("Scratch limit can't be negative, got %d" % scratch_limit)
+    _scratch_limit = scratch_limit
+
+def get_scratch_limit():
+    """Returns the maximum number of bytes of unused buffers kept by the scratch arena of each thread."""
+    return _scratch_limit
+
+# Arrays smaller than this are cheap to allocate, and are not pooled by the scratch arenas
+SCRATCH_MIN_BYTES = 2**16
+
+SCRATCH_STATS = ('requests', 'reuses', 'allocations', 'releases', 'discards', 'pooled_bytes',
+                 'peak_pooled_bytes')
+
+class ScratchArena:
+    """Pool of reusable buffers for the temporary arrays of the kernels.
+
+    Allocating a large array maps fresh memory, whose pages are faulted in when the array is first
+    written. Arrays obtained with `empty` are views of buffers with a capacity of a power of two
+    bytes, and `release` returns these buffers to the pool, so that later requests of a similar size
+    reuse them. The pool grows on demand. Released buffers are freed instead of pooled if the pool
+    would hold more than `get_scratch_limit()` bytes. Arrays of less than `SCRATCH_MIN_BYTES` bytes
+    and arrays of Python objects are allocated directly.
+
+    An arena should only be used by a single thread, use `scratch_arena` to get the arena of
+    the current thread.
+
+    Attributes
+    ----------
+    stats : dict[str, int]
+        Counters for tuning the arena: the number of `requests` for pooled arrays, how many of
+        these were served by `reuses` of a pooled buffer and how many needed `allocations`, the
+        number of `releases` of buffers and the number of `discards` of released buffers because
+        of the limit, and the current and peak number of bytes in the pool (`pooled_bytes` and
+        `peak_pooled_bytes`).
+    """
+
+    def __init__(self):
+        self.pool = defaultdict(list) # (dtype, capacity in bytes) -> list of unused buffers
+        self.outstanding = weakref.WeakValueDictionary() # id -> buffer of arrays handed out
+        self.stats = dict.fromkeys(SCRATCH_STATS, 0)
+
+    def empty(self, shape, dtype):
+        """Uninitialized array of the given shape and dtype, like `np.empty`."""
+        dtype = np.dtype(dtype)
+        if isinstance(shape, int):
+            shape = (shape,)
+        size = prod(shape)
+        nbytes = size*dtype.itemsize
+        if nbytes < SCRATCH_MIN_BYTES or dtype.hasobject:
+            return np.empty(shape, dtype)
+
+        self.stats['requests'] += 1
+        capacity = 1 << (nbytes-1).bit_length()
+        buffers = self.pool.get((dtype, capacity))
+        if buffers:
+            buffer = buffers.pop()
+            self.stats['reuses'] += 1
+            self.stats['pooled_bytes'] -= capacity
+        else:
+            buffer = np.empty(capacity//dtype.itemsize, dtype)
+            self.stats['allocations'] += 1
+        self.outstanding[id(buffer)] = buffer
+        return buffer[:size].reshape(shape)
+
+    def release(self, *arrays):
+        """Returns the buffers of arrays obtained from `empty` to the pool. Other arrays are ignored.
+        The released arrays, and any other views of their buffers, must not be used afterwards."""
+        for array in arrays:
+            buffer = array if array.base is None else array.base
+            if self.outstanding.get(id(buffer)) is not buffer:
+                continue
+            del self.outstanding[id(buffer)]
+            self.stats['releases'] += 1
+            if self.stats['pooled_bytes'] + buffer.nbytes > _scratch_limit:
+                self.stats['discards'] += 1
+                continue
+            self.pool[(buffer.dtype, buffer.nbytes)].append(buffer)
+            self.stats['pooled_bytes'] += buffer.nbytes
+            self.stats['peak_pooled_bytes'] = max(self.stats['peak_pooled_bytes'],
+                                                  self.stats['pooled_bytes'])
+
+    def clear(self):
+        """Frees all the unused buffers in the pool."""
+        self.pool.clear()
+        self.stats['pooled_bytes'] = 0
+
+_scratch_state = threading.local()
+_scratch_arenas = weakref.WeakSet()
+_scratch_lock = threading.Lock()
+
+def scratch_arena():
+    """Returns the `ScratchArena` of the current thread."""
+    arena = getattr(_scratch_state, 'arena', None)
+    if arena is None:
+        arena = ScratchArena()
+        _scratch_state.arena = arena
+        with _scratch_lock:
+            _scratch_arenas.add(arena)
+    return arena
+
+def get_scratch_stats():
+    """Returns the statistics of the scratch arenas of all live threads, summed over the arenas.
+    See `ScratchArena` for the meaning of the counters."""
+    with _scratch_lock:
+        arenas = list(_scratch_arenas)
+    return {key: sum(arena.stats[key] for arena in arenas) for key in SCRATCH_STATS}
+
+# Dtypes of the index columns and of the coefficients of action images
+ctypedef fused index_t:
+    uint8_t
+    uint16_t
+    int32_t
+
+ctypedef fused coeff_t:
+    int32_t
+    int64_t
+
+INT32_MAX = 2**31-1
+INT64_MAX = 2**63-1
+
+def index_dtype(max_index):
+    """Narrowest dtype of the index columns of an action image with indices at most `max_index`."""
+    if max_index < 2**8:
+        return np.dtype(np.uint8)
+    if max_index < 2**16:
+        return np.dtype(np.uint16)
+    if max_index <= INT32_MAX:
+        return np.dtype(np.int32)
+    raise OverflowError("Index %d doesn't fit in 32 bits" % max_index)
+
+def coefficient_dtype(bound):
+    """Narrowest dtype of the coefficients of an action image that are at most `bound` in absolute value."""
+    if bound <= INT32_MAX:
+        return np.dtype(np.int32)
+    if bound <= INT64_MAX:
+        return np.dtype(np.int64)
+    return np.dtype(object)
+
+def max_abs(values):
+    """Largest absolute value of the entries of an integer array, as a Python integer."""
+    if len(values)==0:
+        return 0
+    return max(int(values.max()), -int(values.min()))
+
+def widen(coeffs, bound):
+    """Converts coefficients to a wider dtype if their dtype can't hold values of absolute value
+    `bound`. Otherwise the coefficients are returned as is."""
+    dtype = np.result_type(coeffs.dtype, coefficient_dtype(bound))
+    if dtype != coeffs.dtype:
+        return coeffs.astype(dtype)
+    return coeffs
+
+def scale_coefficients(coeffs, factor, modulus=None):
+    """Multiplies coefficients by `factor`, modulo `modulus` if it is not `None`. Returns the
+    scaled coefficients, which are promoted to a wider dtype if necessary. The coefficients may
+    be modified in place."""
+    if modulus is not None:
+        scaled = coeffs.astype(np.int64)
+        scaled *= factor % modulus
+        scaled %= modulus
+        coeffs[:] = scaled
+        return coeffs
+    coeffs = widen(coeffs, max(max_abs(coeffs), 1)*abs(factor))
+    coeffs *= factor
+    return coeffs
+
+class ActionImage:
+    """A list of basis elements of a direct sum component with coefficients, each labeled by the
+    basis element of the source it is part of the image of.
+
+    Action images are stored as a struct of arrays, so that the index columns can use a narrow dtype,
+    and the kernels don't have to slice off the source and the coefficient of every row. Row `r`
+    corresponds to the row `[i1,...,ik,j,c]` with `[i1,...,ik] = indices[r]`, `j = sources[r]` and
+    `c = coeffs[r]`.
+
+    Attributes
+    ----------
+    indices : np.ndarray[np.uint8, np.uint16 or np.int32]
+        The indices of the basis elements, in the format of `construct_component`
+    sources : np.ndarray[np.int32]
+        The index of the source basis element of each row
+    coeffs : np.ndarray[np.int32, np.int64 or object]
+        The coefficient of each row, see `coefficient_dtype`
+    layout : ComponentLayout or None
+        The encoding of the basis elements in `indices`, or `None` if they are in the format of
+        `construct_component`
+    """
+
+    def __init__(self, indices, sources, coeffs, layout=None):
+        self.indices = indices
+        self.sources = sources
+        self.coeffs = coeffs
+        self.layout = layout
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Converts an array with rows `[i1,...,ik,j,c]` to an `ActionImage`."""
+        coeffs = np.asarray(rows[:,-1])
+        if coeffs.dtype != object:
+            coeffs = coeffs.astype(coefficient_dtype(max_abs(coeffs)))
+        return cls(np.array(rows[:,:-2], dtype=index_dtype(max_abs(rows[:,:-2].ravel()))),
+                   np.array(rows[:,-2], dtype=np.int32), coeffs)
+
+    def to_rows(self):
+        """Converts the image to an array with rows `[i1,...,ik,j,c]`. The indices are in the
+        format of `layout`."""
+        rows = np.empty((len(self), self.indices.shape[1]+2), np.result_type(np.int64, self.coeffs.dtype))
+        rows[:,:-2] = self.indices
+        rows[:,-2] = self.sources
+        rows[:,-1] = self.coeffs
+        return rows
+
+    @staticmethod
+    def concatenate(images, arena=None):
+        """Concatenates action images with the same layout, promoting to the widest dtypes. If
+        `arena` is not `None`, the result is stored in buffers of the `ScratchArena`."""
+        fields = [[image.indices for image in images],
+                  [image.sources for image in images],
+                  [image.coeffs for image in images]]
+        layout = images[0].layout
+        if arena is None:
+            return ActionImage(*[np.concatenate(arrays) for arrays in fields], layout=layout)
+        num_rows = sum(len(image) for image in images)
+        concatenated = []
+        for arrays in fields:
+            out = arena.empty((num_rows,)+arrays[0].shape[1:], np.result_type(*arrays))
+            concatenated.append(np.concatenate(arrays, out=out))
+        return ActionImage(*concatenated, layout=layout)
+
+    def take(self, rows, arena=None):
+        """The action image consisting of the given rows, which is a list of row numbers. If `arena`
+        is not `None`, the result is stored in buffers of the `ScratchArena`."""
+        if arena is None:
+            return ActionImage(self.indices[rows], self.sources[rows], self.coeffs[rows], self.layout)
+        return ActionImage(*[np.take(array, rows, axis=0, out=arena.empty((len(rows),)+array.shape[1:], array.dtype))
+                             for array in (self.indices, self.sources, self.coeffs)], layout=self.layout)
+
+    def copy(self, arena=None):
+        """Copy of the image. If `arena` is not `None`, the copy is stored in buffers of the
+        `ScratchArena`."""
+        if arena is None:
+            return ActionImage(self.indices.copy(), self.sources.copy(), self.coeffs.copy(), self.layout)
+        copies = []
+        for array in (self.indices, self.sources, self.coeffs):
+            copy = arena.empty(array.shape, array.dtype)
+            copy[...] = array
+            copies.append(copy)
+        return ActionImage(*copies, layout=self.layout)
+
+    def release(self, arena):
+        """Returns the buffers of the image to the `ScratchArena`, if they were obtained from it.
+        The image must not be used afterwards."""
+        arena.release(self.indices, self.sources, self.coeffs)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.sources.nbytes + self.coeffs.nbytes
+
+    def __len__(self):
+        return len(self.coeffs)
+
+# Threads of a thread pool set `single_threaded`, so that their kernels don't start more threads
+_thread_state = threading.local()
+
+cdef int kernel_threads(Py_ssize_t num_rows):
+    """Number of threads to use for a kernel acting on `num_rows` rows. Small inputs are not worth
+    the overhead of starting threads."""
+    if num_rows < PARALLEL_MIN_ROWS or getattr(_thread_state, 'single_threaded', False):
+        return 1
+    return _num_threads
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def count_action_rows(int64_t[:,:,:] action_tensor, int64_t acting_element,
+                      index_t[:,:] indices, int col, int64_t[:] counts, int num_threads):
+    """For each row, count the number of non-zero structure coefficients C_ijk with j the index in `col`."""
+    cdef Py_ssize_t row
+    cdef int64_t s, count
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            s = action_tensor[acting_element, indices[row, col], 0]
+            count = 0
             while s!=0: # if s=0, then there are no non-zero structure coeffs
-                new_row = action_source[row].copy() # copy row, and change index to k
-                new_row[col] = k
-                new_row[-1]*=Cijk # multiply coefficient of element by structure coefficient C_ijk
-                action_image[image_row] = new_row
+                count = count + 1
+                if s==-1: # end of the chain
+                    s = 0
+                else:
+                    s = action_tensor[s, indices[row, col], 0]
+            counts[row] = count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fill_action_rows(int64_t[:,:,:] action_tensor, int64_t acting_element,
+                     index_t[:,:] indices, int32_t[:] sources, coeff_t[:] coeffs, int col,
+                     int64_t[:] offsets, index_t[:,:] image_indices, int32_t[:] image_sources,
+                     coeff_t[:] image_coeffs, int64_t modulus, int num_threads):
+    """Write the image of each row starting at row `offsets[row]` of the image arrays.
+    If `modulus` is non-zero, the coefficients are reduced modulo `modulus`. The caller has to
+    make sure that the coefficients and indices of the image fit in their dtypes."""
+    cdef Py_ssize_t row, c, image_row
+    cdef Py_ssize_t num_cols = indices.shape[1]
+    cdef int64_t j, s, k, Cijk, coeff
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            j = indices[row, col]
+            s = action_tensor[acting_element, j, 0]
+            k = action_tensor[acting_element, j, 1]
+            Cijk = action_tensor[acting_element, j, 2]
+            image_row = offsets[row]
+            while s!=0:
+                for c in range(num_cols): # copy row, and change index to k
+                    image_indices[image_row, c] = indices[row, c]
+                image_indices[image_row, col] = <index_t>k
+                image_sources[image_row] = sources[row]
+                coeff = coeffs[row]*Cijk # multiply coefficient by C_ijk
+                if modulus != 0:
+                    coeff = coeff % modulus
+                    if coeff < 0:
+                        coeff = coeff + modulus
+                image_coeffs[image_row] = <coeff_t>coeff
+                image_row = image_row + 1
                 if s==-1: # end of the chain, break out of loop
-                    s=0
+                    s = 0
                 else: # still more non-zero C_ijk's to deal with
-                    s,k,Cijk = action_tensor[s,j]
-                image_row+=1
-                if image_row>=max_rows: # double size of image matrix if we run out of space
-                    action_image = np.concatenate([action_image,np.zeros_like(action_image)])
-                    max_rows = len(action_image)
-    return action_image[:image_row] # Only return non-zero rows
-
-cdef check_equal(long [:] row1,long [:] row2,int num_cols):
-    """fast check to see if two arrays of given length are equal"""
-    cdef int i
-    for i in range(num_cols):
-        if row1[i]!=row2[i]:
-            return False
+                    k = action_tensor[s, j, 1]
+                    Cijk = action_tensor[s, j, 2]
+                    s = action_tensor[s, j, 0]
+
+structure_bounds_cache = dict()
+
+def structure_bound(action_tensor, acting_element):
+    """Largest absolute value of the structure coefficients C_ijk of `action_tensor` with i equal to
+    `acting_element`. The maxima for all i are computed once for every tensor."""
+    key = id(action_tensor)
+    if key not in structure_bounds_cache or structure_bounds_cache[key][0] is not action_tensor:
+        # Follow all the chains at once, keeping the maximum of each chain
+        cols = np.broadcast_to(np.arange(action_tensor.shape[1]), action_tensor.shape[:2])
+        bounds = np.abs(action_tensor[:,:,2])
+        links = action_tensor[:,:,0].copy()
+        while np.any(links>0):
+            linked = links>0
+            next_links = action_tensor[links[linked], cols[linked]]
+            bounds[linked] = np.maximum(bounds[linked], np.abs(next_links[:,2]))
+            links[linked] = next_links[:,0]
+        structure_bounds_cache[key] = (action_tensor, bounds.max(axis=1, initial=0))
+    return int(structure_bounds_cache[key][1][acting_element])
+
+def action_chains(action_tensor, acting_element):
+    """The non-zero structure coefficients C_ijk of `acting_element` i, as arrays `starts`, `ks`
+    and `coeffs`. The coefficients for j are `coeffs[starts[j]:starts[j+1]]`, with the
+    corresponding k in `ks`."""
+    starts = [0]
+    ks = []
+    coeffs = []
+    for j in range(action_tensor.shape[1]):
+        s, k, Cijk = action_tensor[acting_element, j]
+        while s!=0:
+            ks.append(k)
+            coeffs.append(int(Cijk))
+            if s==-1:
+                s = 0
+            else:
+                s, k, Cijk = action_tensor[s, j]
+        starts.append(len(ks))
+    return np.array(starts, np.int64), np.array(ks, np.int64), np.array(coeffs, object)
+
+# Wedge powers of modules with at most this many basis elements can be stored as bitmasks
+MAX_BITMASK_DIM = 64
+
+class ComponentLayout:
+    """Encoding of the basis elements of a direct sum component in the index columns of an
+    `ActionImage`, used for modules with `wedge_bitmasks` or `sym_multiplicities` set.
+
+    In the format of `construct_component` every factor of a wedge power takes a column, and the
+    image of a generator has to be sorted to find its sign, or that it is zero. Instead, a wedge
+    power of a module with at most `MAX_BITMASK_DIM` basis elements can be stored as a bitmask, with
+    bit `p` set if the `p`-th smallest index of the module occurs. The action of a generator then
+    clears one bit and sets another, and the sign is the parity of the number of set bits in
+    between. Terms in which the new bit is already set are zero, and are never written. The
+    bitmask is split into bytes, which are stored in `ceil(dim/8)` columns starting with the least
+    significant byte, so that the index columns keep their narrow dtype.
+
+    Similarly, a symmetric power can be stored as a multiplicity vector, with in column `p` the
+    number of times the `p`-th smallest index of the module occurs. The action of a generator
+    decrements one multiplicity and increments another, and is multiplied by the decremented
+    multiplicity. This takes one column for every basis element of the module, independent of the
+    power, and the images don't need to be sorted.
+
+    All other tensor slots are stored as in `construct_component`.
+
+    Attributes
+    ----------
+    component : list[tuple(str, int, str)]
+        The groups of columns of the layout, in the format of `LieAlgebraCompositeModule.components`.
+        The number of columns of a bitmask or multiplicity vector is given, and its type is 'mask'
+        or 'multiplicities'.
+    type_list : list[str or None]
+        The module of each column, or `None` for the columns of bitmasks and multiplicity vectors
+    masks : list[tuple(int, int, str, np.ndarray[np.int64])]
+        The first column, the number of columns, the module and the sorted basis of each bitmask
+    multiplicities : list[tuple(int, int, str, np.ndarray[np.int64])]
+        The same for each multiplicity vector
+    max_multiplicity : int
+        The largest power stored as a multiplicity vector, or 1 if there is none
+    """
+
+    def __init__(self, module, comp_num):
+        self.component = []
+        self.type_list = []
+        self.masks = []
+        self.multiplicities = []
+        self.max_multiplicity = 1
+        self.groups = [] # for each group of tensor slots: columns in the rows, columns in the layout, encoding, basis
+        self.chains_cache = dict()
+        row_col = 0
+        col = 0
+        for key, n_inputs, tensor_type in module.components[comp_num]:
+            encoding = slot_encoding(module, key, n_inputs, tensor_type)
+            basis = None
+            if encoding is None:
+                width = n_inputs
+                self.component.append((key, width, tensor_type))
+                self.type_list += [key]*width
+            else:
+                basis = np.sort(np.array(module.modules[key], dtype=np.int64))
+                if encoding == 'mask':
+                    width = (len(basis)+7)//8
+                    self.masks.append((col, width, key, basis))
+                else:
+                    width = len(basis)
+                    self.multiplicities.append((col, width, key, basis))
+                    self.max_multiplicity = max(self.max_multiplicity, n_inputs)
+                self.component.append((key, width, encoding))
+                self.type_list += [None]*width
+            self.groups.append((slice(row_col, row_col+n_inputs), slice(col, col+width), encoding, basis))
+            row_col += n_inputs
+            col += width
+        self.num_cols = col
+
+    def encode(self, rows):
+        """Converts basis elements in the format of `construct_component` to this layout."""
+        rows = np.asarray(rows)
+        max_index = max([max_abs(rows[:, row_cols].ravel()) for row_cols, _, encoding, _ in self.groups
+                         if encoding is None] + [self.max_multiplicity] + [255 if self.masks else 0])
+        indices = np.empty((len(rows), self.num_cols), index_dtype(max_index))
+        for row_cols, cols, encoding, basis in self.groups:
+            if encoding is None:
+                indices[:, cols] = rows[:, row_cols]
+                continue
+            positions = np.searchsorted(basis, rows[:, row_cols])
+            if encoding == 'mask':
+                masks = np.bitwise_or.reduce(np.left_shift(np.uint64(1), positions.astype(np.uint64)), axis=1)
+                for byte in range(cols.stop-cols.start):
+                    indices[:, cols.start+byte] = (masks >> np.uint64(8*byte)) & np.uint64(255)
+            else:
+                multiplicities = indices[:, cols]
+                multiplicities[...] = 0
+                for i in range(positions.shape[1]): # one factor at a time, so no row is incremented twice
+                    multiplicities[np.arange(len(rows)), positions[:, i]] += 1
+        return indices
+
+    def decode(self, indices):
+        """Converts basis elements in this layout to the format of `construct_component`."""
+        num_cols = sum(row_cols.stop-row_cols.start for row_cols, _, _, _ in self.groups)
+        max_index = max([max_abs(indices[:, cols].ravel()) if encoding is None else int(basis[-1])
+                         for _, cols, encoding, basis in self.groups], default=0)
+        rows = np.empty((len(indices), num_cols), index_dtype(max_index))
+        for row_cols, cols, encoding, basis in self.groups:
+            if encoding is None:
+                rows[:, row_cols] = indices[:, cols]
+                continue
+            if encoding == 'mask':
+                bits = np.unpackbits(indices[:, cols].astype(np.uint8), axis=1, bitorder='little')
+                positions = np.nonzero(bits)[1]
+            else: # every row has the same number of factors, in increasing order
+                positions = np.repeat(np.tile(np.arange(len(basis)), len(indices)), indices[:, cols].ravel())
+            rows[:, row_cols] = basis[positions].reshape(len(indices), row_cols.stop-row_cols.start)
+        return rows
+
+    def chains(self, basis, action_tensor, acting_element):
+        """The action of `acting_element` on `basis`, the basis of the module of a bitmask or
+        multiplicity vector, as arrays `starts`, `targets` and `coeffs`. The `p`-th basis element is
+        sent to the sum of `coeffs[e]` times basis element `targets[e]`, for `e` from `starts[p]`
+        to `starts[p+1]`."""
+        key = (id(basis), id(action_tensor), acting_element)
+        if key not in self.chains_cache or self.chains_cache[key][0] is not action_tensor:
+            starts, ks, coeffs = action_chains(action_tensor, acting_element)
+            entries = [np.arange(starts[j], starts[j+1]) for j in basis]
+            lengths = [len(e) for e in entries]
+            entries = np.concatenate(entries).astype(np.int64)
+            self.chains_cache[key] = (action_tensor,
+                                      np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                                      np.searchsorted(basis, ks[entries]).astype(np.int64),
+                                      coeffs[entries].astype(np.int64))
+        return self.chains_cache[key][1:]
+
+def slot_encoding(module, key, n_inputs, tensor_type):
+    """How `ComponentLayout` stores a group of tensor slots: 'mask' for a bitmask, 'multiplicities'
+    for a multiplicity vector, or `None` if the slots are stored as in `construct_component`."""
+    if n_inputs < 2:
+        return None
+    if (getattr(module, 'wedge_bitmasks', False) and tensor_type == 'wedge'
+            and len(module.modules[key]) <= MAX_BITMASK_DIM):
+        return 'mask'
+    if getattr(module, 'sym_multiplicities', False) and tensor_type == 'sym':
+        return 'multiplicities'
+    return None
+
+component_layouts_cache = dict()
+
+def component_layout(module, comp_num):
+    """The `ComponentLayout` of a direct sum component, or `None` if its basis elements are acted on
+    in the format of `construct_component`."""
+    component = module.components[comp_num]
+    encodings = [(key, slot_encoding(module, key, n_inputs, tensor_type))
+                 for key, n_inputs, tensor_type in component]
+    encodings = [(key, encoding) for key, encoding in encodings if encoding is not None]
+    if len(encodings)==0:
+        return None
+    key = (tuple(map(tuple, component)),) + tuple((k, e, tuple(module.modules[k])) for k, e in encodings)
+    if key not in component_layouts_cache:
+        component_layouts_cache[key] = ComponentLayout(module, comp_num)
+    return component_layouts_cache[key]
+
+cdef inline int popcount(uint64_t x) nogil:
+    """Number of set bits of `x`."""
+    x = x - ((x >> 1) & 0x5555555555555555ULL)
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL)
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0FULL
+    return <int>((x * 0x0101010101010101ULL) >> 56)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def count_mask_rows(int64_t[:] starts, int64_t[:] targets, index_t[:,:] indices, int col, int width,
+                    int64_t[:] counts, int num_threads):
+    """For each row, count the number of non-zero terms of the action on the bitmask in columns
+    `col,...,col+width-1`, see `ComponentLayout.chains`."""
+    cdef Py_ssize_t row, c, e
+    cdef uint64_t mask, bits, low
+    cdef int64_t p, q, count
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            mask = 0
+            for c in range(width):
+                mask = mask | ((<uint64_t>indices[row, col+c]) << (8*c))
+            count = 0
+            bits = mask
+            while bits!=0:
+                low = bits & (~bits + 1) # lowest set bit
+                bits = bits ^ low
+                p = popcount(low - 1)
+                for e in range(starts[p], starts[p+1]):
+                    q = targets[e]
+                    if q==p or ((mask >> q) & 1)==0: # otherwise the basis element occurs twice
+                        count = count + 1
+            counts[row] = count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fill_mask_rows(int64_t[:] starts, int64_t[:] targets, int64_t[:] chain_coeffs,
+                   index_t[:,:] indices, int32_t[:] sources, coeff_t[:] coeffs, int col, int width,
+                   int64_t[:] offsets, index_t[:,:] image_indices, int32_t[:] image_sources,
+                   coeff_t[:] image_coeffs, int64_t modulus, int num_threads):
+    """Version of `fill_action_rows` for the bitmask in columns `col,...,col+width-1`."""
+    cdef Py_ssize_t row, c, e, image_row
+    cdef Py_ssize_t num_cols = indices.shape[1]
+    cdef uint64_t mask, bits, low, image_mask, between
+    cdef int64_t p, q, coeff
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            mask = 0
+            for c in range(width):
+                mask = mask | ((<uint64_t>indices[row, col+c]) << (8*c))
+            image_row = offsets[row]
+            bits = mask
+            while bits!=0:
+                low = bits & (~bits + 1) # lowest set bit
+                bits = bits ^ low
+                p = popcount(low - 1)
+                for e in range(starts[p], starts[p+1]):
+                    q = targets[e]
+                    coeff = coeffs[row]*chain_coeffs[e]
+                    if q==p:
+                        image_mask = mask
+                    elif ((mask >> q) & 1)==0:
+                        # Move the bit from p to q. Each set bit in between changes the sign by -1.
+                        image_mask = (mask ^ low) | ((<uint64_t>1) << q)
+                        if p < q:
+                            between = (((<uint64_t>1) << q) - 1) ^ ((low << 1) - 1)
+                        else:
+                            between = (low - 1) ^ (((<uint64_t>2) << q) - 1)
+                        if popcount(mask & between) & 1:
+                            coeff = -coeff
+                    else: # the basis element occurs twice
+                        continue
+                    for c in range(num_cols):
+                        image_indices[image_row, c] = indices[row, c]
+                    for c in range(width):
+                        image_indices[image_row, col+c] = <index_t>((image_mask >> (8*c)) & 255)
+                    image_sources[image_row] = sources[row]
+                    if modulus != 0:
+                        coeff = coeff % modulus
+                        if coeff < 0:
+                            coeff = coeff + modulus
+                    image_coeffs[image_row] = <coeff_t>coeff
+                    image_row = image_row + 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def count_multiplicity_rows(int64_t[:] starts, index_t[:,:] indices, int col, int width,
+                            int64_t[:] counts, int num_threads):
+    """For each row, count the number of terms of the action on the multiplicity vector in columns
+    `col,...,col+width-1`, see `ComponentLayout.chains`."""
+    cdef Py_ssize_t row, p
+    cdef int64_t count
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            count = 0
+            for p in range(width):
+                if indices[row, col+p] != 0:
+                    count = count + starts[p+1] - starts[p]
+            counts[row] = count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fill_multiplicity_rows(int64_t[:] starts, int64_t[:] targets, int64_t[:] chain_coeffs,
+                           index_t[:,:] indices, int32_t[:] sources, coeff_t[:] coeffs, int col, int width,
+                           int64_t[:] offsets, index_t[:,:] image_indices, int32_t[:] image_sources,
+                           coeff_t[:] image_coeffs, int64_t modulus, int num_threads):
+    """Version of `fill_action_rows` for the multiplicity vector in columns `col,...,col+width-1`."""
+    cdef Py_ssize_t row, c, p, e, image_row
+    cdef Py_ssize_t num_cols = indices.shape[1]
+    cdef int64_t q, coeff
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            image_row = offsets[row]
+            for p in range(width):
+                if indices[row, col+p] == 0:
+                    continue
+                for e in range(starts[p], starts[p+1]):
+                    q = targets[e]
+                    for c in range(num_cols):
+                        image_indices[image_row, c] = indices[row, c]
+                    # Move one factor from p to q. Each of the equal factors gives the same term.
+                    image_indices[image_row, col+p] = image_indices[image_row, col+p] - 1
+                    image_indices[image_row, col+q] = image_indices[image_row, col+q] + 1
+                    image_sources[image_row] = sources[row]
+                    coeff = coeffs[row]*chain_coeffs[e]*indices[row, col+p]
+                    if modulus != 0:
+                        coeff = coeff % modulus
+                        if coeff < 0:
+                            coeff = coeff + modulus
+                    image_coeffs[image_row] = <coeff_t>coeff
+                    image_row = image_row + 1
+
+cpdef compute_action(acting_element, action_source, module, comp_num, modulus=None):
+    """Computes action of a single lie algebra element on an `ActionImage`.
+    Outputs a new `ActionImage` where indices and coefficients are replaced as per the action.
+    The output is unsorted, and may contain duplicate entries.
+    If `modulus` is not `None`, the coefficients of `action_source` should lie in [0, modulus),
+    and the output coefficients are reduced modulo `modulus`.
+
+    The output has the dtypes of `action_source`, unless its entries may not fit in them. They are
+    then promoted to wider dtypes. For the coefficients this is determined from the largest
+    coefficient of the source and the largest structure coefficient.
+
+    Rows are processed in parallel. For each column we first count the number of image rows of every
+    source row, so that each row can write its image directly to its place in the output.
+    The arrays of the output are obtained from the `ScratchArena` of the thread. Coefficients that
+    don't fit in 64 bits are computed by acting on the source with unit coefficients, and
+    multiplying by the coefficients of the source afterwards.
+
+    Bitmasks and multiplicity vectors of the `ComponentLayout` of the source, if any, are acted on
+    as a whole by the same procedure."""
+    # Get component types. Each type has a different action of the Lie algebra
+    layout = action_source.layout
+    type_list = module.type_lists[comp_num] if layout is None else layout.type_list
+    action_tensors = [module.action_tensor_dic[mod_type] for mod_type in module.type_lists[comp_num]]
+    column_tensors = [(col, module.action_tensor_dic[mod_type]) for col, mod_type in enumerate(type_list)
+                      if mod_type is not None]
+    mask_chains, multiplicity_chains = [], []
+    max_multiplicity = 1
+    if layout is not None:
+        mask_chains = [(col, width, layout.chains(basis, module.action_tensor_dic[mod_type], acting_element))
+                       for col, width, mod_type, basis in layout.masks]
+        multiplicity_chains = [(col, width, layout.chains(basis, module.action_tensor_dic[mod_type], acting_element))
+                               for col, width, mod_type, basis in layout.multiplicities]
+        max_multiplicity = layout.max_multiplicity
+
+    # Bound the entries of the output
+    if modulus is None:
+        max_structure_coeff = max([structure_bound(t, acting_element) for t in action_tensors], default=0)
+        bound = max_abs(action_source.coeffs)*max_structure_coeff*max_multiplicity
     else:
-        return True
-
-cdef col_nonzero(long [:] col, int num_rows):
-    """returns non-zero indices of a column. np.nonzero doesn't seem to work well with memoryviews."""
-
-    indices = np.zeros(num_rows,np.int32)
-    cdef int i
-    cdef int j = 0
-    for i in range(num_rows):
-        if col[i]!=0:
-            indices[j]=i
-            j+=1
-    return indices[:j]
-
-cdef merge_sorted_image(long [:,:] action_image):
-    """Given sorted array, merges adjacent rows which are equal except for last column, 
-    and adds the values of the last column"""
-    merged_image = np.zeros_like(action_image)
-
-    cdef long[:] old_row
-    cdef long[:] row
-    old_row = np.zeros_like(action_image[0])-1
-
-    cdef int row_number = -1
-    cdef int num_cols = action_image.shape[1]-1
-    cdef int num_rows = action_image.shape[0]
-
-    cdef int i
-    for i in range(num_rows):
-        row = action_image[i]
-        if row[-1]!=0:
-            if check_equal(row,old_row,num_cols): # if previous and current row are equal, add last column to result
-                merged_image[row_number,-1] += row[-1]
+        bound = modulus
+    coeffs = widen(action_source.coeffs, bound)
+    indices = action_source.indices
+    dtype = np.result_type(indices.dtype, index_dtype(max([t.shape[1]-1 for _, t in column_tensors], default=0)))
+    if dtype != indices.dtype:
+        indices = indices.astype(dtype)
+    if coeffs.dtype == object:
+        unit_source = ActionImage(indices, np.arange(len(action_source), dtype=np.int32),
+                                  np.ones(len(action_source), np.int64), layout)
+        action_image = compute_action(acting_element, unit_source, module, comp_num)
+        source_rows, unit_coeffs = action_image.sources, action_image.coeffs
+        action_image.sources = action_source.sources[source_rows]
+        action_image.coeffs = coeffs[source_rows]*unit_coeffs
+        scratch_arena().release(source_rows, unit_coeffs)
+        return action_image
+
+    arena = scratch_arena()
+    counts = arena.empty(len(action_source), np.int64)
+    cdef int num_threads = kernel_threads(len(action_source))
+    slot_offsets = [] # row of the output where the image of each source row starts, for each column or bitmask
+    total_rows = 0
+    for col,action_tensor in column_tensors:
+        count_action_rows(action_tensor, acting_element, indices, col, counts, num_threads)
+        total_rows = cumulative_offsets(counts, total_rows, slot_offsets, arena)
+    for col,width,(starts,targets,_) in mask_chains:
+        count_mask_rows(starts, targets, indices, col, width, counts, num_threads)
+        total_rows = cumulative_offsets(counts, total_rows, slot_offsets, arena)
+    for col,width,(starts,_,_) in multiplicity_chains:
+        count_multiplicity_rows(starts, indices, col, width, counts, num_threads)
+        total_rows = cumulative_offsets(counts, total_rows, slot_offsets, arena)
+
+    action_image = ActionImage(arena.empty((total_rows, indices.shape[1]), indices.dtype),
+                               arena.empty(total_rows, np.int32), arena.empty(total_rows, coeffs.dtype),
+                               layout)
+    for (col,action_tensor),offsets in zip(column_tensors, slot_offsets):
+        fill_action_rows(action_tensor, acting_element, indices, action_source.sources, coeffs, col,
+                         offsets, action_image.indices, action_image.sources,
+                         action_image.coeffs, modulus or 0, num_threads)
+    slot_offsets_iter = iter(slot_offsets[len(column_tensors):])
+    for (col,width,(starts,targets,chain_coeffs)),offsets in zip(mask_chains, slot_offsets_iter):
+        fill_mask_rows(starts, targets, chain_coeffs, indices, action_source.sources, coeffs, col, width,
+                       offsets, action_image.indices, action_image.sources, action_image.coeffs,
+                       modulus or 0, num_threads)
+    for (col,width,(starts,targets,chain_coeffs)),offsets in zip(multiplicity_chains, slot_offsets_iter):
+        fill_multiplicity_rows(starts, targets, chain_coeffs, indices, action_source.sources, coeffs, col,
+                               width, offsets, action_image.indices, action_image.sources,
+                               action_image.coeffs, modulus or 0, num_threads)
+    arena.release(counts, *slot_offsets)
+    return action_image
+
+cdef cumulative_offsets(counts, total_rows, slot_offsets, arena):
+    """Appends the row of the output where the image of each source row starts to `slot_offsets`,
+    given the number of image rows `counts` of each source row, and the number `total_rows` of rows
+    before. Returns the new total number of rows."""
+    offsets = arena.empty(len(counts), np.int64)
+    offsets[0:1] = total_rows
+    np.cumsum(counts[:-1], out=offsets[1:])
+    offsets[1:] += total_rows
+    slot_offsets.append(offsets)
+    return total_rows + int(np.sum(counts))
+
+def pack_columns(columns, num_rows):
+    """Pack the rows formed by a list of non-negative integer columns into single sortable keys.
+
+    Sorting the keys gives the same order as `np.lexsort(columns)`, i.e. the last column is the most
+    significant. If a row fits in 64 bits the keys are `np.uint64`, otherwise each row is encoded
+    as a big-endian bytes key (with `np.void` dtype). The `np.uint64` keys are obtained from the
+    `ScratchArena` of the thread."""
+    if len(columns) == 0 or num_rows == 0:
+        return np.zeros(num_rows, np.uint64)
+    bits = [max(int(column.max()).bit_length(), 1) for column in columns]
+
+    if sum(bits) <= 64:
+        arena = scratch_arena()
+        keys = arena.empty(num_rows, np.uint64)
+        keys[:] = 0
+        shifted = arena.empty(num_rows, np.uint64)
+        shift = 0
+        for column, column_bits in zip(columns, bits):
+            np.copyto(shifted, column, casting='unsafe')
+            np.left_shift(shifted, np.uint64(shift), out=shifted)
+            keys |= shifted
+            shift += column_bits
+        arena.release(shifted)
+        return keys
+
+    # Row doesn't fit in a single word. Store the columns in reversed order in big-endian format,
+    # so that comparing the raw bytes is the same as comparing the rows lexicographically.
+    if max(bits) <= 32:
+        wide_type = np.dtype('>u4')
+    else:
+        wide_type = np.dtype('>u8')
+    wide_rows = np.empty((num_rows, len(columns)), wide_type)
+    for col, column in enumerate(columns[::-1]):
+        wide_rows[:, col] = column
+    return wide_rows.view(np.dtype((np.void, wide_type.itemsize * len(columns)))).ravel()
+
+def pack_rows(index_rows):
+    """Pack every row of a non-negative integer array into a single sortable key, see `pack_columns`.
+    Sorting the keys gives the same order as `np.lexsort(np.transpose(index_rows))`."""
+    return pack_columns([index_rows[:, col] for col in range(index_rows.shape[1])], len(index_rows))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def segment_sums(coeff_t[:] values, int64_t[:] starts, int64_t[:] sums, int num_threads):
+    """Sums `values` over the segments starting at `starts`. Each segment is summed by a single thread.
+    The caller has to make sure that the sums fit in 64 bits."""
+    cdef Py_ssize_t num_segments = starts.shape[0]
+    cdef Py_ssize_t segment, i, end
+    cdef int64_t total
+    with nogil:
+        for segment in prange(num_segments, num_threads=num_threads, schedule='static'):
+            if segment+1<num_segments:
+                end = starts[segment+1]
             else:
-                row_number+=1
-                merged_image[row_number]=row
-                old_row = row
-    row_number+=1
-    non_zero_inds = col_nonzero(merged_image[:row_number,-1],row_number) # Only return rows where column is non-zero
-    return merged_image[non_zero_inds,:]
-
-def sort_merge(action_image):
-    """Sorts array, ignoring last column and merges rows which are equal, summing in the last column"""
-    action_image = action_image[np.lexsort(np.transpose(action_image[:,:-1]))]
-    return merge_sorted_image(action_image)
-
-cdef permutation_sign(long [:] row,int num_cols):
-    """Computes the sign of a permutation using bubble sort (efficient for extremely short inputs)"""
-    cdef int sign = 1
-    cdef int i,j
-    for i in range(num_cols):
-        for j in range(i+1,num_cols):
-            if row[i]==row[j]: # if there are duplicate entries then sign is 0 per definition
-                return 0
-            elif row[i]>row[j]: # For each swap we have to do, the sign changes by -1.
-                sign*=-1
-    return sign
-
-cdef sort_cols(module, action_image,comp_num):
-    """Sort all the entries of each tensor component. If tensor component is a wedge power, then
-    mutliply coefficient by sign of permutation sorting the row."""
-    cdef int col_min = 0
-    cdef int num_rows = len(action_image)
-    cdef int i
-    cdef long[:] row
-
-    for _,cols,mod_type in module.components[comp_num]:
-        if cols>1: # List with one item is always sorted
-            if mod_type == 'wedge':
-                for i in range(num_rows):
-                    row = action_image[i,col_min:col_min+cols]
-                    action_image[i,-1]*=permutation_sign(row,cols) # Change coefficient by sign of permutation
-            action_image[:,col_min:col_min+cols] = np.sort(action_image[:,col_min:col_min+cols]) # sort the rows
-        col_min+=cols
-
-cpdef action_on_basis(pbw_elt,wmbase,module,factory,comp_num):
-    """Computes the action of an element of U(n) in PBW order on a basis of the weight component.
-    Input is the PBW element, the basis of the weight component,
-    the factory that created the module, and the number of the direct sum component"""
-
-    num_cols = wmbase.shape[1]
-    action_list = []
-    action_source = np.zeros((wmbase.shape[0], num_cols+2),np.int64)
-    action_source[:,:num_cols] = wmbase
-    action_source[:,num_cols] = np.arange(len(wmbase))
-    action_source[:,-1] = 1
-
-    # Compute action for each monomial seperately, and then sum results
-    for monomial,coefficient in pbw_elt.monomial_coefficients().items():
-        action_image = action_source.copy()
-        action_image[:,-1]*=coefficient # mutliply results by coefficient of monomial
-        for term in monomial.to_word_list()[::-1]: # Right action, so we take terms of the monomial in inverse order
-            index = factory.root_to_index[term] # get the index of the term
-            action_image = compute_action(index, action_image, module, comp_num) # compute the action
-        action_list.append(action_image)
-    action_image = np.concatenate(action_list) # concatenate and merge is equivalent to summing the results.
-    if len(action_image)==0: # merging gives errors for empty matrices
+                end = values.shape[0]
+            total = 0
+            for i in range(starts[segment], end):
+                total = total + values[i]
+            sums[segment] = total
+
+def merge_keys(keys, coeffs, modulus=None):
+    """Sums `coeffs` over equal `keys`, modulo `modulus` if it is not `None`. Returns for each
+    distinct key with a non-zero sum the position of its first occurrence, and the sums. These
+    are ordered by key.
+
+    Sums that may not fit in 64 bits are computed with Python integers."""
+    arena = scratch_arena()
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = np.take(keys, order, out=arena.empty(len(keys), keys.dtype))
+
+    # Find the first row of each block of equal rows, and sum the coefficients in each block.
+    # No partial sum is larger than the largest coefficient times the length of the longest block.
+    is_start = arena.empty(len(keys), np.bool_)
+    is_start[0] = True
+    is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(is_start)
+    arena.release(sorted_keys, is_start)
+    segment_lengths = np.diff(starts, append=len(keys))
+    if coeffs.dtype != object and max_abs(coeffs)*int(segment_lengths.max()) <= INT64_MAX:
+        sorted_coeffs = np.take(coeffs, order, out=arena.empty(len(coeffs), coeffs.dtype))
+        sums = arena.empty(len(starts), np.int64)
+        segment_sums(sorted_coeffs, starts.astype(np.int64), sums, kernel_threads(len(keys)))
+        arena.release(sorted_coeffs)
+    else:
+        sums = np.add.reduceat(coeffs[order].astype(object), starts)
+    if modulus is not None:
+        sums %= modulus
+    nonzero = sums != 0
+    merged_rows, merged_sums = order[starts[nonzero]], sums[nonzero]
+    arena.release(sums)
+    return merged_rows, merged_sums
+
+def merged_dtype(dtype, sums):
+    """Dtype for the merged coefficients `sums` of coefficients with dtype `dtype`. This is only
+    narrower than `dtype` for Python integers that turn out to fit in 64 bits."""
+    if dtype == object:
+        dtype = np.int64
+    return np.result_type(dtype, coefficient_dtype(max_abs(sums)))
+
+def sort_merge(action_image, modulus=None):
+    """Sorts array, ignoring last column and merges rows which are equal, summing in the last column.
+    Rows for which the sum is zero are dropped. If `modulus` is not `None`, the sums are reduced
+    modulo `modulus`.
+
+    The result is promoted to a wider dtype if the sums don't fit in the dtype of `action_image`.
+    Sums that may not fit in 64 bits are computed with Python integers, and the result only has
+    `object` dtype if they actually don't fit. See `merge_image` for action images."""
+    if len(action_image) == 0:
         return action_image
+
+    # Sort on a single packed key instead of on every column
+    if action_image.dtype == object:
+        keys = pack_rows(action_image[:, :-1].astype(np.int64))
     else:
-        sort_cols(module,action_image,comp_num) # Sort and merge
-        action_image = sort_merge(action_image)
+        keys = pack_rows(action_image[:, :-1])
+    rows, sums = merge_keys(keys, action_image[:, -1], modulus)
+    scratch_arena().release(keys)
+
+    merged_image = action_image[rows]
+    if merged_image.dtype == object:
+        # Only keep Python integers if necessary
+        merged_image[:, -1] = sums
+        return merged_image.astype(merged_dtype(object, sums))
+    merged_image = merged_image.astype(merged_dtype(merged_image.dtype, sums), copy=False)
+    merged_image[:, -1] = sums
+    return merged_image
 
+def merge_image(action_image, modulus=None):
+    """Sorts an `ActionImage` by source and basis element, and merges rows with the same source and
+    basis element, summing the coefficients. Rows for which the sum is zero are dropped. If
+    `modulus` is not `None`, the sums are reduced modulo `modulus`. See `sort_merge`.
+    The index columns and sources of the result are obtained from the `ScratchArena` of the
+    thread."""
+    if len(action_image) == 0:
         return action_image
 
+    # Sort on a single packed key, with the source as most significant column
+    arena = scratch_arena()
+    columns = [action_image.indices[:, col] for col in range(action_image.indices.shape[1])]
+    keys = pack_columns(columns + [action_image.sources], len(action_image))
+    rows, sums = merge_keys(keys, action_image.coeffs, modulus)
+    arena.release(keys)
+    indices = np.take(action_image.indices, rows, axis=0,
+                      out=arena.empty((len(rows), action_image.indices.shape[1]), action_image.indices.dtype))
+    sources = np.take(action_image.sources, rows, out=arena.empty(len(rows), np.int32))
+    return ActionImage(indices, sources, sums.astype(merged_dtype(action_image.coeffs.dtype, sums)),
+                       action_image.layout)
+
+# Optimal sorting networks for short rows, as lists of compare-exchange pairs
+SORTING_NETWORKS = {
+    2: [(0,1)],
+    3: [(0,2),(0,1),(1,2)],
+    4: [(0,1),(2,3),(0,2),(1,3),(1,2)],
+    5: [(0,1),(3,4),(2,4),(2,3),(0,3),(0,2),(1,4),(1,3),(1,2)],
+    6: [(1,2),(4,5),(0,2),(3,5),(0,1),(3,4),(2,5),(0,3),(1,4),(2,4),(1,3),(2,3)],
+    7: [(1,2),(3,4),(5,6),(0,2),(3,5),(4,6),(0,1),(4,5),(2,6),(0,4),(1,5),(0,3),(2,5),(1,3),(2,4),(2,3)],
+    8: [(0,2),(1,3),(4,6),(5,7),(0,4),(1,5),(2,6),(3,7),(0,1),(2,3),(4,5),(6,7),(2,4),(3,5),(1,4),(3,6),
+        (1,2),(3,4),(5,6)],
+}
+
+def sorting_network(width):
+    """Returns a sorting network for rows of length `width`. For long rows we use odd-even
+    transposition sort, which is a sorting network with `width` layers."""
+    if width in SORTING_NETWORKS:
+        return SORTING_NETWORKS[width]
+    return [(i, i+1) for layer in range(width) for i in range(layer % 2, width-1, 2)]
+
+slot_networks_cache = dict()
+
+def slot_networks(component):
+    """Compiles the sorting networks for all the tensor slots of a direct sum component.
+
+    Returns an array with a row `[col_min, cols, wedge, net_start, net_end]` for each slot
+    with more than one column, and an array with the compare-exchange pairs of all the networks.
+    The network of a slot consists of rows `net_start,...,net_end-1` of the second array."""
+    key = tuple(component)
+    if key not in slot_networks_cache:
+        slots = []
+        comparators = []
+        col_min = 0
+        for _,cols,mod_type in component:
+            if cols>1 and mod_type not in ('mask', 'multiplicities'): # List with one item is always sorted
+                network = sorting_network(cols)
+                slots.append([col_min, cols, mod_type == 'wedge', len(comparators), len(comparators)+len(network)])
+                comparators += network
+            col_min+=cols
+        slot_networks_cache[key] = (np.array(slots, np.int64).reshape(-1, 5),
+                                    np.array(comparators, np.int64).reshape(-1, 2))
+    return slot_networks_cache[key]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sort_slots(index_t[:,:] indices, coeff_t[:] coeffs, int64_t[:,:] slots, int64_t[:,:] comparators,
+               int num_threads):
+    """Sorts every tensor slot of every row with a sorting network. For wedge slots the parity of the
+    swaps gives the sign of the permutation, and a repeated index makes the coefficient zero."""
+    cdef Py_ssize_t row, slot, c, a, b
+    cdef index_t value
+    cdef int parity
+    with nogil:
+        for row in prange(indices.shape[0], num_threads=num_threads, schedule='static'):
+            for slot in range(slots.shape[0]):
+                parity = 0
+                for c in range(slots[slot, 3], slots[slot, 4]):
+                    a = slots[slot, 0] + comparators[c, 0]
+                    b = slots[slot, 0] + comparators[c, 1]
+                    if indices[row, a] > indices[row, b]: # each swap changes the sign by -1
+                        value = indices[row, a]
+                        indices[row, a] = indices[row, b]
+                        indices[row, b] = value
+                        parity = parity ^ 1
+                if slots[slot, 2]: # wedge power
+                    for c in range(slots[slot, 0], slots[slot, 0]+slots[slot, 1]-1):
+                        if indices[row, c] == indices[row, c+1]: # sign is 0 for duplicate entries
+                            coeffs[row] = 0
+                    if parity:
+                        coeffs[row] = -coeffs[row]
+
+cpdef sort_cols(module, action_image,comp_num):
+    """Sort all the entries of each tensor component of an `ActionImage`. If tensor component is a
+    wedge power, then mutliply coefficient by sign of permutation sorting the row. Bitmasks and
+    multiplicity vectors of the layout of the image are left as they are."""
+    if action_image.layout is None:
+        slots, comparators = slot_networks(module.components[comp_num])
+    else:
+        slots, comparators = slot_networks(action_image.layout.component)
+    if len(slots)==0:
+        return
+    num_threads = kernel_threads(len(action_image))
+    if action_image.coeffs.dtype == object:
+        # Sort the indices, keeping track of the signs separately
+        signs = np.ones(len(action_image), np.int32)
+        sort_slots(action_image.indices, signs, slots, comparators, num_threads)
+        action_image.coeffs *= signs
+    else:
+        sort_slots(action_image.indices, action_image.coeffs, slots, comparators, num_threads)
+
+def word_trie(pbw_elt, factory):
+    """Compiles a PBW element into a trie of generator words.
+
+    Since the action is a right action, the words are stored in reverse order, so that monomials
+    ending in the same generators share a path from the root. Each node is a pair
+    `[coefficient, children]`, where `children` maps generator indices to nodes and `coefficient`
+    is the coefficient of the monomial ending at this node (zero if there is no such monomial)."""
+    root = [0, dict()]
+    for monomial, coefficient in pbw_elt.monomial_coefficients().items():
+        node = root
+        for term in monomial.to_word_list()[::-1]:
+            index = factory.root_to_index[term]
+            if index not in node[1]:
+                node[1][index] = [0, dict()]
+            node = node[1][index]
+        node[0] += coefficient
+    return root
+
+class MapProgram:
+    """A map of the BGG complex compiled to a flat program that can be applied without Sage objects.
+
+    The program is the trie of `word_trie` stored in depth-first order. Node `n` applies
+    generator `gens[n]` to the image of its parent, which is the last node before `n` of depth
+    `depths[n]-1` (or the source itself if `depths[n]` is 1). Any non-zero `coeffs[n]` gives
+    the coefficient of the word ending at this node. The whole result is multiplied by `scale`.
+
+    Attributes
+    ----------
+    gens : np.ndarray[np.int64]
+        Index of the generator applied at each node
+    depths : np.ndarray[np.int64]
+        Depth of each node (length of the word ending at this node)
+    coeffs : np.ndarray[np.int64]
+        Coefficient of the word ending at each node
+    root_coeff : int
+        Coefficient of the empty word
+    scale : int
+        Common factor of all the coefficients, including the sign of the map
+    """
+
+    def __init__(self, gens, depths, coeffs, root_coeff, scale):
+        self.gens = gens
+        self.depths = depths
+        self.coeffs = coeffs
+        self.root_coeff = root_coeff
+        self.scale = scale
+
+def compile_map(pbw_elt, factory, sign=1):
+    """Compiles `sign` times a PBW element into a `MapProgram`. The coefficients should be integers."""
+    root = word_trie(pbw_elt, factory)
+
+    # Flatten the trie in depth-first order
+    gens = []
+    depths = []
+    coeffs = []
+    stack = [(index, 1, child) for index, child in root[1].items()][::-1]
+    while len(stack)>0:
+        index, depth, node = stack.pop()
+        gens.append(index)
+        depths.append(depth)
+        coeffs.append(node[0])
+        stack += [(i, depth+1, child) for i, child in node[1].items()][::-1]
+
+    # Pull out the common factor of the coefficients, these are now integers
+    try:
+        coeffs = [int(ZZ(c)) for c in coeffs]
+        root_coeff = int(ZZ(root[0]))
+    except TypeError:
+        raise ValueError("Only maps with integer coefficients can be compiled")
+    scale = reduce(gcd, coeffs, root_coeff)
+    if scale == 0:
+        scale = 1
+    coeffs = [c // scale for c in coeffs]
+    root_coeff = root_coeff // scale
+
+    return MapProgram(np.array(gens, np.int64), np.array(depths, np.int64), np.array(coeffs, np.int64),
+                      root_coeff, scale*int(sign))
+
+def get_map_program(BGG, mu, arrow, factory):
+    """Returns the signed map of the BGG complex for dominant weight `mu` and edge `arrow`
+    as `MapProgram`. Programs are cached on the BGGComplex, so that each map is compiled only once."""
+    key = (mu, arrow)
+    if key not in BGG._map_programs:
+        BGG._map_programs[key] = compile_map(BGG._maps[mu][arrow], factory, sign=BGG.signs[arrow])
+    return BGG._map_programs[key]
+
+class ImageAccumulator:
+    """Running sum of `ActionImage`s with bounded memory.
+
+    Images are kept unmerged until their total size exceeds `memory_limit` bytes. They are then
+    sorted and merged together with the running result, so that the memory used is proportional
+    to the size of the merged result rather than the total number of terms.
+
+    Parameters
+    ----------
+    module : LieAlgebraCompositeModule
+    comp_num : int
+        The number of the direct sum component of the images
+    scale : int (default: 1)
+        All images are multiplied by this number
+    memory_limit : int or `None` (default: None)
+        Maximum number of bytes of unmerged images. If `None`, use `get_memory_limit()`.
+    modulus : int or `None` (default: None)
+        If not `None`, the coefficients of the images should lie in [0, modulus), and the sum is
+        computed modulo `modulus`.
+    """
+
+    def __init__(self, module, comp_num, scale=1, memory_limit=None, modulus=None):
+        self.module = module
+        self.comp_num = comp_num
+        self.modulus = modulus
+        if modulus is not None:
+            scale = scale % modulus
+        self.scale = scale
+        if memory_limit is None:
+            memory_limit = _memory_limit
+        self.memory_limit = memory_limit
+        self.merged = None
+        self.pending = []
+        self.pending_bytes = 0
+
+    def add(self, action_image):
+        """Add an action image to the sum. The image may be modified in place, and its buffers are
+        returned to the scratch arena once they have been merged."""
+        if len(action_image)==0:
+            return
+        self.pending.append(action_image)
+        self.pending_bytes += action_image.nbytes
+        if self.pending_bytes > self.memory_limit:
+            self.flush()
+
+    def flush(self):
+        """Merge the pending images into the running result."""
+        if len(self.pending)==0:
+            return
+        # Merged images are not used afterwards, so their buffers go back to the scratch arena
+        arena = scratch_arena()
+        if len(self.pending)==1:
+            action_image = self.pending[0]
+        else:
+            action_image = ActionImage.concatenate(self.pending, arena)
+            for pending_image in self.pending:
+                pending_image.release(arena)
+        self.pending = []
+        self.pending_bytes = 0
+        if self.scale!=1:
+            action_image.coeffs = scale_coefficients(action_image.coeffs, self.scale, self.modulus)
+        sort_cols(self.module,action_image,self.comp_num)
+        if self.merged is not None: # the running result is already sorted
+            combined_image = ActionImage.concatenate([self.merged, action_image], arena)
+            self.merged.release(arena)
+            action_image.release(arena)
+            action_image = combined_image
+        self.merged = merge_image(action_image, self.modulus)
+        if self.merged is not action_image:
+            action_image.release(arena)
+
+    def result(self):
+        """Merge all pending images and return the sum, or `None` if nothing was added."""
+        self.flush()
+        return self.merged
+
+cdef scaled_copy(action_image, factor, modulus):
+    """Copy of an `ActionImage` with the coefficients multiplied by `factor`, stored in the scratch
+    arena."""
+    arena = scratch_arena()
+    action_image = action_image.copy(arena)
+    coeffs = scale_coefficients(action_image.coeffs, factor, modulus)
+    if coeffs is not action_image.coeffs: # coefficients were promoted to a wider dtype
+        arena.release(action_image.coeffs)
+        action_image.coeffs = coeffs
+    return action_image
+
+cdef run_program(program, action_source, module, comp_num, accumulator, modulus):
+    """Applies all the words of a `MapProgram` to `action_source`, adding the results to `accumulator`.
+    The image of a shared suffix is computed only once, and reused for all the words containing it.
+    If `modulus` is not `None`, all coefficients are reduced modulo `modulus`.
+    Images that are no longer needed are returned to the scratch arena."""
+    arena = scratch_arena()
+    if program.root_coeff != 0:
+        accumulator.add(scaled_copy(action_source, program.root_coeff, modulus))
+
+    cdef long[:] gens = program.gens
+    cdef long[:] depths = program.depths
+    cdef long[:] coeffs = program.coeffs
+    cdef int node, depth
+    cdef int skip_depth = 0 # if non-zero, skip all nodes below a node with empty image
+
+    images = [action_source] # images[d] is the image of the first d generators of the current word
+    for node in range(len(gens)):
+        depth = depths[node]
+        if skip_depth>0:
+            if depth>skip_depth:
+                continue
+            skip_depth = 0
+        for image in images[depth:]:
+            image.release(arena)
+        del images[depth:]
+        action_image = compute_action(gens[node], images[depth-1], module, comp_num, modulus)
+        if len(action_image)==0: # prune the branch if nothing is left to act on
+            skip_depth = depth
+            continue
+        images.append(action_image)
+        if coeffs[node]!=0: # mutliply results by coefficient of monomial
+            accumulator.add(scaled_copy(action_image, coeffs[node], modulus))
+    for image in images[1:]:
+        image.release(arena)
+
+cpdef action_on_basis(pbw_elt,wmbase,module,factory,comp_num,memory_limit=None,modulus=None):
+    """Computes the action of an element of U(n) in PBW order on a basis of the weight component.
+    Input is the PBW element (or a `MapProgram`), the basis of the weight component,
+    the factory that created the module, and the number of the direct sum component.
+    Returns an `ActionImage`, whose sources are the row numbers in `wmbase`.
+
+    The images of the monomials are summed in chunks of at most `memory_limit` bytes
+    (default: `get_memory_limit()`), so the memory used does not grow with the number of terms.
+    If `modulus` is not `None`, the coefficients are computed modulo `modulus`, and lie in
+    [0, modulus). The modulus should be smaller than 2**31, so that products fit in 64 bits.
+
+    The coefficients have dtype `np.int32` if they fit, and are promoted to a wider dtype otherwise,
+    see `compute_action`. If the direct sum component has a `ComponentLayout`, the action is computed
+    in that layout, and the result is converted back to the format of `construct_component`."""
+    if isinstance(pbw_elt, MapProgram):
+        program = pbw_elt
+    else:
+        program = compile_map(pbw_elt, factory)
+
+    if len(wmbase) > INT32_MAX:
+        raise OverflowError("Can't act on more than 2**31-1 basis elements at once")
+    arena = scratch_arena()
+    layout = component_layout(module, comp_num)
+    if layout is None:
+        indices = arena.empty(wmbase.shape, index_dtype(max_abs(wmbase.ravel())))
+        indices[...] = wmbase
+    else:
+        indices = layout.encode(wmbase)
+    sources = arena.empty(len(wmbase), np.int32)
+    sources[:] = np.arange(len(wmbase))
+    coeffs = arena.empty(len(wmbase), np.int32)
+    coeffs[:] = 1
+    action_source = ActionImage(indices, sources, coeffs, layout)
+
+    # Compute action for each monomial, sharing the work for monomials with a common suffix,
+    # and then sum results
+    accumulator = ImageAccumulator(module, comp_num, program.scale, memory_limit, modulus)
+    run_program(program, action_source, module, comp_num, accumulator, modulus)
+    action_source.release(arena)
+    action_image = accumulator.result()
+    if action_image is None:
+        return ActionImage(np.empty((0, wmbase.shape[1]), index_dtype(max_abs(wmbase.ravel()))),
+                           np.empty(0, np.int32), np.empty(0, np.int32))
+    if layout is not None:
+        action_image = ActionImage(layout.decode(action_image.indices), action_image.sources,
+                                   action_image.coeffs)
+    return action_image
+
 def check_weights(module,action_image):
     weights = set()
-    for row in action_image[:,:-2]:
+    for row in action_image.indices:
         mu = sum(module.weight_dic[s] for s in row)
         weights.add(tuple(mu))
     if len(weights)>1:
         raise ValueError("Found too many weights :(")
 
-def compute_diff(cohom, mu, i):
-    """"
-    Computes the BGG differential associated to a BGGCohomology object, weight mu and degree i.
-    The matrix produced is of the correct rank, but omits some rows consisting entirely of zeros.
-    In order to correctly compute kernel, the dimension of the source space is therefore also returned.
+def basis_to_triplets(module, mu, comp_num, action_image, check=False):
+    """Converts an `ActionImage`, e.g. the output of `action_on_basis`, to rows `[target, source, coeff]` with dtype
+    `np.int64`. Raises `OverflowError` if the coefficients don't fit in 64 bits.
+
+    The sets of indices [i1,...,ik] of direct sum component `comp_num` are replaced by a single
+    index for the whole weight component `mu`, see `LieAlgebraCompositeModule.rank_rows`.
+    The index is computed in the weight component of each row, which should be `mu`. If `check`
+    is `True`, raises `KeyError` if a row has a different weight."""
+    if action_image.coeffs.dtype == object:
+        raise OverflowError("Coefficients of the action don't fit in 64 bits, compute modulo primes instead")
+    if check and len(action_image) > 0:
+        weight_mat = np.array([w for _, w in sorted(module.weight_dic.items(), key=lambda t: t[0])],
+                              dtype=np.int64)
+        weights = weight_mat[np.asarray(action_image.indices, np.int64)].sum(axis=1)
+        if np.any(weights != np.asarray(mu, np.int64)):
+            raise KeyError("Basis elements are not in weight component %s" % (mu,))
+    triplets = np.zeros((len(action_image),3),dtype=np.int64)
+    triplets[:,0] = module.rank_rows(comp_num, action_image.indices)
+    triplets[:,1] = action_image.sources
+    triplets[:,2] = action_image.coeffs
+    return triplets
+
+def chunk_rows(program, weight_comp):
+    """Number of rows of `weight_comp` to act on at once with `program`, so that the images take
+    roughly at most `get_diff_memory_budget()` bytes. We estimate the images of a row to take as
+    much memory as the row, for every node of the program. Rows are counted with 32 bit indices and
+    sources, and 64 bit coefficients."""
+    row_bytes = (weight_comp.shape[1]+1)*np.dtype(np.int32).itemsize + np.dtype(np.int64).itemsize
+    return max(1, _diff_memory_budget // (row_bytes*(len(program.gens)+1)))
+
+def arrow_component_triplets(module, program, initial_vertex, final_vertex, position,
+                             row_start=0, row_end=None, modulus=None):
+    """Computes the action of a compiled map on the direct sum component at `position` in
+    `module.weight_components[initial_vertex]`, as rows `[target, source, coeff]`. The indices
+    are of the bases of the entire weight components `final_vertex` and `initial_vertex`.
+    Optionally only act on the basis elements with index from `row_start` to `row_end` in the
+    direct sum component, and compute the coefficients modulo `modulus`."""
+    components = module.weight_components[initial_vertex]
+    comp_offset_s = sum(module.dimensions_components[comp_num][initial_vertex]
+                        for comp_num, _ in components[:position])
+    comp_num, weight_comp = components[position]
+
+    # compute the action of the PBW element
+    basis_action = action_on_basis(program,weight_comp[row_start:row_end],module,module.factory,comp_num,
+                                   modulus=modulus)
+    if len(basis_action)==0:
+        return np.zeros((0,3), np.int64)
+    triplets = basis_to_triplets(module, final_vertex, comp_num, basis_action)
+    triplets[:,1] += comp_offset_s + row_start # update source
+    return triplets
+
+def diff_tasks(cohom, mu, i):
+    """Splits the computation of the BGG differential for weight `mu` and degree `i` into tasks.
+
+    Every pair of an arrow of the Bruhat graph and a direct sum component of its source gives
+    independent tasks, and large direct sum components are split into chunks of rows to limit
+    memory usage. Each task is a tuple `(program, initial_vertex, final_vertex, position, rows,
+    target_offset, source_offset)`, see `task_triplets`.
+
+    Returns the list of tasks, and the dimensions of the source and the target of the differential.
     """
     # aliases
     BGG = cohom.BGG
@@ -177,9 +1425,6 @@ def compute_diff(cohom, mu, i):
     # weights associated to each vertex of the Bruhat graph
     vertex_weights = cohom.weight_set.get_vertex_weights(mu)
 
-    # maps of the BGG complex
-    maps = BGG._maps[mu]
-
     # for each vertex, get the arrows in the Bruhat graph going out of it.
     column = BGG.column[i]
     delta_i_arrows = [(w, [arrow for arrow in BGG.arrows if arrow[0] == w]) for w in column]
@@ -191,13 +1436,14 @@ def compute_diff(cohom, mu, i):
     # To give the weights in the target column a unique index, we compute
     # an offset for each weight component in the target column
     offset = 0
-    for w,mu in target_col_dic.items():
+    for w,nu in target_col_dic.items():
         target_col_dic[w] = offset
-        if cohom.has_coker and (mu in cohom.coker):
-            offset+=cohom.coker[mu].nrows() # Dimension of quotient is number of rows
+        if cohom.has_coker and (nu in cohom.coker):
+            offset+=cohom.coker[nu].nrows() # Dimension of quotient is number of rows
         else:
-            if mu in module.dimensions:
-                offset+=module.dimensions[mu]
+            if nu in module.dimensions:
+                offset+=module.dimensions[nu]
+    target_dim = offset
 
     # Compute dimension of source space by adding dimensions of weight components in the column
     source_dim = 0
@@ -209,109 +1455,231 @@ def compute_diff(cohom, mu, i):
             else:
                 source_dim += cohom.weight_module.dimensions[initial_vertex]
 
-
+    # Each basis element of a source weight component gets an index. Because we have multiple
+    # weight components, we add an offset to this index so that it is unique across components.
+    # With a cokernel the indices are those of the basis of the quotient, so the offsets add up
+    # the dimensions of the quotients. All arrows out of a vertex act on the same chunks, so that
+    # the tasks for a chunk together give complete columns of the differential.
+    tasks = []
     offset = 0
-    total_diff=[]
     for w, arrows in delta_i_arrows:
         initial_vertex = vertex_weights[w]  # weight of vertex
         if initial_vertex in cohom.weights:  # Ensure weight component isn't empty
-            action_images = []
-            for a in arrows: # Compute image for each arrow
-                final_vertex = vertex_weights[a[1]]
+            # The maps, multiplied by the sign of the map in BGG complex, compiled to programs
+            arrow_programs = [(get_map_program(BGG, mu, a, factory), vertex_weights[a[1]],
+                               target_col_dic[a[1]]) for a in arrows]
+            if cohom.action_engine == 'sparse':
+                for program, final_vertex, target_offset in arrow_programs:
+                    tasks.append((program, initial_vertex, final_vertex, None, None, target_offset, offset))
+            elif len(arrow_programs) > 0:
+                for position, (_, weight_comp) in enumerate(module.weight_components[initial_vertex]):
+                    chunk_size = min(chunk_rows(program, weight_comp) for program, _, _ in arrow_programs)
+                    for row_start in range(0, len(weight_comp), chunk_size):
+                        rows = (row_start, row_start+chunk_size)
+                        for program, final_vertex, target_offset in arrow_programs:
+                            tasks.append((program, initial_vertex, final_vertex, position, rows,
+                                          target_offset, offset))
+            if cohom.has_coker and (initial_vertex in cohom.coker):
+                offset += cohom.coker[initial_vertex].nrows()
+            else:
+                offset += module.dimensions[initial_vertex]
+    return tasks, source_dim, target_dim
+
+def task_triplets(cohom, task, modulus=None):
+    """Computes the entries of the differential coming from a task of `diff_tasks`, as rows
+    `[target, source, coeff]`. The indices are local to the target and source weight components,
+    and don't include the offsets of the task. If there is a cokernel, the images are not reduced
+    to the basis of the quotient, see `coker_project`."""
+    program, initial_vertex, final_vertex, position, rows, _, _ = task
+    if position is None:
+        return cohom.generator_matrices.map_action_triplets(program, initial_vertex, modulus)
+    return arrow_component_triplets(cohom.weight_module, program, initial_vertex, final_vertex,
+                                    position, *rows, modulus=modulus)
 
-                sign = BGG.signs[a] # Multiply everything by the sign of the map in BGG complex
+def compute_diff(cohom, mu, i, modulus=None, matrix_free=False):
+    """"
+    Computes the BGG differential associated to a BGGCohomology object, weight mu and degree i.
+    The matrix produced is of the correct rank, but omits some rows consisting entirely of zeros.
+    In order to correctly compute kernel, the dimension of the source space is therefore also returned.
+    The matrix is returned as a `SparseDifferential`, use its `to_sage` method to get a Sage matrix.
 
-                comp_offset_s = 0
+    If `modulus` is a prime smaller than 2**31, all the coefficients are computed modulo `modulus`,
+    so that they never overflow, and the differential is a matrix over GF(modulus).
+    If `matrix_free` is `True`, a `DifferentialOperator` is returned instead, which computes
+    products with vectors without storing the matrix. This requires `modulus`.
+    """
+    if matrix_free:
+        if modulus is None:
+            raise ValueError("A matrix-free differential needs a modulus")
+        operator = DifferentialOperator(cohom, mu, i, modulus)
+        return operator, operator.shape[1]
+
+    tasks, source_dim, _ = diff_tasks(cohom, mu, i)
+    total_diff = collect_triplets(tasks, run_tasks(cohom, tasks, modulus))
 
-                for comp_num,weight_comp in module.weight_components[initial_vertex]:
-                    # compute the action of the PBW element
-                    # map is multiplied by sign. Need to convert sign to Rational to avoid errors in newer sage version
-                    basis_action = action_on_basis(maps[a]*Rational(sign),weight_comp,module,factory,comp_num)
+    if len(total_diff)==0: # Trivial differential
+        return SparseDifferential.zero(modulus),source_dim
 
-                    basis_action[:,-2] += comp_offset_s # update source
-                    comp_offset_s += module.dimensions_components[comp_num][initial_vertex]
+    total_diff = sort_merge(total_diff, modulus) # for cokernels we can get duplicate entries. We need to merge them.
 
-                    # If there is a cokernel, we have reduce the image of the action
-                    # to the basis of the quotient module
-                    if cohom.has_coker:
-                        try:
-                            basis_action = coker_reduce(cohom.weight_module,cohom.coker, basis_action,
-                                                        initial_vertex, final_vertex,
-                                                        component=comp_num)
-                        except IndexError as err:
-                            print(final_vertex)
-                            raise err
+    # Entries with the same target are put in the same row. Targets not in the image are skipped.
+    return SparseDifferential.from_triplets(total_diff, modulus), source_dim
 
-                        if len(basis_action)>0:
-                            basis_action[:,0]+=target_col_dic[a[1]] # offset for weight module
-                            action_images.append(basis_action)
+def run_tasks(cohom, tasks, modulus=None):
+    """Computes the images of the tasks of `diff_tasks` as rows `[target, source, coeff]`, reduced
+    to the basis of the cokernel if there is one. The offsets of the tasks are not applied."""
+    # Compute the image of the action as rows [target, source, coeff], where target and source
+    # are indices of the basis of the entire weight component. The kernels release the GIL, so
+    # the tasks can run in a thread pool. Each task then uses a single thread for its kernels.
+    def run_task(task):
+        return task_triplets(cohom, task, modulus)
 
-                    # The cokernel reduction automatically inserts appropriate offsets for indices
-                    # In the non-cokernel case we still have to do this manually
-                    if len(basis_action)>0:
-                        if not cohom.has_coker:
-                            new_basis_action = np.zeros(shape=(basis_action.shape[0],3),dtype=basis_action.dtype)
+    def run_task_single_threaded(task):
+        _thread_state.single_threaded = True
+        try:
+            return run_task(task)
+        finally:
+            _thread_state.single_threaded = False
 
+    # The generator matrix cache of the sparse engine is not thread safe
+    if _num_threads > 1 and len(tasks) > 1 and cohom.action_engine != 'sparse':
+        with ThreadPoolExecutor(max_workers=min(_num_threads, len(tasks))) as executor:
+            task_images = list(executor.map(run_task_single_threaded, tasks))
+    else:
+        task_images = [run_task(task) for task in tasks]
 
+    # If there is a cokernel, we have reduce the images to the basis of the quotient module
+    if cohom.has_coker:
+        for task_num, (_, initial_vertex, final_vertex, _, _, _, _) in enumerate(tasks):
+            if len(task_images[task_num])>0:
+                try:
+                    task_images[task_num] = coker_project(cohom.sparse_coker, task_images[task_num],
+                                                          initial_vertex, final_vertex, modulus)
+                except IndexError as err:
+                    print(final_vertex)
+                    raise err
+    return task_images
 
-                            # Convert the sets of indices [i1,...,ik] into a single index for the whole weight component
-                            # We do this by looking the index i up in a dictionary.
-                            target_basis_dic = module.weight_comp_index_numbers[final_vertex]
-                            num_cols = basis_action.shape[1]-2
-                            for i,row in enumerate(basis_action):
-                                j = target_basis_dic[tuple(list(row[:num_cols])+[comp_num])]
-                                new_basis_action[i][0]=j
-                                new_basis_action[i][1:] = row[num_cols:]
-                            new_basis_action[:,0]+=target_col_dic[a[1]]
+def collect_triplets(tasks, task_images):
+    """Writes the images of the tasks, with the offsets of the tasks applied, into a single
+    array of rows `[target, source, coeff]`."""
+    num_triplets = sum(len(image) for image in task_images)
+    total_diff = np.empty((num_triplets, 3), np.int64)
+    start = 0
+    for task, image in zip(tasks, task_images):
+        if len(image)==0:
+            continue
+        end = start + len(image)
+        total_diff[start:end, 0] = image[:,0] + task[5] # offset for weight module
+        total_diff[start:end, 1] = image[:,1] + task[6]
+        total_diff[start:end, 2] = image[:,2]
+        start = end
+    return total_diff
 
-                            action_images.append(new_basis_action)
+def compute_diff_rank(cohom, mu, i, modulus):
+    """Rank modulo the prime `modulus` of the BGG differential for weight `mu` and degree `i`,
+    computed without storing the differential. Returns the rank and the dimension of the source.
 
-            if len(action_images)>0:
-                # Concatenate images for each arrow to get total image
-                sub_diff = np.concatenate(action_images)
+    The tasks of `diff_tasks` are grouped by the chunk of source basis elements they act on. Once
+    all arrows have acted on a chunk, the corresponding columns of the differential are complete,
+    and they are added as rows to an `EchelonAccumulator`. The memory used is that of the echelon
+    form plus the images of a single chunk. We stop as soon as the rank can't increase any further.
 
-                # Each basis element of weight component gets index
-                # Because we have multiple weight components, we need to add a number to this index
-                # So that index remains unique across multiple components
+    If the source weight component has a cokernel, every basis element of the quotient is a
+    combination of basis elements from all chunks of the component. The columns are then only
+    complete once the whole weight component has been acted on, so its tasks form a single group.
+    """
+    tasks, source_dim, target_dim = diff_tasks(cohom, mu, i)
+    accumulator = EchelonAccumulator(target_dim, modulus, min(source_dim, target_dim))
+    chunks = dict()
+    for task in tasks:
+        _, initial_vertex, _, position, rows, _, source_offset = task
+        if cohom.has_coker and (initial_vertex in cohom.coker):
+            chunks.setdefault((source_offset, None, None), []).append(task)
+        else:
+            chunks.setdefault((source_offset, position, rows), []).append(task)
+    for chunk_tasks in chunks.values():
+        if accumulator.is_full():
+            break
+        triplets = collect_triplets(chunk_tasks, run_tasks(cohom, chunk_tasks, modulus))
+        accumulator.add_rows(triplets[:, [1, 0, 2]]) # columns of the differential
+    return accumulator.rank, source_dim
 
-                sub_diff[:,-2]+=offset
+class DifferentialOperator:
+    """The BGG differential for weight `mu` and degree `i` modulo a prime, as a matrix-free
+    linear operator.
 
-                offset+=module.dimensions[initial_vertex]
-                total_diff.append(sub_diff)
+    The differential is never stored. Instead, products with vectors are computed by running the
+    tasks of `diff_tasks` one at a time, and accumulating their entries into the result. The
+    memory used is therefore that of the vectors plus the images of a single task, which is
+    bounded by `get_diff_memory_budget()`. The price is that every product recomputes the
+    action on the whole source. Unlike `compute_diff`, no rows are omitted: the operator has
+    shape (dimension of target, dimension of source).
 
+    Parameters
+    ----------
+    cohom : BGGCohomology
+    mu : tuple(int)
+    i : int
+    modulus : int
+        Prime smaller than 2**31
 
-    if len(total_diff)>0: # Sometimes action is trivial, would otherwise raise errors
-        total_diff = np.concatenate(total_diff)
-        total_diff = sort_merge(total_diff) # for cokernels we can get duplicate entries. We need to merge them.
-        total_diff = total_diff[np.lexsort(np.transpose(total_diff[:,:-2]))]  # Sort by source indices
+    Attributes
+    ----------
+    shape : tuple(int, int)
+    modulus : int
+    tasks : list(tuple)
+        Tasks of `diff_tasks`
+    """
 
-    if len(total_diff) ==0: # Trivial differential
-        return matrix(ZZ,0,0),source_dim
+    def __init__(self, cohom, mu, i, modulus):
+        self.cohom = cohom
+        self.modulus = modulus
+        self.tasks, source_dim, target_dim = diff_tasks(cohom, mu, i)
+        self.shape = (target_dim, source_dim)
 
-     # encode as sparse matrix. each entry is triple of two indices and the value at the two indices
-    diff_entries = np.zeros((len(total_diff),3),np.int64)
-    j = -1
+    def task_entries(self):
+        """Iterates over the entries of the differential, as arrays of rows `[target, source,
+        coeff]` with coefficients in [0, modulus). Entries can be repeated, and have to be summed."""
+        cohom = self.cohom
+        for task in self.tasks:
+            image = task_triplets(cohom, task, self.modulus)
+            if len(image)==0:
+                continue
+            if cohom.has_coker:
+                _, initial_vertex, final_vertex, _, _, _, _ = task
+                image = coker_project(cohom.sparse_coker, image, initial_vertex, final_vertex, self.modulus)
+                if len(image)==0:
+                    continue
+            image[:,0] += task[5]
+            image[:,1] += task[6]
+            yield image
 
-    # If two entries represent the same element in source column, put them in same row j.
-    # This loop merges this an populates a sparse matrix with correct row numbers.
+    def _apply(self, vector, transpose):
+        vector = np.asarray(vector, np.int64) % self.modulus
+        if transpose:
+            src, dst, result_dim = 0, 1, self.shape[1]
+        else:
+            src, dst, result_dim = 1, 0, self.shape[0]
+        result = np.zeros(result_dim, np.int64)
+        for image in self.task_entries():
+            # both factors are smaller than 2**31, so the products fit in 64 bits
+            np.add.at(result, image[:,dst], (image[:,2]*vector[image[:,src]]) % self.modulus)
+            result %= self.modulus
+        return result
 
-    prev_row = np.zeros_like(total_diff[0,:-2])-1  # every row is different from this one
-    for i in range(len(total_diff)):
-        row_num = i
-        row = total_diff[i,:-2]
-        if np.any(np.not_equal(row,prev_row)): # if row is different, it will have different index
-            j+=1
-            prev_row = row
-        diff_entries[row_num,0] = j # populate sparse matrix
-        diff_entries[row_num,1:] = total_diff[i,-2:]
-    j+=1
+    def matvec(self, vector):
+        """Product of the differential with a vector of length `shape[1]`, modulo the prime."""
+        return self._apply(vector, False)
 
-    # turn sparse differential matrix into dense one.
-    d_dense = matrix(ZZ,j,max(diff_entries[:,1])+1)
-    for i in range(len(diff_entries)):
-        d_dense[diff_entries[i,0],diff_entries[i,1]] = diff_entries[i,2]
+    def rmatvec(self, vector):
+        """Product of the transpose of the differential with a vector of length `shape[0]`,
+        modulo the prime."""
+        return self._apply(vector, True)
 
-    return d_dense, source_dim
+    def rank(self, max_extra_terms=20):
+        """Rank of the differential modulo the prime, see `differential.blackbox_rank`."""
+        return blackbox_rank(self, max_extra_terms=max_extra_terms)
 
 def coker_reduce(target_module, coker, action_image, mu0, mu1, component=0):
     """Projects source and target of an action in the coker quotient coker(f), f:M->N.
@@ -323,68 +1691,503 @@ def coker_reduce(target_module, coker, action_image, mu0, mu1, component=0):
     `component` is the index of the direct sum component
     We assume we acted with a map `mu0`->`mu1` in action_on_basis.
     """
-    # the input is always of shape [i1,i2,..,ik,j,c] where i denotes the indices
-    # of the target, j the source index, and c the coefficient.
-    # then `num_cols` denotes this number k.
-    num_cols = action_image.shape[1]-2
-
     # If mu1 is not in the module, then it has to be zero
     if mu1 not in target_module.weight_components:
-        return []
+        return np.zeros((0,3), np.int64)
 
+    # the input is always of shape [i1,i2,..,ik,j,c] where i denotes the indices
+    # of the target, j the source index, and c the coefficient.
     # Convert the sets of indices [i1,...,ik] into a single index i for the whole weight component
-    # We do this by looking the index i up in a dictionary.
-    target_basis_dic = target_module.weight_comp_index_numbers[mu1]
-    action_image_target = np.zeros((action_image.shape[0],3),dtype=action_image.dtype)
-    for i,row in enumerate(action_image):
-        j = target_basis_dic[tuple(list(row[:num_cols])+[component])]
-        action_image_target[i][0]=j
-        action_image_target[i][1:] = row[num_cols:]
+    action_image_target = basis_to_triplets(target_module, mu1, component, action_image)
+    return coker_project(coker, action_image_target, mu0, mu1)
+
+def matrix_to_csc(coker_matrix):
+    """Converts a Sage integer matrix to a `scipy.sparse.csc_matrix` with int64 entries.
+    Cokernel bases that are already stored sparsely, like `quantum_center.SparseCokernel`,
+    are converted with their own `tocsc` method."""
+    if hasattr(coker_matrix, "tocsc"):
+        return coker_matrix.tocsc()
+    entries = coker_matrix.dict()
+    rows = np.fromiter((ij[0] for ij in entries.keys()), np.int64, len(entries))
+    cols = np.fromiter((ij[1] for ij in entries.keys()), np.int64, len(entries))
+    data = np.fromiter((int(c) for c in entries.values()), np.int64, len(entries))
+    shape = (coker_matrix.nrows(), coker_matrix.ncols())
+    return sparse.csc_matrix((data, (rows, cols)), shape=shape)
+
+class SparseCoker:
+    """Wrapper around a dictionary of cokernel bases, giving access to the bases as sparse matrices.
+
+    Each matrix is converted to CSC format the first time it is needed, so that the entries of a
+    column can be looked up quickly. Acts like the wrapped dictionary otherwise.
+
+    Parameters
+    ----------
+    coker : Dict[tuple(int), matrix or SparseCokernel] or CokerCache
+    """
+
+    def __init__(self, coker):
+        self.coker = coker
+        self._csc = dict()
+
+    def __getitem__(self, mu):
+        return self.coker[mu]
+
+    def __contains__(self, mu):
+        return mu in self.coker
+
+    def keys(self):
+        return self.coker.keys()
+
+    def csc(self, mu):
+        """The basis of the cokernel in weight component `mu` as a `scipy.sparse.csc_matrix`."""
+        if mu not in self._csc:
+            self._csc[mu] = matrix_to_csc(self.coker[mu])
+        return self._csc[mu]
+
+def coker_csc(coker, mu):
+    """The basis of the cokernel in weight component `mu` as a `scipy.sparse.csc_matrix`."""
+    if isinstance(coker, SparseCoker):
+        return coker.csc(mu)
+    return matrix_to_csc(coker[mu])
+
+def column_entries(csc, cols):
+    """Finds the entries of the columns `cols` of a CSC matrix. Returns for every entry the
+    position in `cols` of its column, and its position in `csc.indices` and `csc.data`."""
+    indptr = csc.indptr.astype(np.int64)
+    starts = indptr[cols]
+    counts = indptr[cols+1] - starts
+    which = np.repeat(np.arange(len(cols)), counts)
+    first_entry = np.cumsum(counts) - counts
+    positions = np.arange(len(which)) - first_entry[which] + starts[which]
+    return which, positions
+
+def project_column(triplets, csc, column, modulus=None):
+    """Replaces an index column of rows `[target, source, coeff]` by the indices of the nonzero
+    entries of the corresponding column of `csc`, multiplying the coefficients by these entries.
+    If `modulus` is `None`, raises `OverflowError` if the products may not fit in 64 bits."""
+    which, positions = column_entries(csc, triplets[:,column])
+    projected = triplets[which]
+    projected[:,column] = csc.indices[positions]
+    data = csc.data[positions]
+    if modulus is None:
+        if max_abs(projected[:,2])*max_abs(data) > INT64_MAX:
+            raise OverflowError("Coefficients of the projection to the cokernel don't fit in 64 bits, "
+                                "compute modulo primes instead")
+        projected[:,2] *= data
+    else:
+        # both factors are smaller than 2**31, so the products fit in 64 bits
+        projected[:,2] = ((projected[:,2] % modulus) * (data % modulus)) % modulus
+    return projected
+
+def coker_project(coker, action_image_target, mu0, mu1, modulus=None):
+    """Projects source and target of an action in the coker quotient.
+    The input has rows `[target, source, coeff]` with indices in the basis of the weight
+    components `mu1` and `mu0` respectively. Returns action in the basis of the cokernel.
+    If `modulus` is not `None`, the coefficients are computed modulo `modulus`.
+
+    The basis of a cokernel is a matrix with one row for each basis element of the quotient.
+    An entry `[target, source, coeff]` is replaced by an entry for each nonzero entry in column
+    `source` (resp. `target`) of this matrix. Pass a `SparseCoker` to convert the bases to sparse
+    matrices only once."""
+    empty = np.zeros((0,3), np.int64)
+    action_image = np.asarray(action_image_target, np.int64)
 
     # If mu0 is in the cokernel dictionary, express the action in the basis of the quotient
     # If not, then the basis of the quotient is equal to the basis of the module, so there's nothing to do
     if mu0 in coker:
+        csc = coker_csc(coker, mu0)
         # If target vector space is zero, return empty matrix
-        if coker[mu0].nrows()==0:
-            return np.array([])
-        new_images = np.zeros((action_image.shape[0]*coker[mu0].ncols(),3),dtype=action_image.dtype)
-        current_row = 0
-
-        for action_row in action_image_target:
-            target, source,coeff = action_row
-            for i,c in enumerate(coker[mu0][:,source]):
-                if c!=0:
-                    new_images[current_row] = [target, i, coeff*c]
-                    current_row+=1
-        new_action_image = new_images[:current_row]
-    else:
-        new_action_image = action_image_target
+        if csc.shape[0]==0:
+            return empty
+        action_image = project_column(action_image, csc, 1, modulus)
 
     # If mu1 is in the cokernel dictionary, then reduce the image to the quotient
     # We do this by multiplying by the matrix encoding the basis of the cokernel
     # If it's not in the dictionary, no reduction is necessary.
     if mu1 in coker:
+        csc = coker_csc(coker, mu1)
         # If target vector space is zero, return empty matrix
-        if coker[mu1].nrows()==0:
-            return np.array([])
-        new_image_coker = np.zeros((new_action_image.shape[0]*coker[mu1].ncols(),3),dtype=action_image.dtype)
-        current_row = 0
-
-        for action_row in new_action_image:
-            j = action_row[0]
-            for i,c in enumerate(coker[mu1][:,j]):
-                if c!=0:
-                    new_image_coker[current_row]=action_row
-                    new_image_coker[current_row][0]=i
-                    new_image_coker[current_row][2]*=c
-                    current_row+=1
-    else:
-        new_image_coker = new_action_image
-        current_row = len(new_image_coker)
+        if csc.shape[0]==0:
+            return empty
+        action_image = project_column(action_image, csc, 0, modulus)
 
     # At the end of the day, sort the result and sum coefficients of identical (source, target) tuples.
-    # If the final matrix is empty, instead we just return an empty array to avoid errors.
-    if current_row>0:
-        return sort_merge(new_image_coker[:current_row])
+    if len(action_image)>0:
+        return sort_merge(action_image, modulus)
     else:
-        return np.array([])
\ No newline at end of file
+        return empty
+
+
+cdef inline int64_t inverse_mod(int64_t a, int64_t p) noexcept nogil:
+    """Inverse of `a` modulo the prime `p`, using the extended Euclidean algorithm."""
+    cdef int64_t t = 0, new_t = 1, r = p, new_r = a, q, tmp
+    while new_r != 0:
+        q = r // new_r
+        tmp = t - q*new_t
+        t = new_t
+        new_t = tmp
+        tmp = r - q*new_r
+        r = new_r
+        new_r = tmp
+    if t < 0:
+        t += p
+    return t
+
+cdef inline void heap_push(int64_t* heap, Py_ssize_t* size, int64_t value) noexcept nogil:
+    """Push `value` on a binary min-heap of `size` elements."""
+    cdef Py_ssize_t i = size[0], parent
+    size[0] += 1
+    while i > 0:
+        parent = (i-1) >> 1
+        if heap[parent] <= value:
+            break
+        heap[i] = heap[parent]
+        i = parent
+    heap[i] = value
+
+cdef inline int64_t heap_pop(int64_t* heap, Py_ssize_t* size) noexcept nogil:
+    """Remove and return the smallest element of a non-empty binary min-heap."""
+    cdef int64_t top = heap[0]
+    cdef int64_t last
+    cdef Py_ssize_t i = 0, child
+    size[0] -= 1
+    last = heap[size[0]]
+    while True:
+        child = 2*i+1
+        if child >= size[0]:
+            break
+        if child+1 < size[0] and heap[child+1] < heap[child]:
+            child += 1
+        if heap[child] >= last:
+            break
+        heap[i] = heap[child]
+        i = child
+    heap[i] = last
+    return top
+
+cdef inline int64_t* reserve(int64_t* array, Py_ssize_t* capacity, Py_ssize_t size) noexcept nogil:
+    """Grow `array` to hold at least `size` elements. Returns NULL if out of memory, in which case
+    `array` is still valid."""
+    cdef Py_ssize_t new_capacity
+    cdef int64_t* new_array
+    if size <= capacity[0]:
+        return array
+    new_capacity = 2*capacity[0]
+    if new_capacity < size:
+        new_capacity = size
+    new_array = <int64_t*> realloc(array, new_capacity*sizeof(int64_t))
+    if new_array != NULL:
+        capacity[0] = new_capacity
+    return new_array
+
+cdef struct Echelon:
+    # Row echelon form modulo a prime, stored sparsely with one pivot row for each pivot column.
+    # The pivot row of column c has leading coefficient 1, and its other entries are stored at
+    # positions pivot_start[c] to pivot_start[c]+pivot_len[c] of pivot_cols and pivot_vals.
+    Py_ssize_t num_cols
+    Py_ssize_t rank
+    Py_ssize_t num_stored
+    Py_ssize_t heap_capacity
+    Py_ssize_t cols_capacity
+    Py_ssize_t vals_capacity
+    int64_t* work # dense copy of current row
+    int64_t* remaining # columns without a pivot
+    int64_t* pivot_start # -1 if not a pivot column
+    int64_t* pivot_len
+    int64_t* heap
+    int64_t* pivot_cols
+    int64_t* pivot_vals
+
+cdef int echelon_init(Echelon* e, Py_ssize_t num_cols) noexcept nogil:
+    """Allocates an empty echelon form for rows with `num_cols` columns.
+    Returns -1 if out of memory, in which case `echelon_free` still has to be called."""
+    cdef Py_ssize_t k
+    e.num_cols = num_cols
+    e.rank = 0
+    e.num_stored = 0
+    e.heap_capacity = num_cols+1
+    e.cols_capacity = num_cols+1
+    e.vals_capacity = num_cols+1
+    e.work = <int64_t*> malloc((num_cols+1)*sizeof(int64_t))
+    e.remaining = <int64_t*> malloc((num_cols+1)*sizeof(int64_t))
+    e.pivot_start = <int64_t*> malloc((num_cols+1)*sizeof(int64_t))
+    e.pivot_len = <int64_t*> malloc((num_cols+1)*sizeof(int64_t))
+    e.heap = <int64_t*> malloc(e.heap_capacity*sizeof(int64_t))
+    e.pivot_cols = <int64_t*> malloc(e.cols_capacity*sizeof(int64_t))
+    e.pivot_vals = <int64_t*> malloc(e.vals_capacity*sizeof(int64_t))
+    if (e.work == NULL or e.remaining == NULL or e.pivot_start == NULL or e.pivot_len == NULL
+            or e.heap == NULL or e.pivot_cols == NULL or e.pivot_vals == NULL):
+        return -1
+    for k in range(num_cols):
+        e.work[k] = 0
+        e.pivot_start[k] = -1
+    return 0
+
+cdef void echelon_free(Echelon* e) noexcept nogil:
+    free(e.work)
+    free(e.remaining)
+    free(e.pivot_start)
+    free(e.pivot_len)
+    free(e.heap)
+    free(e.pivot_cols)
+    free(e.pivot_vals)
+    e.work = e.remaining = e.pivot_start = e.pivot_len = NULL
+    e.heap = e.pivot_cols = e.pivot_vals = NULL
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int echelon_add_row(Echelon* e, int64_t[:] cols, int64_t[:] vals, Py_ssize_t start,
+                         Py_ssize_t end, int64_t p) noexcept nogil:
+    """Adds the row with entries `vals[k]` in columns `cols[k]` for `k` from `start` to `end` to the
+    echelon form. The columns must be distinct, and the values lie in [0, p).
+
+    The row is reduced by visiting its non-zero columns in increasing order using a heap, so that
+    the fill-in is only ever in columns that have not been visited yet. If anything is left, it
+    becomes a new pivot row. Returns 1 if the rank increased, 0 if not, and -1 if out of memory."""
+    cdef Py_ssize_t k, pivot, lead, heap_size = 0, num_remaining = 0
+    cdef int64_t c, c2, v, t, inv, last = -1
+    cdef int64_t* work = e.work
+    cdef int64_t* new_array
+    for k in range(start, end):
+        c = cols[k]
+        work[c] = vals[k]
+        heap_push(e.heap, &heap_size, c)
+
+    # Reduce the row by the pivot rows, in order of increasing column
+    while heap_size > 0:
+        c = heap_pop(e.heap, &heap_size)
+        if c == last: # a column can be pushed more than once
+            continue
+        last = c
+        v = work[c]
+        if v == 0:
+            continue
+        pivot = e.pivot_start[c]
+        if pivot < 0:
+            e.remaining[num_remaining] = c
+            num_remaining += 1
+            continue
+        new_array = reserve(e.heap, &e.heap_capacity, heap_size+e.pivot_len[c])
+        if new_array == NULL:
+            return -1
+        e.heap = new_array
+        for k in range(pivot, pivot+e.pivot_len[c]):
+            c2 = e.pivot_cols[k]
+            if work[c2] == 0:
+                heap_push(e.heap, &heap_size, c2)
+            t = work[c2] - (v*e.pivot_vals[k]) % p
+            if t < 0:
+                t += p
+            work[c2] = t
+        work[c] = 0
+    if num_remaining == 0:
+        return 0
+
+    # Store what is left as a new pivot row with leading coefficient 1
+    lead = e.remaining[0]
+    inv = inverse_mod(work[lead], p)
+    work[lead] = 0
+    new_array = reserve(e.pivot_cols, &e.cols_capacity, e.num_stored+num_remaining)
+    if new_array == NULL:
+        return -1
+    e.pivot_cols = new_array
+    new_array = reserve(e.pivot_vals, &e.vals_capacity, e.num_stored+num_remaining)
+    if new_array == NULL:
+        return -1
+    e.pivot_vals = new_array
+    e.pivot_start[lead] = e.num_stored
+    e.pivot_len[lead] = num_remaining-1
+    for k in range(1, num_remaining):
+        c = e.remaining[k]
+        e.pivot_cols[e.num_stored] = c
+        e.pivot_vals[e.num_stored] = (work[c]*inv) % p
+        e.num_stored += 1
+        work[c] = 0
+    e.rank += 1
+    return 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t sparse_rank_mod_p(int64_t[:] indptr, int64_t[:] indices, int64_t[:,:] data,
+                                  Py_ssize_t prime_num, Py_ssize_t row_start, Py_ssize_t row_end,
+                                  Py_ssize_t num_cols, int64_t p) noexcept nogil:
+    """Rank modulo `p` of rows `row_start` to `row_end` of the CSR matrix with values
+    `data[prime_num]`, which lie in [0, p). The column indices of these rows are less than `num_cols`.
+
+    Rows are added one at a time to a row echelon form, see `echelon_add_row`.
+    Returns -1 if out of memory."""
+    cdef Echelon e
+    cdef Py_ssize_t row
+    cdef Py_ssize_t rank
+    if echelon_init(&e, num_cols) < 0:
+        echelon_free(&e)
+        return -1
+    for row in range(row_start, row_end):
+        if e.rank == num_cols: # rank can't increase any further
+            break
+        if echelon_add_row(&e, indices, data[prime_num], indptr[row], indptr[row+1], p) < 0:
+            e.rank = -1
+            break
+    rank = e.rank
+    echelon_free(&e)
+    return rank
+
+cdef class EchelonAccumulator:
+    """Rank modulo a prime of a matrix whose rows are added a few at a time.
+
+    The rows are reduced as they are added, and only the sparse row echelon form is kept, so the
+    whole matrix never has to be stored. See `echelon_add_row`.
+
+    Parameters
+    ----------
+    num_cols : int
+        Number of columns of the matrix
+    modulus : int
+        Prime smaller than 2**31
+    max_rank : int or `None` (default: None)
+        Rank after which further rows are ignored, typically the smaller dimension of the
+        matrix. If `None`, use `num_cols`.
+
+    Attributes
+    ----------
+    num_cols : int
+    modulus : int
+    max_rank : int
+    rank : int
+        The rank of the rows added so far
+    """
+    cdef Echelon echelon
+    cdef readonly Py_ssize_t num_cols
+    cdef readonly int64_t modulus
+    cdef readonly Py_ssize_t max_rank
+
+    def __cinit__(self, num_cols, modulus, max_rank=None):
+        self.num_cols = num_cols
+        self.modulus = modulus
+        self.max_rank = num_cols if max_rank is None else min(max_rank, num_cols)
+        if echelon_init(&self.echelon, num_cols) < 0:
+            raise MemoryError("Out of memory while allocating echelon form")
+
+    def __dealloc__(self):
+        echelon_free(&self.echelon)
+
+    @property
+    def rank(self):
+        return self.echelon.rank
+
+    def is_full(self):
+        """Whether the rank has reached `max_rank`, so that more rows can't change it."""
+        return self.echelon.rank >= self.max_rank
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def add_rows(self, triplets):
+        """Adds the rows of a matrix given as rows `[row, col, value]`, and returns the rank.
+        Entries with the same row and column are summed. Rows are added in increasing order of
+        their index, until the rank reaches `max_rank`."""
+        if len(triplets) == 0 or self.is_full():
+            return self.echelon.rank
+        triplets = np.asarray(triplets, np.int64)
+        if triplets[:,1].min() < 0 or triplets[:,1].max() >= self.num_cols:
+            raise ValueError("Column index out of range")
+        triplets = triplets.copy()
+        triplets[:,2] %= self.modulus
+        triplets = sort_merge(triplets, self.modulus)
+        triplets = triplets[np.argsort(triplets[:,0], kind='stable')]
+        bounds = np.flatnonzero(np.diff(triplets[:,0])) + 1
+        cdef int64_t[:] row_bounds = np.concatenate([[0], bounds, [len(triplets)]]).astype(np.int64)
+        cdef int64_t[:] cols = np.ascontiguousarray(triplets[:,1])
+        cdef int64_t[:] vals = np.ascontiguousarray(triplets[:,2])
+        cdef Py_ssize_t row
+        cdef int status = 0
+        with nogil:
+            for row in range(row_bounds.shape[0]-1):
+                if self.echelon.rank >= self.max_rank:
+                    break
+                status = echelon_add_row(&self.echelon, cols, vals, row_bounds[row],
+                                         row_bounds[row+1], self.modulus)
+                if status < 0:
+                    break
+        if status < 0:
+            raise MemoryError("Out of memory while computing rank modulo p")
+        return self.echelon.rank
+
+def block_ranks_mod_primes(indptr, indices, data, block_rows, block_cols, primes):
+    """Computes the ranks of several integer matrices modulo each of the given primes.
+
+    The matrices are stacked in a single CSR matrix, with rows `block_rows[b]` to `block_rows[b+1]`
+    forming the matrix `b`, which has `block_cols[b]` columns. Column indices are local to each
+    matrix. The primes should be smaller than 2**31, so that all products fit in 64 bits.
+    All pairs of a matrix and a prime are processed in parallel, largest matrices first.
+    Returns an array of shape (number of matrices, number of primes)."""
+    primes = np.asarray(primes, np.int64)
+    block_rows = np.asarray(block_rows, np.int64)
+    cdef int64_t[:] prime_view = primes
+    cdef int64_t[:] indptr_view = np.asarray(indptr, np.int64)
+    cdef int64_t[:] indices_view = np.asarray(indices, np.int64)
+    cdef int64_t[:,:] data_view = np.mod(np.asarray(data, np.int64)[None,:], primes[:,None])
+    cdef int64_t[:] rows_view = block_rows
+    cdef int64_t[:] cols_view = np.asarray(block_cols, np.int64)
+    cdef Py_ssize_t num_primes = len(primes)
+    cdef Py_ssize_t num_blocks = len(block_rows)-1
+    cdef int64_t[:,:] ranks = np.zeros((num_blocks, num_primes), np.int64)
+
+    # Blocks with most entries first, for load balancing
+    block_nnz = np.asarray(indptr)[block_rows[1:]] - np.asarray(indptr)[block_rows[:-1]]
+    cdef int64_t[:] block_order = np.argsort(-block_nnz, kind='stable').astype(np.int64)
+    cdef Py_ssize_t task, block, prime_num
+    cdef int num_threads = min(num_blocks*num_primes, _num_threads)
+    for task in prange(num_blocks*num_primes, num_threads=num_threads, schedule='dynamic', nogil=True):
+        block = block_order[task // num_primes]
+        prime_num = task % num_primes
+        ranks[block, prime_num] = sparse_rank_mod_p(indptr_view, indices_view, data_view, prime_num,
+                                                    rows_view[block], rows_view[block+1],
+                                                    cols_view[block], prime_view[prime_num])
+    if np.any(np.asarray(ranks) < 0):
+        raise MemoryError("Out of memory while computing rank modulo p")
+    return np.asarray(ranks)
+
+def rank_mod_primes(indptr, indices, data, num_cols, primes):
+    """Computes the rank of an integer matrix in CSR format modulo each of the given primes.
+    Returns an array with the rank for each prime, see `block_ranks_mod_primes`."""
+    return block_ranks_mod_primes(indptr, indices, data, [0, len(indptr)-1], [num_cols], primes)[0]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int64_t find_root(int64_t[:] parent, int64_t node) noexcept nogil:
+    """Root of `node` in a union-find forest, halving the path on the way."""
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void union_entries(int64_t[:] parent, int64_t[:] rows, int64_t[:] cols,
+                        int64_t num_rows) noexcept nogil:
+    """Merge the sets of the row and the column of each entry. Column `c` is node `num_rows+c`."""
+    cdef Py_ssize_t k
+    cdef int64_t a, b
+    for k in range(rows.shape[0]):
+        a = find_root(parent, rows[k])
+        b = find_root(parent, num_rows+cols[k])
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+
+def block_labels(rows, cols, num_rows, num_cols):
+    """Finds the connected components of the bipartite graph with an edge between row `rows[k]` and
+    column `cols[k]` for every `k`, using union-find.
+
+    Returns arrays with a label for each row and each column. Labels are numbered from 0, and
+    rows or columns without entries get their own label."""
+    parent = np.arange(num_rows+num_cols, dtype=np.int64)
+    cdef int64_t[:] parent_view = parent
+    cdef Py_ssize_t node
+    union_entries(parent_view, np.asarray(rows, np.int64), np.asarray(cols, np.int64), num_rows)
+    for node in range(num_rows+num_cols):
+        parent_view[node] = find_root(parent_view, node)
+    _, labels = np.unique(parent, return_inverse=True)
+    labels = labels.reshape(-1)
+    return labels[:num_rows], labels[num_rows:]
@@ -0,0 +1,622 @@
+"""
+Sparse integer matrices for the differentials of the BGG complex.
+
+The differentials computed by `cohomology.compute_diff` are very sparse. They are stored as
+arrays of row indices, column indices and values (COO format), and are only converted to a
+dense matrix when they are small enough. Only the rank of the differentials is needed to compute
+cohomology. For large matrices this is computed modulo several random primes, since the rank
+over the rationals is the maximum of the ranks modulo primes. Differentials can also be computed
+directly modulo a prime, in which case they are matrices over a finite field.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+
+from sage.arith.misc import random_prime
+from sage.matrix.constructor import matrix
+from sage.rings.finite_rings.finite_field_constructor import GF
+from sage.rings.integer_ring import ZZ
+
+# Matrices with at most this many entries (including zeros) are converted to dense matrices
+# to compute their rank.
+DENSE_MAX_ENTRIES = 10 ** 6
+
+# Primes used for modular rank computations lie between these bounds
+PRIME_LOWER_BOUND = 2 ** 29
+PRIME_UPPER_BOUND = 2 ** 30
+
+# Smallest prime accepted by `blackbox_rank`. Over small fields the random preconditioners are
+# far from generic, and the rank found is often too small.
+BLACKBOX_MIN_PRIME = 2 ** 20
+
+RANK_METHODS = ("auto", "exact", "modular")
+
+
+class SparseDifferential:
+    """Sparse integer matrix in COO format.
+
+    Parameters
+    ----------
+    rows : array(int)
+        Row index of each non-zero entry
+    cols : array(int)
+        Column index of each non-zero entry
+    data : array(int)
+        Value of each non-zero entry
+    shape : tuple(int, int)
+        Number of rows and columns of the matrix
+    modulus : int or `None` (default: None)
+        If not `None`, a prime such that the matrix has entries in GF(modulus). The values
+        are then in [0, modulus).
+
+    Attributes
+    ----------
+    rows : array(int)
+    cols : array(int)
+    data : array(int)
+    shape : tuple(int, int)
+    modulus : int or `None`
+    """
+
+    def __init__(self, rows, cols, data, shape, modulus=None):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.int64)
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.modulus = None if modulus is None else int(modulus)
+
+    @classmethod
+    def from_triplets(cls, triplets, modulus=None):
+        """Build a matrix from rows `[row, col, value]`, removing all rows of zeros.
+
+        Every row index is replaced by its position among the distinct row indices, so that the
+        resulting matrix has no zero rows. The number of columns is one more than the largest
+        column index. Entries with the same row and column index must already be merged.
+        """
+        if len(triplets) == 0:
+            return cls.zero(modulus)
+        _, rows = np.unique(triplets[:, 0], return_inverse=True)
+        shape = (rows.max() + 1, triplets[:, 1].max() + 1)
+        return cls(rows.reshape(-1), triplets[:, 1], triplets[:, 2], shape, modulus)
+
+    @classmethod
+    def zero(cls, modulus=None):
+        """The matrix of shape (0, 0)."""
+        empty = np.zeros(0, np.int64)
+        return cls(empty, empty, empty, (0, 0), modulus)
+
+    def nrows(self):
+        """Number of rows."""
+        return self.shape[0]
+
+    def ncols(self):
+        """Number of columns."""
+        return self.shape[1]
+
+    @property
+    def nnz(self):
+        """Number of stored entries."""
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of entries."""
+        return self.rows.nbytes + self.cols.nbytes + self.data.nbytes
+
+    def tocoo(self):
+        """Convert to a `scipy.sparse.coo_matrix`."""
+        return sparse.coo_matrix((self.data, (self.rows, self.cols)), shape=self.shape)
+
+    def tocsr(self):
+        """Convert to a `scipy.sparse.csr_matrix`."""
+        return self.tocoo().tocsr()
+
+    def to_numpy(self):
+        """Convert to a dense numpy array."""
+        dense = np.zeros(self.shape, np.int64)
+        dense[self.rows, self.cols] = self.data
+        return dense
+
+    def to_sage(self, sparse=None):
+        """Convert to a Sage matrix over ZZ, or over GF(modulus) if the modulus is set.
+
+        Parameters
+        ----------
+        sparse : bool or `None` (default: None)
+            Whether to return a sparse matrix. If `None`, a sparse matrix is returned if the
+            matrix has more than `DENSE_MAX_ENTRIES` entries.
+        """
+        ring = ZZ if self.modulus is None else GF(self.modulus)
+        if sparse is None:
+            sparse = self.shape[0] * self.shape[1] > DENSE_MAX_ENTRIES
+        if sparse:
+            entries = dict(
+                zip(zip(self.rows.tolist(), self.cols.tolist()), self.data.tolist())
+            )
+            return matrix(ring, self.shape[0], self.shape[1], entries, sparse=True)
+        return matrix(ring, self.shape[0], self.shape[1], self.to_numpy().ravel().tolist())
+
+    def blocks(self):
+        """Split the matrix into blocks with disjoint rows and columns.
+
+        Two entries are in the same block if they are connected by a path of entries, where
+        consecutive entries share a row or a column. The rank of the matrix is the sum of the
+        ranks of the blocks. Rows and columns without entries are dropped.
+
+        Returns
+        -------
+        list(SparseDifferential)
+        """
+        from . import cohomology  # cohomology imports this module
+
+        if self.nnz == 0:
+            return []
+        row_labels, col_labels = cohomology.block_labels(
+            self.rows, self.cols, self.shape[0], self.shape[1]
+        )
+
+        # Rows and columns without entries form blocks of their own, which we drop.
+        # They are put in an extra block numbered `num_blocks`.
+        used = np.zeros(self.shape[0] + self.shape[1], bool)
+        used[self.rows] = True
+        used[self.shape[0] + self.cols] = True
+        labels = np.concatenate([row_labels, col_labels])
+        _, labels[used] = np.unique(labels[used], return_inverse=True)
+        num_blocks = labels[used].max() + 1
+        labels[~used] = num_blocks
+        row_labels, col_labels = labels[: self.shape[0]], labels[self.shape[0] :]
+
+        # Number rows and columns consecutively within each block
+        local_rows, block_num_rows = _number_within_blocks(row_labels, num_blocks + 1)
+        local_cols, block_num_cols = _number_within_blocks(col_labels, num_blocks + 1)
+
+        entry_labels = row_labels[self.rows]
+        order = np.argsort(entry_labels, kind="stable")
+        bounds = np.searchsorted(entry_labels[order], np.arange(num_blocks + 1))
+        rows = local_rows[self.rows[order]]
+        cols = local_cols[self.cols[order]]
+        data = self.data[order]
+        return [
+            SparseDifferential(
+                rows[start:end],
+                cols[start:end],
+                data[start:end],
+                (block_num_rows[b], block_num_cols[b]),
+                self.modulus,
+            )
+            for b, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ]
+
+    def rank(self, method="auto", num_primes=3, certify=False, split_blocks=True):
+        """Rank of the matrix over the rationals.
+
+        If the modulus is set, this is instead the rank over GF(modulus), which is always
+        computed by sparse elimination modulo the prime. The other parameters except
+        `split_blocks` are then ignored.
+
+        Parameters
+        ----------
+        method : str (default: "auto")
+            One of the following:
+
+            - "exact": Compute the rank with Sage. Small matrices are converted to dense matrices,
+              larger ones to sparse matrices.
+            - "modular": Compute the rank modulo random primes, see `modular_ranks`.
+            - "auto": Use "exact" for matrices with at most `DENSE_MAX_ENTRIES` entries and
+              "modular" otherwise.
+        num_primes : int (default: 3)
+            Number of primes used by the modular method
+        certify : bool (default: False)
+            Whether the modular method should certify the result
+        split_blocks : bool (default: True)
+            If `True`, split the matrix into independent blocks (see `blocks`), and add the ranks
+            of the blocks. The method is chosen for each block separately, and the blocks using
+            the modular method are processed in parallel.
+        """
+        if method not in RANK_METHODS:
+            raise ValueError("Unknown rank method '%s'" % method)
+        if self.nnz == 0:
+            return 0
+        if split_blocks:
+            blocks = self.blocks()
+        else:
+            blocks = [self]
+        if self.modulus is not None:
+            csr_blocks = [_elimination_csr(block) for block in blocks]
+            return int(_ranks_mod_primes(csr_blocks, [self.modulus]).sum())
+
+        exact_blocks = []
+        modular_blocks = []
+        for block in blocks:
+            if method == "exact" or (
+                method == "auto" and block.shape[0] * block.shape[1] <= DENSE_MAX_ENTRIES
+            ):
+                exact_blocks.append(block)
+            else:
+                modular_blocks.append(block)
+
+        rank = sum(block.to_sage().rank() for block in exact_blocks)
+        if len(modular_blocks) > 0:
+            rank += sum(modular_ranks(modular_blocks, num_primes, certify))
+        return rank
+
+    def hadamard_bits(self):
+        """Upper bound for log2 of the absolute value of any minor of the matrix.
+
+        Any minor is bounded by the product of the Euclidean norms of its rows, and hence by the
+        product of the largest `min(shape)` row norms of the matrix."""
+        squared_norms = np.bincount(
+            self.rows, weights=self.data.astype(np.float64) ** 2, minlength=self.shape[0]
+        )
+        squared_norms = np.sort(squared_norms[squared_norms > 0])[::-1]
+        return 0.5 * np.sum(np.log2(squared_norms[: min(self.shape)]))
+
+    def modular_rank(self, num_primes=3, certify=False):
+        """Rank over the rationals computed by elimination modulo random primes.
+        See `modular_ranks`."""
+        return modular_ranks([self], num_primes, certify)[0]
+
+    def __repr__(self):
+        description = "SparseDifferential of shape %s with %d non-zero entries" % (
+            self.shape,
+            self.nnz,
+        )
+        if self.modulus is not None:
+            description += " modulo %d" % self.modulus
+        return description
+
+
+class DifferentialCache:
+    """Cache of differentials and their ranks.
+
+    Keys are typically tuples `(module fingerprint, cokernel fingerprint, mu, i)`, see
+    `BGGCohomology.differential`. Differentials are kept in memory until their total size exceeds
+    `max_bytes`, after which the least recently used differentials are evicted. If `spill_dir`
+    is given, evicted differentials are written to disk and read back when needed. Ranks are
+    small, and are never evicted. With `max_bytes=0` and no `spill_dir`, only ranks are kept.
+
+    Parameters
+    ----------
+    max_bytes : int (default: 2**30)
+        Maximum total size of the differentials kept in memory
+    spill_dir : str or `None` (default: None)
+        Directory to write evicted differentials to. If `None`, evicted differentials are
+        discarded.
+
+    Attributes
+    ----------
+    max_bytes : int
+    spill_dir : str or `None`
+    nbytes : int
+        Total size of the differentials in memory
+    """
+
+    def __init__(self, max_bytes=2 ** 30, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.nbytes = 0
+        self._diffs = OrderedDict()
+        self._spilled = set()
+        self._ranks = dict()
+
+    def _spill_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, digest + ".npz")
+
+    def get_diff(self, key):
+        """Return the pair `(differential, source dimension)` stored for `key`, or `None`."""
+        if key in self._diffs:
+            self._diffs.move_to_end(key)
+            return self._diffs[key]
+        if key in self._spilled:
+            with np.load(self._spill_path(key)) as arrays:
+                modulus = int(arrays["modulus"])
+                diff = SparseDifferential(
+                    arrays["rows"],
+                    arrays["cols"],
+                    arrays["data"],
+                    arrays["shape"],
+                    modulus if modulus > 0 else None,
+                )
+                source_dim = int(arrays["source_dim"])
+            self.store_diff(key, diff, source_dim)
+            return diff, source_dim
+        return None
+
+    def store_diff(self, key, diff, source_dim):
+        """Store a differential together with the dimension of its source."""
+        if key in self._diffs:
+            return
+        if self.max_bytes <= 0 and self.spill_dir is None:
+            return
+        self._diffs[key] = (diff, source_dim)
+        self.nbytes += diff.nbytes
+        while self.nbytes > self.max_bytes and len(self._diffs) > 0:
+            evicted_key, (evicted, evicted_dim) = self._diffs.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            if self.spill_dir is not None and evicted_key not in self._spilled:
+                np.savez(
+                    self._spill_path(evicted_key),
+                    rows=evicted.rows,
+                    cols=evicted.cols,
+                    data=evicted.data,
+                    shape=np.array(evicted.shape),
+                    modulus=evicted.modulus or 0,
+                    source_dim=evicted_dim,
+                )
+                self._spilled.add(evicted_key)
+
+    def get_rank(self, key):
+        """Return the pair `(rank, source dimension)` stored for `key`, or `None`."""
+        return self._ranks.get(key)
+
+    def store_rank(self, key, rank, source_dim):
+        """Store the rank of a differential together with the dimension of its source."""
+        self._ranks[key] = (rank, source_dim)
+
+    def clear(self):
+        """Remove everything from the cache, including differentials spilled to disk."""
+        if self.spill_dir is not None:
+            for key in self._spilled:
+                path = self._spill_path(key)
+                if os.path.exists(path):
+                    os.remove(path)
+        self._diffs.clear()
+        self._spilled.clear()
+        self._ranks.clear()
+        self.nbytes = 0
+
+
+# Cache shared by all BGGCohomology instances, unless they are given their own. It only keeps
+# ranks, since keeping differentials around for the lifetime of the process costs a lot of
+# memory and they are rarely reused.
+default_cache = DifferentialCache(max_bytes=0)
+
+
+def _number_within_blocks(labels, num_blocks):
+    """Number the elements with the same label consecutively.
+
+    Returns the number of each element within its block, and the size of each block."""
+    order = np.argsort(labels, kind="stable")
+    block_sizes = np.bincount(labels, minlength=num_blocks)
+    block_starts = np.cumsum(block_sizes) - block_sizes
+    numbers = np.empty(len(labels), np.int64)
+    numbers[order] = np.arange(len(labels)) - block_starts[labels[order]]
+    return numbers, block_sizes
+
+
+def random_primes(num_primes, exclude=()):
+    """Distinct random primes between `PRIME_LOWER_BOUND` and `PRIME_UPPER_BOUND`.
+
+    Parameters
+    ----------
+    num_primes : int
+    exclude : iterable(int) (default: ())
+        Primes that should not be returned
+
+    Returns
+    -------
+    list(int)
+    """
+    exclude = set(exclude)
+    primes = []
+    while len(primes) < num_primes:
+        p = int(random_prime(PRIME_UPPER_BOUND, lbound=PRIME_LOWER_BOUND))
+        if p not in exclude:
+            exclude.add(p)
+            primes.append(p)
+    return primes
+
+
+def _elimination_csr(diff):
+    """CSR matrix of `diff` with rows sorted by number of entries, so that rows with few entries
+    are eliminated first to reduce fill-in."""
+    csr = diff.tocsr()
+    csr = csr[np.argsort(np.diff(csr.indptr), kind="stable")]
+    csr.sort_indices()
+    return csr
+
+
+def _ranks_mod_primes(csr_blocks, primes):
+    """Ranks of CSR matrices modulo each of the primes, as an array of shape
+    (number of matrices, number of primes). See `cohomology.block_ranks_mod_primes`."""
+    from . import cohomology  # cohomology imports this module
+
+    if len(csr_blocks) == 0:
+        return np.zeros((0, len(primes)), np.int64)
+
+    # The matrices have different numbers of columns, so we stack the CSR arrays ourselves
+    nnz_offsets = np.cumsum([0] + [csr.nnz for csr in csr_blocks])
+    indptr = np.concatenate(
+        [[0]] + [csr.indptr[1:] + offset for csr, offset in zip(csr_blocks, nnz_offsets)]
+    )
+    indices = np.concatenate([csr.indices for csr in csr_blocks])
+    data = np.concatenate([csr.data for csr in csr_blocks])
+    block_rows = np.cumsum([0] + [csr.shape[0] for csr in csr_blocks])
+    block_cols = [csr.shape[1] for csr in csr_blocks]
+    return cohomology.block_ranks_mod_primes(
+        indptr, indices, data, block_rows, block_cols, primes
+    )
+
+
+def modular_ranks(diffs, num_primes=3, certify=False):
+    """Ranks over the rationals of several matrices, computed by elimination modulo random primes.
+
+    The rank modulo a prime is never larger than the rank over the rationals, and it is
+    smaller only if the prime divides all the non-zero minors of maximal size. The maximum of
+    the ranks modulo `num_primes` random 30-bit primes is therefore the rank over the
+    rationals with very high probability. All pairs of a matrix and a prime are processed
+    in parallel.
+
+    Parameters
+    ----------
+    diffs : list(SparseDifferential)
+    num_primes : int (default: 3)
+        Number of random primes to use
+    certify : bool (default: False)
+        If `True`, keep adding primes until their product exceeds the Hadamard bound
+        of each matrix. If the rank over the rationals were larger than the maximum rank
+        found, then all these primes would divide a non-zero minor bounded by the
+        Hadamard bound, which is impossible. The result is then provably correct.
+
+    Returns
+    -------
+    list(int)
+    """
+    if num_primes < 1:
+        raise ValueError("Number of primes must be positive, got %d" % num_primes)
+
+    csr_blocks = [_elimination_csr(diff) for diff in diffs]
+
+    ranks = np.zeros(len(diffs), np.int64)
+    max_ranks = np.array([min(diff.shape) for diff in diffs], np.int64)
+    if certify:
+        bound_bits = np.array([diff.hadamard_bits() for diff in diffs])
+    else:
+        bound_bits = np.zeros(len(diffs))
+    used_primes = set()
+    prime_bits = 0
+    pending = [b for b, diff in enumerate(diffs) if diff.nnz > 0]
+    while len(pending) > 0:
+        primes = random_primes(num_primes, exclude=used_primes)
+        used_primes.update(primes)
+        block_ranks = _ranks_mod_primes([csr_blocks[b] for b in pending], primes)
+        ranks[pending] = np.maximum(ranks[pending], np.max(block_ranks, axis=1))
+
+        # Matrices of full rank, or for which the primes exceed the Hadamard bound, are done
+        prime_bits += sum(np.log2(p) for p in primes)
+        pending = [
+            b for b in pending if ranks[b] < max_ranks[b] and prime_bits <= bound_bits[b]
+        ]
+    return [int(r) for r in ranks]
+
+
+def _berlekamp_massey_step(state, sequence, p):
+    """Process the last term of `sequence` in the Berlekamp-Massey algorithm modulo `p`.
+
+    `state` is a list `[C, B, L, m, b]`, where `C` is the current connection polynomial of
+    degree at most `L`, as an array of coefficients starting with the constant term."""
+    C, B, L, m, b = state
+    k = len(sequence) - 1
+    window = sequence[k - L : k + 1][::-1]
+    n = min(len(C), L + 1)
+    discrepancy = int(np.sum(C[:n] * window[:n] % p) % p)
+    if discrepancy == 0:
+        state[3] = m + 1
+        return
+    coeff = discrepancy * pow(b, p - 2, p) % p
+    new_C = np.zeros(max(len(C), len(B) + m), np.int64)
+    new_C[: len(C)] = C
+    new_C[m : m + len(B)] = (new_C[m : m + len(B)] - coeff * B) % p
+    if 2 * L <= k:
+        state[:] = [new_C, C, k + 1 - L, 1, discrepancy]
+    else:
+        state[0] = new_C
+        state[3] = m + 1
+
+
+def blackbox_rank(operator, max_extra_terms=20, seed=None, num_trials=2):
+    """Rank modulo a prime of a matrix-free linear operator, using Wiedemann's algorithm.
+
+    For a matrix `A` with rank `r` and random diagonal matrices `D1` and `D2`, the square matrix
+    `B = D1 A^T D2 A D1` (or `D2 A D1 A^T D2` if `A` has fewer rows than columns) has rank `r`,
+    and its minimal polynomial is `x^e f(x)` with `deg f = r` and `e <= 1`, with high probability.
+    The minimal polynomial is found with the Berlekamp-Massey algorithm from the sequence
+    `u^T B^k v` for random vectors `u` and `v`. Only a few vectors are stored, so the memory used
+    is proportional to the size of the matrix rather than its number of entries.
+
+    The result of a single run is never larger than the rank, and is equal to it with high
+    probability if the prime is large. The sequence is extended until the linear complexity has
+    not changed for `max_extra_terms` terms, so roughly `2*r + max_extra_terms` products with `B`
+    are needed. The algorithm is run `num_trials` times with independent random choices, and
+    the largest result is returned. Primes smaller than `BLACKBOX_MIN_PRIME` are refused.
+
+    Parameters
+    ----------
+    operator : object
+        Has attributes `shape` and `modulus`, and methods `matvec` and `rmatvec` computing
+        products of the matrix and its transpose with vectors modulo `modulus`, for example a
+        `cohomology.DifferentialOperator`.
+    max_extra_terms : int (default: 20)
+        Number of terms without change in linear complexity after which to stop early
+    seed : int or `None` (default: None)
+        Seed for the random vectors and preconditioners
+    num_trials : int (default: 2)
+        Number of independent runs. We stop early if a run finds the largest possible rank.
+
+    Returns
+    -------
+    int
+    """
+    p = operator.modulus
+    if p < BLACKBOX_MIN_PRIME:
+        raise ValueError(
+            "Matrix-free ranks need a prime of at least %d, got %d" % (BLACKBOX_MIN_PRIME, p)
+        )
+    num_rows, num_cols = operator.shape
+    if num_rows == 0 or num_cols == 0:
+        return 0
+    rng = np.random.default_rng(seed)
+    rank = 0
+    for _ in range(num_trials):
+        rank = max(rank, _blackbox_rank_trial(operator, max_extra_terms, rng))
+        if rank == min(num_rows, num_cols):
+            break
+    return rank
+
+
+def _blackbox_rank_trial(operator, max_extra_terms, rng):
+    """A single run of `blackbox_rank`, with random choices made by the generator `rng`."""
+    p = operator.modulus
+    num_rows, num_cols = operator.shape
+
+    def random_units(size):
+        return rng.integers(1, p, size=size, dtype=np.int64)
+
+    if num_cols <= num_rows:
+        size = num_cols
+        inner, outer = random_units(num_rows), random_units(num_cols)
+
+        def apply(vector):
+            vector = outer * vector % p
+            vector = operator.rmatvec(inner * operator.matvec(vector) % p)
+            return outer * vector % p
+
+    else:
+        size = num_rows
+        inner, outer = random_units(num_cols), random_units(num_rows)
+
+        def apply(vector):
+            vector = outer * vector % p
+            vector = operator.matvec(inner * operator.rmatvec(vector) % p)
+            return outer * vector % p
+
+    u = rng.integers(0, p, size=size, dtype=np.int64)
+    vector = rng.integers(0, p, size=size, dtype=np.int64)
+    sequence = np.zeros(2 * size + 1, np.int64)
+    state = [np.ones(1, np.int64), np.ones(1, np.int64), 0, 1, 1]
+    last_change = 0
+    for k in range(2 * size + 1):
+        sequence[k] = np.sum(u * vector % p) % p
+        complexity = state[2]
+        _berlekamp_massey_step(state, sequence[: k + 1], p)
+        if state[2] != complexity:
+            last_change = k
+        if k - last_change >= max_extra_terms and k >= 2 * state[2]:
+            break
+        vector = apply(vector)
+
+    # The minimal polynomial has coefficients C[L], C[L-1], ..., C[0], starting with the
+    # constant term. Its multiplicity of the root 0 does not count towards the rank.
+    C, L = state[0], state[2]
+    C = np.concatenate([C, np.zeros(max(0, L + 1 - len(C)), np.int64)])
+    trailing = 0
+    while trailing < L and C[L - trailing] == 0:
+        trailing += 1
+    return int(L - trailing)
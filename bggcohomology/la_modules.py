@@ -7,14 +7,20 @@ example usage.
 """
 
 from IPython.display import display, Math, Latex
+import hashlib
 import itertools
+from math import comb
 from sage.rings.integer_ring import ZZ
+from sage.rings.polynomial.polynomial_ring_constructor import PolynomialRing
 from sage.matrix.constructor import matrix
 from sage.misc.cachefunc import cached_method
 from collections import defaultdict
 import numpy as np
 
 from . import cohomology
+from . import differential
+from .differential import RANK_METHODS
+from .sparse_action import GeneratorMatrixCache
 from .weight_set import WeightSet
 
 INT_PRECISION = np.int32
@@ -40,12 +46,20 @@ class LieAlgebraCompositeModule:
         Or `[[('g',1,'sym')],[('u',1,'sym')]]` to denote :math:`\\mathfrak g\\oplus\\mathfrak u`.
     component_dic : dict[str, ModuleComponent]
         dictionary mapping keys like 'g' or 'n' to their respective lie algebra component
+    wedge_bitmasks : bool (default: False)
+        If True, the action on wedge powers of modules with at most 64 basis elements is computed
+        on bitmasks, see `cohomology.ComponentLayout`. This doesn't change the results.
+    sym_multiplicities : bool (default: False)
+        If True, the action on symmetric powers is computed on vectors with the multiplicity of
+        each basis element, see `cohomology.ComponentLayout`. This doesn't change the results.
 
     Attributes
     ----------
     components : List[List[tuple(str, int, str)]]
     component_dic : dict[str, ModuleComponent]
     factory : ModuleFactory
+    wedge_bitmasks : bool
+    sym_multiplicities : bool
     weight_dic : Dict[int, np.array[np.int32]]
         Dictionary mapping the basis indices to the weights of the Lie algebra elements, 
         encoded as vector with length given by rank of Lie algebra.
@@ -90,10 +104,14 @@ class LieAlgebraCompositeModule:
         coefficients of the action.
     """
 
-    def __init__(self, factory, components, component_dic):
+    def __init__(
+        self, factory, components, component_dic, wedge_bitmasks=False, sym_multiplicities=False
+    ):
         self.components = components
         self.component_dic = component_dic
         self.factory = factory
+        self.wedge_bitmasks = wedge_bitmasks
+        self.sym_multiplicities = sym_multiplicities
         self.weight_dic = factory.weight_dic
         self.modules = {
             k: component_dic[k].basis for k in component_dic.keys()
@@ -141,6 +159,9 @@ class LieAlgebraCompositeModule:
             self.weight_comp_index_numbers[mu] = basis_dic
             self.weight_comp_direct_sum_index_numbers[mu] = basis_dic_direct_sum
 
+        # Tables to look up the same indices with array operations, see `rank_rows`
+        self._initialize_rank_tables()
+
         # for each direct sum component, store a list which lists the module type for each tensor slot
         self.type_lists = []
         for comp in self.components:
@@ -307,6 +328,130 @@ class LieAlgebraCompositeModule:
                 weight_components[weight].append((i, basis))
         return weight_components
 
+    def _initialize_rank_tables(self):
+        """Compute the tables used by `rank_rows` and `unrank`."""
+        # position of each index in the basis of each module, or -1
+        self._basis_positions = dict()
+        for key, basis in self.modules.items():
+            positions = np.full(self.max_index + 1, -1, dtype=np.int64)
+            positions[np.asarray(basis, dtype=np.int64)] = np.arange(len(basis))
+            self._basis_positions[key] = positions
+
+        # binomial coefficients for each tensor slot group
+        self._binomials = dict()
+        for component in self.components:
+            for key, n_inputs, tensor_type in component:
+                num_elements = self._slot_num_elements(key, n_inputs, tensor_type)
+                self._binomials[(num_elements, n_inputs)] = np.array(
+                    [[comb(a, b) for b in range(n_inputs + 1)] for a in range(num_elements + 1)],
+                    dtype=np.int64,
+                )
+
+        # For each direct sum component, the index in its weight component of each basis element,
+        # ordered as in `construct_component`. Also the offset of each direct sum component in
+        # each weight component.
+        self._weight_comp_positions = []
+        for component in self.components:
+            size = 1
+            for key, n_inputs, tensor_type in component:
+                num_elements = self._slot_num_elements(key, n_inputs, tensor_type)
+                size *= comb(num_elements, n_inputs)
+            self._weight_comp_positions.append(np.full(size, -1, dtype=np.int64))
+        self._weight_comp_offsets = dict()
+        for mu, components in self.weight_components.items():
+            offset = 0
+            offsets = dict()
+            for comp_num, basis in components:
+                offsets[comp_num] = offset
+                ranks = self._component_ranks(comp_num, basis)
+                self._weight_comp_positions[comp_num][ranks] = offset + np.arange(len(basis))
+                offset += len(basis)
+            self._weight_comp_offsets[mu] = offsets
+
+    def _slot_num_elements(self, key, n_inputs, tensor_type):
+        """Number of elements to choose from, in the combinatorial number system, for a
+        group of tensor slots. A multiset `a_0<=...<a_{n-1}` of positions in a basis of size N
+        corresponds to the set `a_0<a_1+1<...<a_{n-1}+n-1` of positions in N+n-1 elements."""
+        if tensor_type == "sym":
+            return len(self.modules[key]) + n_inputs - 1
+        return len(self.modules[key])
+
+    def _component_ranks(self, comp_num, rows):
+        """Position of rows in the basis of a direct sum component given by
+        `construct_component`. Each tensor slot group is ranked in lexicographic order
+        using the combinatorial number system, and the ranks are combined in mixed radix."""
+        rows = np.asarray(rows, dtype=np.int64)
+        ranks = np.zeros(len(rows), dtype=np.int64)
+        col = 0
+        for key, n_inputs, tensor_type in self.components[comp_num]:
+            positions = self._basis_positions[key][rows[:, col : col + n_inputs]]
+            if np.any(positions < 0):
+                raise KeyError("Rows contain indices not in the basis of '%s'" % key)
+            if tensor_type == "sym":
+                positions = positions + np.arange(n_inputs)
+            num_elements = self._slot_num_elements(key, n_inputs, tensor_type)
+            binomials = self._binomials[(num_elements, n_inputs)]
+
+            # Lexicographic rank of the set c_0<...<c_{n-1} out of N elements is
+            # C(N, n) - 1 - sum_i C(N-1-c_i, n-i)
+            num_subsets = binomials[num_elements, n_inputs]
+            slot_ranks = num_subsets - 1
+            for i in range(n_inputs):
+                slot_ranks = slot_ranks - binomials[num_elements - 1 - positions[:, i], n_inputs - i]
+            ranks = ranks * num_subsets + slot_ranks
+            col += n_inputs
+        return ranks
+
+    def rank_rows(self, comp_num, rows):
+        """Index of basis elements in their weight component.
+
+        This gives the same indices as `weight_comp_index_numbers`, but uses array operations
+        instead of dictionary lookups.
+
+        Parameters
+        ----------
+        comp_num : int
+            The direct sum component of the basis elements
+        rows : np.ndarray[int, int]
+            Basis elements of the direct sum component, in the format of `construct_component`.
+            The indices in each symmetric or wedge power have to be sorted.
+
+        Returns
+        -------
+        np.ndarray[np.int64]
+            For each row, the index of the basis element in the basis of its weight component.
+        """
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return self._weight_comp_positions[comp_num][self._component_ranks(comp_num, rows)]
+
+    def unrank(self, comp_num, mu, indices):
+        """Basis elements with the given indices in weight component `mu`. Inverse of `rank_rows`.
+
+        Parameters
+        ----------
+        comp_num : int
+            The direct sum component of the basis elements
+        mu : tuple(int)
+            The weight of the basis elements
+        indices : np.ndarray[int]
+            Indices in the basis of the weight component `mu`. They have to belong
+            to the direct sum component `comp_num`.
+
+        Returns
+        -------
+        np.ndarray[np.int32, np.int32]
+            The basis elements, in the format of `construct_component`.
+        """
+        indices = np.asarray(indices, dtype=np.int64) - self._weight_comp_offsets[mu][comp_num]
+        basis = dict(self.weight_components[mu])[comp_num]
+        if np.any(indices < 0) or np.any(indices >= len(basis)):
+            raise IndexError(
+                "Indices are not in direct sum component %d of weight component %s"
+                % (comp_num, mu)
+            )
+        return basis[indices]
+
     def get_action_tensor(self, component):
         """Compute a tensor encoding the action for a given tensor component.
 
@@ -435,6 +580,27 @@ class LieAlgebraCompositeModule:
         #return self._latex_basis_dic
         return basis_dic
 
+    @cached_method
+    def fingerprint(self):
+        """Digest identifying the module, used to look up cached differentials.
+
+        Two modules with the same fingerprint have the same components and the same action
+        of the same Lie algebra, and hence the same BGG differentials.
+
+        Returns
+        -------
+        str
+        """
+        digest = hashlib.sha1()
+        digest.update(repr(self.factory.lie_algebra).encode())
+        digest.update(repr(self.components).encode())
+        for key in sorted(self.action_tensor_dic.keys()):
+            digest.update(repr((key, sorted(self.modules[key]))).encode())
+            action_tensor = np.ascontiguousarray(self.action_tensor_dic[key])
+            digest.update(repr(action_tensor.shape).encode())
+            digest.update(action_tensor.tobytes())
+        return digest.hexdigest()
+
     def _weight_latex_basis(self, mu):
         """Turn a list of dictionaries into a list of all their values."""
         return list(
@@ -472,12 +638,11 @@ class LieAlgebraCompositeModule:
                 bgg_map, weight_comp, self, self.factory, comp_num
             )
 
-            target_dic = self.weight_comp_index_numbers[new_mu]
+            targets = self.rank_rows(comp_num, basis_action.indices)
             source_target_pairs = dict()
-            for row in basis_action:
-                target = target_dic[tuple(list(row[:-2]) + [comp_num])]
-                source = row[-2]
-                coeff = row[-1]
+            for source, coeff, target in zip(
+                basis_action.sources, basis_action.coeffs, targets
+            ):
                 if source not in source_target_pairs:
                     source_target_pairs[source] = []
                 source_target_pairs[source].append((target, coeff))
@@ -950,6 +1115,36 @@ class BGGCohomology:
     pbars : iterable(tqdm) or `None` (default: `None`)
         Progress bars to send updates to. If `None`, this feature is disabled.
         Up to two progress bars are supported for more detailed information.
+    action_engine : {'kernel', 'sparse'} (default: 'kernel')
+        How to compute the action of the BGG maps. 'kernel' rewrites the basis elements
+        of each weight component monomial by monomial, 'sparse' multiplies cached sparse
+        matrices of the generators acting on the weight components.
+    rank_method : {'auto', 'exact', 'modular'} (default: 'auto')
+        How to compute the rank of the differentials, see `SparseDifferential.rank`.
+        'auto' uses exact rank computations for small differentials and computations modulo
+        random primes for large ones.
+    num_primes : int (default: 3)
+        Number of random primes used for modular rank computations.
+    certify_rank : bool (default: False)
+        If `True`, modular rank computations use enough primes to prove the result is correct.
+    diff_cache : DifferentialCache or `None` (default: None)
+        Cache for differentials and their ranks. If `None`, use the cache shared by all
+        instances, `differential.default_cache`, which only keeps ranks. Entries are keyed by
+        fingerprints of the module and the cokernel, so instances for different modules can share
+        a cache.
+    primes : list(int) or `None` (default: None)
+        If not `None`, the differentials are computed modulo each of these primes, which have
+        to be smaller than 2**31. Coefficients then never overflow, and the rank of a
+        differential is the maximum of its ranks modulo the primes. The ranks are computed
+        while the differential is produced, see `cohomology.compute_diff_rank`. This is a lower bound for
+        the rank over the rationals, which is attained unless all primes divide every maximal
+        non-zero minor. Use `differential.random_primes` to get suitable primes.
+    matrix_free : bool (default: False)
+        If `True`, the differentials are never stored, and their ranks are computed with
+        `differential.blackbox_rank` from products with vectors, see
+        `cohomology.DifferentialOperator`. This uses little memory, but is much slower.
+        If `primes` is `None`, `num_primes` random primes are used. Otherwise the primes have to
+        be at least `differential.BLACKBOX_MIN_PRIME`.
 
     Attributes
     ----------
@@ -957,6 +1152,8 @@ class BGGCohomology:
     has_coker : bool
         True if `self.coker` is not None
     coker : Dict[tuple(int), matrix] or None
+    sparse_coker : SparseCoker
+        The cokernel bases as sparse matrices, only if `self.coker` is not None.
     weight_set : WeightSet
     weight_module : LieAlgebraCompositeModule
     weights : list(tuple(int))
@@ -966,16 +1163,39 @@ class BGGCohomology:
     regular_weights : list(tuple[tuple(int), tuple(int), int])
         list of triples consisting of dot-regular weight, associated dominant, and the length of 
         the Weyl group element making the weight dominant under the dot action.
+    action_engine : str
+    generator_matrices : GeneratorMatrixCache or `None`
+        Cache of generator matrices used if `action_engine` is 'sparse'.
+    rank_method : str
+    num_primes : int
+    certify_rank : bool
+    diff_cache : DifferentialCache
+    primes : tuple(int) or `None`
+    matrix_free : bool
 
     """
 
-    def __init__(self, BGG, weight_module=None, coker=None, pbars=None):
+    def __init__(
+        self,
+        BGG,
+        weight_module=None,
+        coker=None,
+        pbars=None,
+        action_engine="kernel",
+        rank_method="auto",
+        num_primes=3,
+        certify_rank=False,
+        diff_cache=None,
+        primes=None,
+        matrix_free=False,
+    ):
         self.BGG = BGG
         self.BGG.compute_signs()  # Make sure BGG signs are computed.
 
         if coker is not None:
             self.has_coker = True
             self.coker = coker
+            self.sparse_coker = cohomology.SparseCoker(coker)
         else:
             self.has_coker = False
 
@@ -987,6 +1207,38 @@ class BGGCohomology:
 
         self.weight_set = WeightSet.from_bgg(BGG)
 
+        if action_engine not in ("kernel", "sparse"):
+            raise ValueError("Unknown action engine '%s'" % action_engine)
+        self.action_engine = action_engine
+        self.generator_matrices = None
+
+        if rank_method not in RANK_METHODS:
+            raise ValueError("Unknown rank method '%s'" % rank_method)
+        self.rank_method = rank_method
+        self.num_primes = num_primes
+        self.certify_rank = certify_rank
+
+        if diff_cache is None:
+            diff_cache = differential.default_cache
+        self.diff_cache = diff_cache
+
+        if primes is not None:
+            primes = tuple(int(p) for p in primes)
+            if len(primes) == 0:
+                raise ValueError("At least one prime is needed")
+            for p in primes:
+                if p >= 2 ** 31 or not ZZ(p).is_prime():
+                    raise ValueError("%d is not a prime smaller than 2**31" % p)
+                if matrix_free and p < differential.BLACKBOX_MIN_PRIME:
+                    raise ValueError(
+                        "Matrix-free ranks need primes of at least %d, got %d"
+                        % (differential.BLACKBOX_MIN_PRIME, p)
+                    )
+        elif matrix_free:
+            primes = tuple(differential.random_primes(num_primes))
+        self.primes = primes
+        self.matrix_free = matrix_free
+
         if weight_module is not None:
             self.weight_module = weight_module
             self.weights = weight_module.weight_components.keys()
@@ -997,9 +1249,153 @@ class BGGCohomology:
                 self.weights
             )  # Find dot-regular weights
 
+            if action_engine == "sparse":
+                self.generator_matrices = GeneratorMatrixCache(weight_module)
+
+    def rank(self, diff):
+        """Rank of a differential, using the rank method of this object.
+
+        Parameters
+        ----------
+        diff : SparseDifferential
+
+        Returns
+        -------
+        int
+        """
+        return diff.rank(
+            method=self.rank_method,
+            num_primes=self.num_primes,
+            certify=self.certify_rank,
+        )
+
+    @cached_method
+    def coker_fingerprint(self):
+        """Digest identifying the cokernel, used to look up cached differentials.
+
+        If the cokernel is a `CokerCache`, the digest is built from the relations, dimensions and
+        basis indices it computes the cokernels from, so that no cokernel has to be computed.
+
+        Returns
+        -------
+        str
+            The digest, or "none" if there is no cokernel.
+        """
+        if not self.has_coker:
+            return "none"
+        digest = hashlib.sha1()
+        if hasattr(self.coker, "rel_dic"):
+            digest.update(repr(self.coker.method).encode())
+            for mu in sorted(self.coker.rel_dic.keys()):
+                rels = np.ascontiguousarray(self.coker.rel_dic[mu], dtype=np.int64)
+                digest.update(
+                    repr(
+                        (
+                            mu,
+                            self.coker.source_dims[mu],
+                            self.coker.target_dims[mu],
+                            list(self.coker.basis_indices[mu]),
+                            rels.shape,
+                        )
+                    ).encode()
+                )
+                digest.update(rels.tobytes())
+        else:
+            for mu in sorted(self.coker.keys()):
+                csc = self.sparse_coker.csc(mu)
+                csc.sort_indices()
+                digest.update(repr((mu, csc.shape)).encode())
+                for array in (csc.indptr, csc.indices, csc.data):
+                    digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def _diff_key(self, mu, i, modulus=None):
+        return (
+            self.weight_module.fingerprint(),
+            self.coker_fingerprint(),
+            tuple(int(m) for m in mu),
+            i,
+            modulus,
+        )
+
+    def _rank_key(self, mu, i):
+        # Modular ranks may be too small unless certified, so ranks computed with different
+        # settings are not interchangeable. The number of random primes only matters for
+        # uncertified ranks.
+        num_primes = None
+        if self.primes is None and not self.certify_rank:
+            num_primes = self.num_primes
+        return self._diff_key(mu, i, self.primes) + (
+            self.rank_method,
+            self.certify_rank,
+            num_primes,
+        )
+
+    def differential(self, mu, i, prime=None):
+        """Compute the BGG differential in degree `i` for dominant weight `mu`, or get it from
+        the cache.
+
+        The maps of the BGG complex for `mu` have to be computed in advance.
+
+        Parameters
+        ----------
+        mu : tuple(int)
+        i : int
+        prime : int or `None` (default: None)
+            If not `None`, compute the differential modulo this prime.
+
+        Returns
+        -------
+        (SparseDifferential, int)
+            The differential, and the dimension of its source. See `cohomology.compute_diff`.
+        """
+        key = self._diff_key(mu, i, prime)
+        cached = self.diff_cache.get_diff(key)
+        if cached is not None:
+            return cached
+        diff, source_dim = cohomology.compute_diff(self, mu, i, modulus=prime)
+        self.diff_cache.store_diff(key, diff, source_dim)
+        return diff, source_dim
+
+    def differential_rank(self, mu, i):
+        """Rank of the BGG differential in degree `i` for dominant weight `mu`.
+        The rank is computed only once, and stored in the cache.
+        If `self.primes` is set, this is the maximum of the ranks modulo these primes.
+
+        Returns
+        -------
+        (int, int)
+            The rank of the differential, and the dimension of its source.
+        """
+        key = self._rank_key(mu, i)
+        cached = self.diff_cache.get_rank(key)
+        if cached is not None:
+            return cached
+        if self.primes is None:
+            diff, source_dim = self.differential(mu, i)
+            rank = self.rank(diff)
+        elif self.matrix_free:
+            rank = 0
+            for p in self.primes:
+                operator, source_dim = cohomology.compute_diff(
+                    self, mu, i, modulus=p, matrix_free=True
+                )
+                rank = max(rank, operator.rank())
+        else:
+            # Only the rank is needed, so the differential is reduced as it is computed
+            rank = 0
+            for p in self.primes:
+                p_rank, source_dim = cohomology.compute_diff_rank(self, mu, i, p)
+                rank = max(rank, p_rank)
+        self.diff_cache.store_rank(key, rank, source_dim)
+        return rank, source_dim
+
     def cohomology_component(self, mu, i):
         """Compute cohomology BGG_i(mu).
 
+        Differentials and their ranks are stored in `self.diff_cache`, so that they can be reused
+        for neighbouring degrees.
+
         Parameters
         ----------
         mu : tuple(int)
@@ -1017,22 +1413,21 @@ class BGGCohomology:
         if self.pbar1 is not None:
             self.pbar1.set_description(str(mu) + ", maps")
         self.BGG.compute_maps(mu, pbar=self.pbar2, column=i)
+        return self._cohomology_dimension(mu, i)
 
+    def _cohomology_dimension(self, mu, i):
+        """Dimension of BGG_i(mu), assuming the maps for `mu` are already computed."""
         if self.pbar1 is not None:
             self.pbar1.set_description(str(mu) + ", diff")
         try:
-            d_i, chain_dim = cohomology.compute_diff(self, mu, i)
-            d_i_minus_1, _ = cohomology.compute_diff(self, mu, i - 1)
+            rank_1, chain_dim = self.differential_rank(mu, i)
+            if self.pbar1 is not None:
+                self.pbar1.set_description(str(mu) + ", rank2")
+            rank_2, _ = self.differential_rank(mu, i - 1)
         except IndexError as err:
             print(mu, i)
             raise err
 
-        if self.pbar1 is not None:
-            self.pbar1.set_description(str(mu) + ", rank1")
-        rank_1 = d_i.rank()
-        if self.pbar1 is not None:
-            self.pbar1.set_description(str(mu) + ", rank2")
-        rank_2 = d_i_minus_1.rank()
         return chain_dim - rank_1 - rank_2
 
     @cached_method
@@ -1088,10 +1483,7 @@ class BGGCohomology:
 
         # For isolated weights, multiplicity is just the module dimension
         for w, w_dom in dominant_trivial:
-            if (self.has_coker) and (w in self.coker):
-                cohom_dim = self.coker[w].nrows()
-            else:
-                cohom_dim = self.weight_module.dimensions[w]
+            cohom_dim = self._isolated_dimension(w)
             if cohom_dim > 0:
                 cohomology_dic[w_dom] += cohom_dim
 
@@ -1109,6 +1501,99 @@ class BGGCohomology:
         # The sorting order is the same as how we normally sort weights
         return sorted(cohomology_dic.items(), key=lambda t: (sum(t[0]), t[0][::-1]))
 
+    def _isolated_dimension(self, w):
+        """Dimension of the cohomology coming from an isolated dot-regular weight `w`."""
+        if (self.has_coker) and (w in self.coker):
+            return self.coker[w].nrows()
+        return self.weight_module.dimensions[w]
+
+    @cached_method
+    def cohomology_all_degrees(self, mu=None, min_degree=0):
+        """Compute the cohomology in all degrees at once.
+
+        This gives the same result as calling `self.cohomology(i, mu)` for every degree `i`,
+        but handles one dominant weight at a time. For each dominant weight that is not
+        isolated, the maps of the BGG complex are computed once, and every differential
+        and its rank are also computed only once.
+
+        Parameters
+        ----------
+        mu : tuple(int) or None (default: None)
+            Optionally restrict computation to a particular dominant weight.
+        min_degree : int (default: 0)
+            Only compute the cohomology in degrees at least `min_degree`.
+
+        Returns
+        -------
+        list[list[tuple(tuple(int), int)]]
+            For each degree `i` from 0 up to the length of the longest Weyl group element,
+            the cohomology in degree `i` in the same format as `self.cohomology`. Degrees
+            smaller than `min_degree` are not computed, and give empty lists.
+        """
+        if self.pbar1 is not None:
+            self.pbar1.set_description("Initializing")
+
+        # For each dominant weight, the dot-regular weights of each length mapping to it
+        weights_by_length = defaultdict(lambda: defaultdict(list))
+        for w, w_dom, l in self.regular_weights:
+            if (mu is not None) and (w_dom != mu):
+                continue
+            weights_by_length[w_dom][l].append(w)
+
+        max_degree = self.BGG.max_word_length
+        cohomology_dics = [defaultdict(int) for _ in range(max_degree + 1)]
+
+        if self.pbar1 is not None:
+            self.pbar1.reset(total=len(weights_by_length))
+        for w_dom, length_dic in weights_by_length.items():
+            # A degree is isolated if there are no weights of length one more or one less
+            non_isolated = []
+            for i, weights in length_dic.items():
+                if i < min_degree:
+                    continue
+                if (i - 1 in length_dic) or (i + 1 in length_dic):
+                    non_isolated.append(i)
+                else:
+                    for w in weights:
+                        cohomology_dics[i][w_dom] += self._isolated_dimension(w)
+
+            if len(non_isolated) > 0:
+                if self.pbar1 is not None:
+                    self.pbar1.set_description(str(w_dom) + ", maps")
+                self.BGG.compute_maps(w_dom, pbar=self.pbar2)
+                for i in sorted(non_isolated):
+                    cohomology_dics[i][w_dom] += self._cohomology_dimension(w_dom, i)
+            if self.pbar1 is not None:
+                self.pbar1.update()
+
+        return [
+            sorted(
+                ((w, mult) for w, mult in dic.items() if mult > 0),
+                key=lambda t: (sum(t[0]), t[0][::-1]),
+            )
+            for dic in cohomology_dics
+        ]
+
+    def poincare_polynomial(self, mu=None):
+        """Compute the Poincaré polynomial of the cohomology.
+
+        Parameters
+        ----------
+        mu : tuple(int) or None (default: None)
+            Optionally restrict computation to a particular dominant weight.
+
+        Returns
+        -------
+        Polynomial
+            Polynomial in `t` with integer coefficients, where the coefficient of `t^i` is
+            the Betti number in degree `i`.
+        """
+        t = PolynomialRing(ZZ, "t").gen()
+        return sum(
+            self.betti_number(cohom) * t ** i
+            for i, cohom in enumerate(self.cohomology_all_degrees(mu=mu))
+        )
+
     def betti_number(self, cohomology):
         """Compute Betti number from list of dominant weights and multiplicities.
 
@@ -1178,7 +1663,8 @@ class BGGCohomology:
                 all_degrees = range(1, self.BGG.max_word_length + 1)
             else:
                 all_degrees = range(self.BGG.max_word_length + 1)
-            cohoms = [(j, self.cohomology(j, mu=mu)) for j in all_degrees]
+            all_cohoms = self.cohomology_all_degrees(mu=mu, min_degree=all_degrees[0])
+            cohoms = [(j, all_cohoms[j]) for j in all_degrees]
 
             max_len = max([len(cohom) for _, cohom in cohoms])
             if (max_len == 0) and not skip_zero:
@@ -41,6 +41,7 @@ to a dominant weight :math:`\\mu` computes the multiplicity of :math:`\\mu` of
 from collections import defaultdict
 
 import numpy as np
+from scipy import sparse
 from IPython.display import Math, display
 
 from . import cohomology
@@ -263,14 +264,9 @@ def Eijk_basis(BGG, j, k, subset=[], pbar=None, method=0):
                     # For each row, look up the index in the target module
                     # then put the tuple (soruce, target, sign) in the list of relations.
                     basis_g = np.zeros(shape=(len(new_basis), 3), dtype=int)
-                    for row_num, (row, sign) in enumerate(
-                        zip(new_basis, signs[mask])
-                    ):
-                        source = row[0]
-                        target = wc_mod.weight_comp_index_numbers[new_mu][
-                            tuple(list(row[1:]) + [t_g_insert])
-                        ]
-                        basis_g[row_num] = [source, target, sign]
+                    basis_g[:, 0] = new_basis[:, 0]
+                    basis_g[:, 1] = wc_mod.rank_rows(t_g_insert, new_basis[:, 1:])
+                    basis_g[:, 2] = signs[mask]
                     if len(basis_g) > 0:
                         sparse_relations.append(basis_g)
 
@@ -306,14 +302,9 @@ def Eijk_basis(BGG, j, k, subset=[], pbar=None, method=0):
                         basis_un = np.zeros(
                             shape=(len(new_basis), 3), dtype=int
                         )
-                        for row_num, (row, sign) in enumerate(
-                            zip(new_basis, signs)
-                        ):
-                            source = row[0]
-                            target = wc_mod.weight_comp_index_numbers[new_mu][
-                                tuple(list(row[1:]) + [t_un_insert])
-                            ]
-                            basis_un[row_num] = [source, target, sign]
+                        basis_un[:, 0] = new_basis[:, 0]
+                        basis_un[:, 1] = wc_mod.rank_rows(t_un_insert, new_basis[:, 1:])
+                        basis_un[:, 2] = signs
                         if len(basis_un) > 0:
                             sparse_relations.append(basis_un)
 
@@ -422,6 +413,78 @@ class CokerCache:
         return mu in self.rel_dic
 
 
+class SparseCokernel:
+    """Basis of a cokernel, stored as an identity block and a sparse block.
+
+    The basis is a matrix with one row for each element of `basis_indices`. The
+    columns `basis_indices` of this matrix form an identity matrix, and the
+    columns `complement_indices` express the remaining basis elements of the
+    target in the basis of the quotient. Only the latter block is stored, as a
+    sparse matrix. Supports the parts of the Sage matrix interface used for
+    cokernel bases.
+
+    Parameters
+    ----------
+    target_dim : int
+        Dimension of the target of the map.
+    basis_indices : array[int]
+        Indices of the basis elements of the target forming a basis of the quotient.
+    complement_indices : array[int]
+        Indices of the remaining basis elements of the target.
+    complement_block : scipy.sparse.spmatrix
+        Matrix of shape `(len(basis_indices), len(complement_indices))`.
+    """
+
+    def __init__(self, target_dim, basis_indices, complement_indices, complement_block):
+        self.target_dim = int(target_dim)
+        self.basis_indices = np.asarray(basis_indices, dtype=np.int64)
+        self.complement_indices = np.asarray(complement_indices, dtype=np.int64)
+        self.complement_block = sparse.csc_matrix(complement_block, dtype=np.int64)
+        self._csc = None
+
+    def nrows(self):
+        """Dimension of the quotient."""
+        return len(self.basis_indices)
+
+    def ncols(self):
+        """Dimension of the target."""
+        return self.target_dim
+
+    def tocsc(self):
+        """The full basis of the cokernel as a `scipy.sparse.csc_matrix`."""
+        if self._csc is None:
+            block = self.complement_block.tocoo()
+            num_basis = self.nrows()
+            rows = np.concatenate([np.arange(num_basis), block.row])
+            cols = np.concatenate(
+                [self.basis_indices, self.complement_indices[block.col]]
+            )
+            data = np.concatenate([np.ones(num_basis, dtype=np.int64), block.data])
+            self._csc = sparse.csc_matrix(
+                (data, (rows, cols)), shape=(self.nrows(), self.ncols())
+            )
+        return self._csc
+
+    def dict(self):
+        """Dictionary of the nonzero entries of the basis of the cokernel."""
+        coo = self.tocsc().tocoo()
+        return {
+            (int(i), int(j)): int(c) for i, j, c in zip(coo.row, coo.col, coo.data)
+        }
+
+    def to_matrix(self):
+        """The basis of the cokernel as a sparse Sage matrix."""
+        return matrix(
+            ZZ, self.dict(), nrows=self.nrows(), ncols=self.ncols(), sparse=True
+        )
+
+    def rows(self):
+        return self.to_matrix().rows()
+
+    def columns(self):
+        return self.to_matrix().columns()
+
+
 def _compute_kernel(source_dim, target_dim, rels, pbar=None):
     """Compute cokernel.
 
@@ -458,7 +521,14 @@ def _compute_kernel(source_dim, target_dim, rels, pbar=None):
 
 
 def _compute_kernel2(source_dim, target_dim, rels, basis_indices, check=False):
-    inds_complement = list(set(range(target_dim)) - set(basis_indices))
+    """Compute cokernel, given the indices of a basis of the quotient.
+
+    The remaining basis elements of the target are solved for in terms of the
+    basis elements `basis_indices`. Only the solution is stored, and the
+    cokernel is returned as a `SparseCokernel`.
+    """
+    basis_indices = list(basis_indices)
+    inds_complement = sorted(set(range(target_dim)) - set(basis_indices))
 
     M = matrix(ZZ, nrows=source_dim, ncols=target_dim)
     for source, target, coeff in rels:
@@ -468,13 +538,26 @@ def _compute_kernel2(source_dim, target_dim, rels, basis_indices, check=False):
 
     sol = M[:, inds_complement].solve_right(b)
 
-    coker_mat = matrix(ZZ, nrows=target_dim, ncols=len(basis_indices))
-    coker_mat[inds_complement] = -sol
-    coker_mat[basis_indices] = matrix.identity(len(basis_indices))
-    coker_mat = coker_mat.T
+    # The cokernel is the identity on basis_indices and -sol.T on inds_complement
+    entries = sol.dict()
+    block_rows = np.fromiter((ij[1] for ij in entries), np.int64, len(entries))
+    block_cols = np.fromiter((ij[0] for ij in entries), np.int64, len(entries))
+    block_values = [-int(ZZ(c)) for c in entries.values()]
+    if max((abs(c) for c in block_values), default=0) > cohomology.INT64_MAX:
+        raise OverflowError("Coefficients of the basis of the cokernel don't fit in 64 bits")
+    block_data = np.array(block_values, dtype=np.int64)
+    complement_block = sparse.csc_matrix(
+        (block_data, (block_rows, block_cols)),
+        shape=(len(basis_indices), len(inds_complement)),
+    )
+    coker = SparseCokernel(target_dim, basis_indices, inds_complement, complement_block)
     if check:
-        assert (coker_mat * M.T).norm() == 0
-    return coker_mat
+        rels = np.asarray(rels, dtype=np.int64).reshape(-1, 3)
+        relations = sparse.csc_matrix(
+            (rels[:, 2], (rels[:, 1], rels[:, 0])), shape=(target_dim, source_dim)
+        )
+        assert (coker.tocsc() @ relations).count_nonzero() == 0
+    return coker
 
 
 def all_abijk(BGG, s=0, subset=[], half_only=False):
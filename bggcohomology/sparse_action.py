@@ -0,0 +1,238 @@
+"""
+Sparse matrix engine for the action of the BGG maps on weight modules.
+
+Instead of rewriting the basis indices of a weight component for every monomial of a map,
+this engine computes for each weight :math:`\\mu` and each generator :math:`f_\\alpha` the
+sparse matrix of :math:`f_\\alpha\\colon V_\\mu\\to V_{\\mu-\\alpha}` once. The action of a
+map of the BGG complex is then a sum of products of these matrices. The generator matrices are
+indexed by the basis of entire weight components, so no further index lookups are needed, and
+they are shared between all arrows, degrees and dominant weights.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from . import cohomology
+
+
+def _check_bound(bound, modulus):
+    """Raise `OverflowError` if coefficients of absolute value `bound` don't fit in 64 bits."""
+    if bound > cohomology.INT64_MAX:
+        message = "Coefficients of the action don't fit in 64 bits"
+        if modulus is None:
+            message += ", compute modulo primes instead"
+        raise OverflowError(message)
+
+
+def _reduce(matrix, modulus):
+    """Reduce the entries of a sparse matrix modulo `modulus` in place, if it is not `None`."""
+    if modulus is not None:
+        matrix.data %= modulus
+        matrix.eliminate_zeros()
+    return matrix
+
+
+def _scale(matrix, factor, modulus):
+    """Product of a sparse matrix with an integer, modulo `modulus` if it is not `None`."""
+    factor = int(factor)
+    if modulus is not None:
+        factor %= modulus
+    _check_bound(cohomology.max_abs(matrix.data) * abs(factor), modulus)
+    return _reduce(matrix * factor, modulus)
+
+
+def _add(left, right, modulus):
+    """Sum of two sparse matrices, modulo `modulus` if it is not `None`."""
+    _check_bound(cohomology.max_abs(left.data) + cohomology.max_abs(right.data), modulus)
+    return _reduce(left + right, modulus)
+
+
+def _product(left, right, modulus):
+    """Product of two sparse matrices, modulo `modulus` if it is not `None`.
+
+    Every entry of the product is a sum of at most (number of non-zero entries in a row of `left`)
+    products, which gives a bound on the entries that is checked before multiplying."""
+    left = left.tocsr()
+    max_row_nnz = int(np.diff(left.indptr).max()) if left.shape[0] > 0 else 0
+    _check_bound(
+        cohomology.max_abs(left.data) * cohomology.max_abs(right.data) * max_row_nnz,
+        modulus,
+    )
+    return _reduce(left @ right, modulus)
+
+
+class GeneratorMatrixCache:
+    """Cache of sparse matrices encoding the action of generators on weight components.
+
+    Parameters
+    ----------
+    module : LieAlgebraCompositeModule
+        The module on which the generators act
+    max_nnz : int (default: 10**8)
+        Maximum total number of non-zero entries of the stored matrices. If this is exceeded,
+        the least recently used matrices are evicted.
+
+    Attributes
+    ----------
+    module : LieAlgebraCompositeModule
+    max_nnz : int
+    nnz : int
+        Total number of non-zero entries of the stored matrices
+    """
+
+    def __init__(self, module, max_nnz=10 ** 8):
+        self.module = module
+        self.max_nnz = max_nnz
+        self.nnz = 0
+        self._matrices = OrderedDict()
+
+    def target_weight(self, mu, gen):
+        """Weight obtained by acting with generator `gen` on weight `mu`."""
+        return tuple(int(m + w) for m, w in zip(mu, self.module.weight_dic[gen]))
+
+    def __getitem__(self, key):
+        """Return sparse matrix of generator acting on a weight component.
+
+        Parameters
+        ----------
+        key : tuple(tuple(int), int)
+            Pair `(mu, gen)` of a weight and the index of a generator
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix or `None`
+            Matrix of shape (dimension of target, dimension of `mu`). If the target weight
+            component is empty, returns `None`.
+        """
+        if key in self._matrices:
+            self._matrices.move_to_end(key)
+            return self._matrices[key]
+
+        gen_matrix = self._compute_matrix(*key)
+        self._matrices[key] = gen_matrix
+        if gen_matrix is not None:
+            self.nnz += gen_matrix.nnz
+            while self.nnz > self.max_nnz and len(self._matrices) > 1:
+                _, evicted = self._matrices.popitem(last=False)
+                if evicted is not None:
+                    self.nnz -= evicted.nnz
+        return gen_matrix
+
+    def _compute_matrix(self, mu, gen):
+        """Compute the matrix of generator `gen` acting on weight component `mu`."""
+        module = self.module
+        target_mu = self.target_weight(mu, gen)
+        if target_mu not in module.weight_components:
+            return None
+
+        triplets = []
+        offset = 0
+        for comp_num, basis in module.weight_components[mu]:
+            action_source = cohomology.ActionImage(
+                basis,
+                np.arange(offset, offset + len(basis), dtype=np.int32),
+                np.ones(len(basis), dtype=np.int32),
+            )
+            offset += len(basis)
+
+            action_image = cohomology.compute_action(
+                gen, action_source, module, comp_num
+            )
+            if len(action_image) > 0:
+                cohomology.sort_cols(module, action_image, comp_num)
+                action_image = cohomology.merge_image(action_image)
+            if len(action_image) > 0:
+                triplets.append(
+                    cohomology.basis_to_triplets(
+                        module, target_mu, comp_num, action_image
+                    )
+                )
+
+        shape = (module.dimensions[target_mu], module.dimensions[mu])
+        if len(triplets) == 0:
+            return sparse.csr_matrix(shape, dtype=np.int64)
+        triplets = np.concatenate(triplets)
+        return sparse.csr_matrix(
+            (triplets[:, 2], (triplets[:, 0], triplets[:, 1])), shape=shape
+        )
+
+    def map_action(self, program, mu, modulus=None):
+        """Compute the matrix of a map of the BGG complex acting on a weight component.
+
+        Before every product and sum of matrices, a bound on the entries of the result is
+        computed, so that the entries never overflow. If `modulus` is not `None`, the entries are
+        reduced after every operation, and lie in [0, modulus).
+
+        Parameters
+        ----------
+        program : MapProgram
+            The compiled map
+        mu : tuple(int)
+            Weight of the source
+        modulus : int or `None` (default: None)
+            If not `None`, a prime smaller than 2**31 to compute the matrix modulo.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix or `None`
+            Matrix of shape (dimension of target, dimension of `mu`), or `None` if the
+            action is trivial.
+
+        Raises
+        ------
+        OverflowError
+            If the entries of the matrix may not fit in 64 bits.
+        """
+        result = None
+        if program.root_coeff != 0:
+            dim = self.module.dimensions[mu]
+            result = _scale(
+                sparse.identity(dim, dtype=np.int64, format="csr"),
+                program.root_coeff,
+                modulus,
+            )
+
+        # Walk the program depth-first. images[d] is the pair (matrix, weight) obtained
+        # by the first d generators of the current word.
+        images = [(None, mu)]
+        skip_depth = 0
+        for gen, depth, coeff in zip(program.gens, program.depths, program.coeffs):
+            if skip_depth > 0:
+                if depth > skip_depth:
+                    continue
+                skip_depth = 0
+            del images[depth:]
+            prev_matrix, prev_mu = images[depth - 1]
+            gen_matrix = self[(prev_mu, gen)]
+            if gen_matrix is None:  # prune the branch if the image is zero
+                skip_depth = depth
+                continue
+            if prev_matrix is not None:
+                gen_matrix = _product(gen_matrix, prev_matrix, modulus)
+                if gen_matrix.nnz == 0:
+                    skip_depth = depth
+                    continue
+            images.append((gen_matrix, self.target_weight(prev_mu, gen)))
+            if coeff != 0:
+                term = _scale(gen_matrix, coeff, modulus)
+                if result is None:
+                    result = term
+                else:
+                    result = _add(result, term, modulus)
+
+        if result is None:
+            return None
+        return _scale(result, program.scale, modulus)
+
+    def map_action_triplets(self, program, mu, modulus=None):
+        """Same as `map_action`, but returns rows `[target, source, coeff]` with non-zero coeff."""
+        result = self.map_action(program, mu, modulus)
+        if result is None:
+            return np.zeros((0, 3), np.int64)
+        result = result.tocoo()
+        triplets = np.stack([result.row, result.col, result.data], axis=1).astype(
+            np.int64
+        )
+        return triplets[triplets[:, 2] != 0]
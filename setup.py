@@ -1,9 +1,32 @@
+import sys
+
 import setuptools
 from Cython.Build import cythonize
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
+# The kernels in `cohomology.pyx` are parallelized with OpenMP. Apple clang doesn't ship
+# OpenMP, in which case the kernels are compiled to run on a single thread.
+if sys.platform == "win32":
+    openmp_compile_args, openmp_link_args = ["/openmp"], []
+elif sys.platform == "darwin":
+    openmp_compile_args, openmp_link_args = [], []
+else:
+    openmp_compile_args, openmp_link_args = ["-fopenmp"], ["-fopenmp"]
+
+extensions = [
+    setuptools.Extension(
+        "bggcohomology.cohomology",
+        ["bggcohomology/cohomology.pyx"],
+        extra_compile_args=openmp_compile_args,
+        extra_link_args=openmp_link_args,
+    ),
+    setuptools.Extension(
+        "bggcohomology.quantum_center", ["bggcohomology/quantum_center.pyx"]
+    ),
+]
+
 setuptools.setup(
     name="bggcohomology",
     version="1.6.1",
@@ -12,9 +35,9 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/RikVoorhaar/bgg-cohomology",
-    ext_modules=cythonize("bggcohomology/*.pyx"),
+    ext_modules=cythonize(extensions),
     packages=setuptools.find_packages(),
-    install_requires=["tqdm"],
+    install_requires=["tqdm", "scipy"],
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
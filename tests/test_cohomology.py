@@ -0,0 +1,420 @@
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import sage.all
+from sage.matrix.constructor import matrix
+from sage.rings.integer_ring import ZZ
+
+from bggcohomology import cohomology
+from bggcohomology.bggcomplex import BGGComplex
+from bggcohomology.cohomology import (
+    ActionImage,
+    compile_map,
+    merge_image,
+    sort_cols,
+    sort_merge,
+)
+from bggcohomology.differential import DifferentialCache
+from bggcohomology.la_modules import (
+    BGGCohomology,
+    LieAlgebraCompositeModule,
+    ModuleFactory,
+)
+from bggcohomology.weight_set import WeightSet
+
+
+def random_coker(module, seed=0):
+    """Random cokernel bases for all weight components of `module`, of about half their size."""
+    rng = np.random.default_rng(seed)
+    coker = dict()
+    for nu, dim in module.dimensions.items():
+        quotient_dim = dim // 2 + 1
+        shape = (quotient_dim, dim)
+        basis = rng.integers(-2, 3, size=shape) * (rng.random(shape) < 0.5)
+        coker[nu] = matrix(ZZ, basis.tolist())
+    return coker
+
+
+@pytest.fixture(scope="module")
+def b2_module():
+    """Third symmetric power of the coadjoint representation of u for B2, and a dominant weight
+    whose maps of the BGG complex are computed."""
+    bgg = BGGComplex("B2")
+    factory = ModuleFactory(bgg.LA)
+    component_dic = {"u": factory.build_component("u", "coad")}
+    module = LieAlgebraCompositeModule(factory, [[("u", 3, "sym")]], component_dic)
+    mu = WeightSet.from_bgg(bgg).make_dominant((1, 2))[0]
+    bgg.compute_maps(mu)
+    return SimpleNamespace(bgg=bgg, factory=factory, module=module, mu=mu)
+
+
+@pytest.fixture(params=[False, True], ids=["module", "coker"])
+def b2_cohom(request, b2_module):
+    """`BGGCohomology` for `b2_module`, without and with a cokernel."""
+    coker = random_coker(b2_module.module) if request.param else None
+    cohom = BGGCohomology(
+        b2_module.bgg, b2_module.module, coker=coker, diff_cache=DifferentialCache()
+    )
+    return SimpleNamespace(cohom=cohom, bgg=b2_module.bgg, mu=b2_module.mu)
+
+
+def naive_merge(action_image):
+    """Merge rows by summing coefficients in a dictionary."""
+    sums = defaultdict(int)
+    for row in action_image:
+        sums[tuple(row[:-1])] += row[-1]
+    return {k: v for k, v in sums.items() if v != 0}
+
+
+@pytest.mark.parametrize("max_value", [4, 2 ** 20, 2 ** 40])
+def test_sort_merge(max_value):
+    rng = np.random.default_rng(max_value)
+    action_image = rng.integers(0, 4, size=(1000, 6)) * (max_value // 4)
+    action_image[:, -1] = rng.integers(-2, 3, size=1000)
+    merged = sort_merge(action_image)
+
+    # Rows are sorted with the last index column as primary key
+    assert np.array_equal(merged, merged[np.lexsort(np.transpose(merged[:, :-1]))])
+    assert {tuple(row[:-1]): row[-1] for row in merged} == naive_merge(action_image)
+
+
+def test_sort_merge_modulus():
+    rng = np.random.default_rng(0)
+    action_image = rng.integers(0, 4, size=(1000, 4))
+    action_image[:, -1] = rng.integers(0, 7, size=1000)
+    merged = sort_merge(action_image, modulus=7)
+
+    expected = {k: v % 7 for k, v in naive_merge(action_image).items() if v % 7 != 0}
+    assert {tuple(row[:-1]): row[-1] for row in merged} == expected
+
+
+def permutation_sign(row):
+    """Sign of the permutation sorting a row, or 0 if it has duplicate entries."""
+    if len(set(row)) < len(row):
+        return 0
+    inversions = sum(row[i] > row[j] for i in range(len(row)) for j in range(i + 1, len(row)))
+    return (-1) ** inversions
+
+
+@pytest.mark.parametrize("width", [2, 3, 5, 8, 11])
+def test_sort_cols(width):
+    module = SimpleNamespace(
+        components=[[("u", width, "sym"), ("g", 1, "wedge"), ("n", width, "wedge")]]
+    )
+    rng = np.random.default_rng(width)
+    action_image = rng.integers(0, 3 * width, size=(500, 2 * width + 3))
+    action_image[:, -1] = 1
+    sorted_image = ActionImage.from_rows(action_image)
+    assert sorted_image.indices.dtype == np.uint8
+    sort_cols(module, sorted_image, 0)
+    sorted_image = sorted_image.to_rows()
+
+    for row, sorted_row in zip(action_image, sorted_image):
+        sym_slot = slice(0, width)
+        wedge_slot = slice(width + 1, 2 * width + 1)
+        assert np.array_equal(np.sort(row[sym_slot]), sorted_row[sym_slot])
+        assert np.array_equal(np.sort(row[wedge_slot]), sorted_row[wedge_slot])
+        assert sorted_row[-1] == permutation_sign(list(row[wedge_slot]))
+
+
+def test_action_dtypes():
+    """Action images are stored as int32 if possible, and promoted when coefficients grow."""
+    big = 2 ** 40
+    # Generator 0 swaps basis elements 1 and 2, multiplying by `big`. Generator 1 fixes them.
+    action_tensor = np.zeros((2, 3, 3), np.int64)
+    action_tensor[0, 1] = (-1, 2, big)
+    action_tensor[0, 2] = (-1, 1, big)
+    action_tensor[1, 1] = (-1, 1, 1)
+    action_tensor[1, 2] = (-1, 2, 1)
+    module = SimpleNamespace(
+        type_lists=[["a"]],
+        action_tensor_dic={"a": action_tensor},
+        components=[[("a", 1, "sym")]],
+    )
+    action_source = ActionImage.from_rows(np.array([[1, 0, 1], [2, 1, -1]]))
+    assert action_source.indices.dtype == np.uint8
+    assert action_source.coeffs.dtype == np.int32
+    assert cohomology.compute_action(1, action_source, module, 0).coeffs.dtype == np.int32
+
+    image = action_source
+    for power, dtype in [(1, np.int64), (2, object), (3, object)]:
+        image = cohomology.compute_action(0, image, module, 0)
+        assert image.coeffs.dtype == dtype
+        assert image.coeffs.tolist() == [big ** power, -(big ** power)]
+    assert image.indices.tolist() == [[2], [1]]
+    assert image.sources.tolist() == [0, 1]
+
+    # Merged images only keep Python integers if the sums don't fit in 64 bits
+    assert merge_image(ActionImage.concatenate([image, image])).coeffs.dtype == object
+    cancelling = image.copy()
+    cancelling.coeffs = 1 - image.coeffs
+    merged = merge_image(ActionImage.concatenate([image, cancelling]))
+    assert merged.coeffs.dtype == np.int64
+    assert merged.to_rows().tolist() == [[2, 0, 1], [1, 1, 1]]
+    assert sort_merge(np.concatenate([image.to_rows(), cancelling.to_rows()])).dtype == np.int64
+
+
+@pytest.mark.parametrize("root_system", ["A2", "B2"])
+def test_compile_map(root_system):
+    bgg = BGGComplex(root_system)
+    factory = ModuleFactory(bgg.LA)
+    mu = WeightSet.from_bgg(bgg).make_dominant((1, 2))[0]
+    for arrow, bgg_map in bgg.compute_maps(mu).items():
+        program = compile_map(bgg_map, factory, sign=-1)
+
+        # Reconstruct the words from the depth-first order of the program
+        words = dict()
+        path = []
+        for gen, depth, coeff in zip(program.gens, program.depths, program.coeffs):
+            path = path[: depth - 1] + [gen]
+            if coeff != 0:
+                words[tuple(path)] = -coeff * program.scale
+        if program.root_coeff != 0:
+            words[tuple()] = -program.root_coeff * program.scale
+
+        expected = {
+            tuple(factory.root_to_index[t] for t in monomial.to_word_list()[::-1]): c
+            for monomial, c in bgg_map.monomial_coefficients().items()
+        }
+        assert words == expected
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_parallel_kernels(num_threads, b2_cohom):
+    """Differentials don't depend on the number of threads."""
+    cohom, bgg, mu = b2_cohom.cohom, b2_cohom.bgg, b2_cohom.mu
+
+    old_threads, old_min_rows = cohomology.get_num_threads(), cohomology.PARALLEL_MIN_ROWS
+    for i in range(bgg.max_word_length):
+        diff, source_dim = cohomology.compute_diff(cohom, mu, i)
+        try:
+            cohomology.set_num_threads(num_threads)
+            cohomology.PARALLEL_MIN_ROWS = 1
+            parallel_diff, parallel_source_dim = cohomology.compute_diff(cohom, mu, i)
+        finally:
+            cohomology.set_num_threads(old_threads)
+            cohomology.PARALLEL_MIN_ROWS = old_min_rows
+        assert parallel_source_dim == source_dim
+        assert np.array_equal(parallel_diff.to_numpy(), diff.to_numpy())
+
+
+def test_action_memory_limit(b2_module):
+    """Merging images in small chunks gives the same result as merging them all at once."""
+    bgg, factory, module = b2_module.bgg, b2_module.factory, b2_module.module
+    for arrow, bgg_map in bgg.compute_maps(b2_module.mu).items():
+        for nu, components in module.weight_components.items():
+            for comp_num, basis in components:
+                expected = cohomology.action_on_basis(
+                    bgg_map, basis, module, factory, comp_num
+                )
+                streamed = cohomology.action_on_basis(
+                    bgg_map, basis, module, factory, comp_num, memory_limit=1
+                )
+                assert np.array_equal(expected.to_rows(), streamed.to_rows())
+
+
+def test_basis_to_triplets(b2_module):
+    """Basis elements are replaced by their index in the weight component, which is checked."""
+    module = b2_module.module
+    weights = sorted(module.weight_components)
+    for nu, other in zip(weights, weights[1:] + weights[:1]):
+        for comp_num, basis in module.weight_components[nu]:
+            image = ActionImage(
+                basis, np.arange(len(basis), dtype=np.int32), np.ones(len(basis), np.int32)
+            )
+            triplets = cohomology.basis_to_triplets(module, nu, comp_num, image, check=True)
+            index_numbers = module.weight_comp_index_numbers[nu]
+            expected = [index_numbers[tuple(row) + (comp_num,)] for row in basis]
+            assert triplets[:, 0].tolist() == expected
+            with pytest.raises(KeyError):
+                cohomology.basis_to_triplets(module, other, comp_num, image, check=True)
+
+
+def test_scratch_arena():
+    """Released buffers are reused, up to the scratch limit."""
+    arena = cohomology.ScratchArena()
+    size = cohomology.SCRATCH_MIN_BYTES // 4
+    a = arena.empty(size, np.int64)
+    arena.release(a)
+    b = arena.empty((size - 10, 1), np.int64)
+    assert b.shape == (size - 10, 1)
+    assert b.base is a.base
+    assert arena.stats["reuses"] == 1
+    assert arena.stats["allocations"] == 1
+
+    # Buffers that weren't obtained from the arena, or only once, are ignored
+    arena.release(np.empty(size, np.int64), b, b)
+    assert arena.stats["releases"] == 2
+
+    # Small arrays are not pooled
+    arena.release(arena.empty(1, np.int64))
+    assert arena.stats["requests"] == 2
+
+    old_limit = cohomology.get_scratch_limit()
+    try:
+        cohomology.set_scratch_limit(0)
+        arena.clear()
+        arena.release(arena.empty(size, np.int64))
+        assert arena.stats["discards"] == 1
+        assert arena.stats["pooled_bytes"] == 0
+    finally:
+        cohomology.set_scratch_limit(old_limit)
+
+
+@pytest.mark.parametrize(
+    "layout_options",
+    [
+        {"wedge_bitmasks": True},
+        {"sym_multiplicities": True},
+        {"wedge_bitmasks": True, "sym_multiplicities": True},
+    ],
+)
+def test_component_layouts(layout_options):
+    """Acting on wedge powers stored as bitmasks, or on symmetric powers stored as multiplicity
+    vectors, gives the same differentials."""
+    bgg = BGGComplex("B2")
+    factory = ModuleFactory(bgg.LA)
+    component_dic = {
+        "u": factory.build_component("u", "coad"),
+        "n": factory.build_component("n", "ad"),
+    }
+    components = [[("n", 3, "wedge"), ("u", 2, "sym")], [("u", 3, "sym"), ("n", 2, "wedge")]]
+    module = LieAlgebraCompositeModule(factory, components, component_dic)
+    encoded_module = LieAlgebraCompositeModule(
+        factory, components, component_dic, **layout_options
+    )
+    for comp_num in range(len(components)):
+        layout = cohomology.component_layout(encoded_module, comp_num)
+        basis = encoded_module.construct_component(components[comp_num])
+        assert np.array_equal(layout.decode(layout.encode(basis)), basis)
+
+    mu = WeightSet.from_bgg(bgg).make_dominant((1, 2))[0]
+    bgg.compute_maps(mu)
+    for i in range(bgg.max_word_length):
+        diff, _ = cohomology.compute_diff(BGGCohomology(bgg, module), mu, i)
+        encoded_diff, _ = cohomology.compute_diff(BGGCohomology(bgg, encoded_module), mu, i)
+        assert np.array_equal(encoded_diff.to_numpy(), diff.to_numpy())
+
+
+def test_chunked_diff(b2_cohom):
+    """Splitting weight components into chunks doesn't change the differentials."""
+    cohom, bgg, mu = b2_cohom.cohom, b2_cohom.bgg, b2_cohom.mu
+
+    old_budget = cohomology.get_diff_memory_budget()
+    for i in range(bgg.max_word_length):
+        diff, source_dim = cohomology.compute_diff(cohom, mu, i)
+        try:
+            cohomology.set_diff_memory_budget(1)
+            chunked_diff, chunked_source_dim = cohomology.compute_diff(cohom, mu, i)
+        finally:
+            cohomology.set_diff_memory_budget(old_budget)
+        assert source_dim == chunked_source_dim
+        assert chunked_diff.shape == diff.shape
+        assert np.array_equal(chunked_diff.to_numpy(), diff.to_numpy())
+
+
+@pytest.mark.parametrize("prime", [3, 1073741789])
+def test_modular_diff(prime, b2_cohom):
+    """Differentials computed modulo a prime are the reductions of the integer differentials."""
+    cohom, bgg, mu = b2_cohom.cohom, b2_cohom.bgg, b2_cohom.mu
+
+    for i in range(bgg.max_word_length):
+        diff, source_dim = cohomology.compute_diff(cohom, mu, i)
+        modular_diff, modular_source_dim = cohomology.compute_diff(cohom, mu, i, modulus=prime)
+        assert modular_source_dim == source_dim
+        assert modular_diff.modulus == prime
+
+        # Rows and trailing columns can vanish modulo the prime
+        expected = diff.to_numpy() % prime
+        expected = expected[np.any(expected != 0, axis=1)]
+        dense = modular_diff.to_numpy()
+        assert np.array_equal(expected[:, : dense.shape[1]], dense)
+        assert not np.any(expected[:, dense.shape[1] :])
+        assert modular_diff.rank() <= diff.rank()
+
+
+@pytest.mark.parametrize("budget", [1, None])
+def test_diff_rank(budget, b2_cohom):
+    """Ranks computed while the differential is produced agree with ranks of stored differentials."""
+    cohom, bgg, mu = b2_cohom.cohom, b2_cohom.bgg, b2_cohom.mu
+    prime = 1073741789
+
+    old_budget = cohomology.get_diff_memory_budget()
+    for i in range(bgg.max_word_length):
+        diff, source_dim = cohom.differential(mu, i, prime)
+        try:
+            if budget is not None:
+                cohomology.set_diff_memory_budget(budget)
+            rank, rank_source_dim = cohomology.compute_diff_rank(cohom, mu, i, prime)
+        finally:
+            cohomology.set_diff_memory_budget(old_budget)
+        assert rank_source_dim == source_dim
+        assert rank == diff.rank()
+
+
+def test_differential_operator(b2_cohom):
+    """The matrix-free differential agrees with the stored differential."""
+    cohom, bgg, mu = b2_cohom.cohom, b2_cohom.bgg, b2_cohom.mu
+    prime = 1073741789
+    rng = np.random.default_rng(0)
+
+    for i in range(bgg.max_word_length):
+        diff, source_dim = cohomology.compute_diff(cohom, mu, i, modulus=prime)
+        operator, operator_source_dim = cohomology.compute_diff(
+            cohom, mu, i, modulus=prime, matrix_free=True
+        )
+        assert operator_source_dim == source_dim
+        assert operator.shape[1] == source_dim
+
+        # The operator keeps the zero rows that the stored differential omits
+        dense = np.zeros(operator.shape, np.int64)
+        for entries in operator.task_entries():
+            np.add.at(dense, (entries[:, 0], entries[:, 1]), entries[:, 2])
+        dense %= prime
+        dense_rows = dense[np.any(dense != 0, axis=1)]
+        assert np.array_equal(dense_rows[:, : diff.ncols()], diff.to_numpy())
+
+        x = rng.integers(0, prime, size=operator.shape[1])
+        y = rng.integers(0, prime, size=operator.shape[0])
+        assert np.array_equal(
+            operator.matvec(x), (dense.astype(object) @ x.astype(object)) % prime
+        )
+        assert np.array_equal(
+            operator.rmatvec(y), (dense.T.astype(object) @ y.astype(object)) % prime
+        )
+        assert operator.rank() == diff.rank()
+
+
+def test_coker_project():
+    """Projecting to cokernels multiplies the matrix of the action by the cokernel bases."""
+    rng = np.random.default_rng(0)
+    coker_0 = rng.integers(-2, 3, size=(4, 9)) * (rng.random((4, 9)) < 0.4)
+    coker_1 = rng.integers(-2, 3, size=(5, 7)) * (rng.random((5, 7)) < 0.4)
+    coker = {
+        "mu0": matrix(ZZ, coker_0.tolist()),
+        "mu1": matrix(ZZ, coker_1.tolist()),
+    }
+    action = rng.integers(-3, 4, size=(7, 9)) * (rng.random((7, 9)) < 0.5)
+    targets, sources = np.nonzero(action)
+    triplets = np.stack([targets, sources, action[targets, sources]], axis=1)
+
+    expected = coker_1 @ action @ coker_0.T
+    for sparse_coker in [coker, cohomology.SparseCoker(coker)]:
+        projected = cohomology.coker_project(sparse_coker, triplets, "mu0", "mu1")
+        result = np.zeros(expected.shape, np.int64)
+        result[projected[:, 0], projected[:, 1]] = projected[:, 2]
+        assert np.array_equal(result, expected)
+
+    # Products that may not fit in 64 bits are only computed modulo a prime
+    large = triplets.copy()
+    large[:, 2] *= 2 ** 61
+    with pytest.raises(OverflowError):
+        cohomology.coker_project(coker, large, "mu0", "mu1")
+    prime = 1073741789
+    projected = cohomology.coker_project(coker, large, "mu0", "mu1", prime)
+    result = np.zeros(expected.shape, np.int64)
+    result[projected[:, 0], projected[:, 1]] = projected[:, 2]
+    assert np.array_equal(result, (expected.astype(object) * 2 ** 61) % prime)
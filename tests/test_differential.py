@@ -0,0 +1,197 @@
+import numpy as np
+import pytest
+
+import sage.all
+
+from bggcohomology import cohomology, differential
+from bggcohomology.differential import DifferentialCache, SparseDifferential, blackbox_rank
+
+
+def random_triplets(seed, size=300):
+    """Random merged triplets `[row, col, value]` with some rows missing."""
+    rng = np.random.default_rng(seed)
+    triplets = rng.integers(0, 40, size=(size, 3))
+    triplets[:, 0] *= 3
+    triplets[:, 2] = rng.integers(1, 4, size=size)
+    _, unique = np.unique(triplets[:, :2], axis=0, return_index=True)
+    return triplets[unique]
+
+
+def test_from_triplets():
+    triplets = random_triplets(0)
+    diff = SparseDifferential.from_triplets(triplets)
+
+    # Rows are renumbered in order, without zero rows
+    row_ids = np.unique(triplets[:, 0])
+    expected = np.zeros((len(row_ids), triplets[:, 1].max() + 1), np.int64)
+    expected[np.searchsorted(row_ids, triplets[:, 0]), triplets[:, 1]] = triplets[:, 2]
+    assert diff.shape == expected.shape
+    assert np.array_equal(diff.to_numpy(), expected)
+    assert np.array_equal(diff.tocsr().toarray(), expected)
+    assert np.array_equal(np.array(diff.to_sage(sparse=True)), expected)
+    assert np.array_equal(np.array(diff.to_sage(sparse=False)), expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rank(seed, monkeypatch):
+    diff = SparseDifferential.from_triplets(random_triplets(seed))
+    dense_rank = diff.to_sage(sparse=False).rank()
+    assert diff.rank() == dense_rank
+
+    monkeypatch.setattr(differential, "DENSE_MAX_ENTRIES", 0)
+    assert diff.rank() == dense_rank
+
+
+def test_zero():
+    diff = SparseDifferential.zero()
+    assert diff.shape == (0, 0)
+    assert diff.rank() == 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("certify", [False, True])
+def test_modular_rank(seed, certify):
+    # Low rank matrix, with entries of the factors large enough to have non-trivial minors
+    rng = np.random.default_rng(seed)
+    dense = rng.integers(-50, 50, size=(60, 8)) @ rng.integers(-50, 50, size=(8, 40))
+    dense[rng.random(dense.shape) < 0.5] = 0
+    rows, cols = np.nonzero(dense)
+    diff = SparseDifferential(rows, cols, dense[rows, cols], dense.shape)
+
+    exact_rank = diff.rank(method="exact")
+    assert diff.rank(method="modular", num_primes=1, certify=certify) == exact_rank
+    assert diff.rank(method="modular", num_primes=4, certify=certify) == exact_rank
+
+
+def test_rank_mod_small_prime():
+    # The rank of this matrix is 2, but it is 1 modulo 5
+    diff = SparseDifferential([0, 0, 1, 1], [0, 1, 0, 1], [1, 2, 3, 1], (2, 2))
+    csr = diff.tocsr()
+    ranks = cohomology.rank_mod_primes(csr.indptr, csr.indices, csr.data, 2, [5, 7])
+    assert list(ranks) == [1, 2]
+    assert diff.rank(method="modular") == 2
+    assert SparseDifferential([0, 0, 1, 1], [0, 1, 0, 1], [1, 2, 3, 1], (2, 2), 5).rank() == 1
+
+
+class DenseOperator:
+    """Matrix-free interface to a dense matrix modulo a prime."""
+
+    def __init__(self, dense, modulus):
+        self.dense = dense.astype(object) % modulus
+        self.modulus = modulus
+        self.shape = dense.shape
+
+    def matvec(self, vector):
+        return (self.dense @ vector.astype(object) % self.modulus).astype(np.int64)
+
+    def rmatvec(self, vector):
+        return (self.dense.T @ vector.astype(object) % self.modulus).astype(np.int64)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_blackbox_rank(seed):
+    rng = np.random.default_rng(seed)
+    num_rows, num_cols, rank = rng.integers(1, 30, size=3)
+    dense = rng.integers(-3, 4, size=(num_rows, rank)) @ rng.integers(-3, 4, size=(rank, num_cols))
+    dense[rng.random(dense.shape) < 0.3] = 0
+    prime = 1073741789
+    diff = SparseDifferential(*np.nonzero(dense), dense[np.nonzero(dense)], dense.shape, prime)
+    assert blackbox_rank(DenseOperator(dense, prime), seed=seed) == diff.rank()
+
+
+def test_blackbox_rank_special():
+    prime = 1073741789
+    assert blackbox_rank(DenseOperator(np.eye(20, dtype=np.int64), prime)) == 20
+    assert blackbox_rank(DenseOperator(np.zeros((5, 7), np.int64), prime)) == 0
+    nilpotent = np.triu(np.ones((15, 15), np.int64), 1)
+    assert blackbox_rank(DenseOperator(nilpotent, prime)) == 14
+
+
+def test_blackbox_rank_small_prime():
+    """Over small fields the preconditioners are degenerate, so small primes are refused."""
+    ones = np.ones((1, 2), np.int64)
+    for prime in [2, 3]:
+        with pytest.raises(ValueError):
+            blackbox_rank(DenseOperator(ones, prime))
+    prime = 1073741789
+    assert blackbox_rank(DenseOperator(ones, prime)) == 1
+    identities = np.concatenate([np.eye(4, dtype=np.int64)] * 2, axis=1)
+    for seed in range(5):
+        assert blackbox_rank(DenseOperator(identities, prime), seed=seed) == 4
+
+
+@pytest.mark.parametrize("prime", [2, 7, 1073741789])
+def test_echelon_accumulator(prime):
+    rng = np.random.default_rng(prime)
+    left = rng.integers(-3, 4, size=(60, 8)) * (rng.random((60, 8)) < 0.3)
+    right = rng.integers(-3, 4, size=(8, 50)) * (rng.random((8, 50)) < 0.3)
+    dense = left @ right
+    rows, cols = np.nonzero(dense)
+    triplets = np.stack([rows, cols, dense[rows, cols]], axis=1)
+    expected = SparseDifferential(rows, cols, dense[rows, cols], dense.shape, prime).rank()
+
+    # Add the rows in a few batches of shuffled entries
+    accumulator = cohomology.EchelonAccumulator(dense.shape[1], prime)
+    for batch_rows in np.array_split(rng.permutation(dense.shape[0]), 4):
+        batch = triplets[np.isin(triplets[:, 0], batch_rows)]
+        accumulator.add_rows(batch[rng.permutation(len(batch))])
+    assert accumulator.rank == expected
+    assert expected <= 8
+
+
+def test_blocks():
+    # Block diagonal matrix with shuffled rows and columns, and an empty row and column
+    rng = np.random.default_rng(1)
+    block_list = [rng.integers(1, 4, size=shape) for shape in [(3, 4), (1, 1), (5, 2)]]
+    dense = np.zeros((10, 8), np.int64)
+    dense[:3, :4] = block_list[0]
+    dense[3:4, 4:5] = block_list[1]
+    dense[4:9, 5:7] = block_list[2]
+    row_perm, col_perm = rng.permutation(10), rng.permutation(8)
+    dense = dense[row_perm][:, col_perm]
+    rows, cols = np.nonzero(dense)
+    diff = SparseDifferential(rows, cols, dense[rows, cols], dense.shape)
+
+    blocks = diff.blocks()
+    assert sorted(block.shape for block in blocks) == [(1, 1), (3, 4), (5, 2)]
+    assert sum(block.nnz for block in blocks) == diff.nnz
+    for block in blocks:
+        matching = [b for b in block_list if b.shape == block.shape][0]
+        assert block.to_numpy().sum() == matching.sum()
+
+    expected = diff.rank(split_blocks=False)
+    assert diff.rank() == expected
+    assert diff.rank(method="modular") == expected
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_differential_cache(spill, tmp_path):
+    cache = DifferentialCache(max_bytes=16000, spill_dir=str(tmp_path) if spill else None)
+    diffs = {
+        ("module", "none", (0, 0), i): SparseDifferential.from_triplets(random_triplets(i))
+        for i in range(4)
+    }
+    modular_triplets = random_triplets(4)
+    modular_triplets[:, 2] %= 7
+    diffs[("module", "none", (0, 0), 4, 7)] = SparseDifferential.from_triplets(
+        modular_triplets[modular_triplets[:, 2] != 0], modulus=7
+    )
+    for key, diff in diffs.items():
+        cache.store_diff(key, diff, diff.shape[1])
+        cache.store_rank(key, 1, diff.shape[1])
+    assert cache.nbytes <= cache.max_bytes
+
+    # The first differentials have been evicted, and can only be recovered from disk
+    for key, diff in diffs.items():
+        cached = cache.get_diff(key)
+        if cached is None:
+            assert not spill
+        else:
+            assert np.array_equal(cached[0].to_numpy(), diff.to_numpy())
+            assert cached[0].modulus == diff.modulus
+            assert cached[1] == diff.shape[1]
+        assert cache.get_rank(key) == (1, diff.shape[1])
+
+    cache.clear()
+    assert cache.get_diff(("module", "none", (0, 0), 0)) is None
+    assert list(tmp_path.iterdir()) == []
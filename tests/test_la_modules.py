@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 import sage.all
@@ -6,11 +7,15 @@ from sage.rings.integer_ring import ZZ
 from sage.matrix.constructor import matrix
 
 from bggcohomology.bggcomplex import BGGComplex
+from bggcohomology.cohomology import compile_map, sort_merge
+from bggcohomology.differential import DifferentialCache
 from bggcohomology.la_modules import (
     BGGCohomology,
     LieAlgebraCompositeModule,
     ModuleFactory,
 )
+from bggcohomology.quantum_center import Eijk_basis, Mjk
+from bggcohomology.sparse_action import GeneratorMatrixCache
 from bggcohomology.weight_set import WeightSet
 
 
@@ -155,3 +160,203 @@ def test_coker(root_system, action_type, subset):
         betti1 = bggcohom1.betti_number(bggcohom1.cohomology(i))
         betti2 = bggcohom2.betti_number(bggcohom2.cohomology(i))
         assert betti1 == betti2
+
+
+@pytest.mark.parametrize("root_system", ["A2", "B2", "A3"])
+def test_sparse_action_engine(root_system):
+    """The sparse matrix engine gives the same cohomology as the kernel engine."""
+    BGG = BGGComplex(root_system)
+    factory = ModuleFactory(BGG.LA)
+    component_dic = {
+        "u": factory.build_component("u", "coad"),
+        "n": factory.build_component("n", "ad"),
+    }
+    components = [[("u", 2, "sym"), ("n", 1, "wedge")], [("n", 2, "wedge")]]
+    module = LieAlgebraCompositeModule(factory, components, component_dic)
+
+    kernel_cohom = BGGCohomology(BGG, module)
+    sparse_cohom = BGGCohomology(BGG, module, action_engine="sparse")
+    modular_cohom = BGGCohomology(
+        BGG,
+        module,
+        action_engine="sparse",
+        primes=[1073741789],
+        diff_cache=DifferentialCache(),
+    )
+    for i in range(BGG.max_word_length + 1):
+        assert kernel_cohom.cohomology(i) == sparse_cohom.cohomology(i)
+        assert kernel_cohom.cohomology(i) == modular_cohom.cohomology(i)
+
+
+def test_sparse_action_overflow():
+    """The sparse matrix engine refuses coefficients that don't fit in 64 bits, unless it
+    computes modulo a prime."""
+    BGG = BGGComplex("A2")
+    factory = ModuleFactory(BGG.LA)
+    component_dic = {"u": factory.build_component("u", "coad")}
+    module = LieAlgebraCompositeModule(factory, [[("u", 2, "sym")]], component_dic)
+    generator_matrices = GeneratorMatrixCache(module)
+    mu = WeightSet.from_bgg(BGG).make_dominant((1, 2))[0]
+    vertex_weights = WeightSet.from_bgg(BGG).get_vertex_weights(mu)
+    prime = 1073741789
+
+    for (w, _), bgg_map in BGG.compute_maps(mu).items():
+        if vertex_weights[w] not in module.weight_components:
+            continue
+        program = compile_map(bgg_map, factory)
+        triplets = generator_matrices.map_action_triplets(program, vertex_weights[w])
+        if len(triplets) == 0:
+            continue
+        large_program = compile_map(bgg_map * 2 ** 63, factory)
+        with pytest.raises(OverflowError):
+            generator_matrices.map_action_triplets(large_program, vertex_weights[w])
+
+        modular = generator_matrices.map_action_triplets(large_program, vertex_weights[w], prime)
+        expected = triplets.astype(object)
+        expected[:, 2] = expected[:, 2] * 2 ** 63 % prime
+        expected = expected[expected[:, 2] != 0].astype(np.int64)
+        assert np.array_equal(sort_merge(modular, prime), sort_merge(expected, prime))
+
+
+def test_differential_cache():
+    """Differentials are computed once, and shared between instances for the same module."""
+    BGG = BGGComplex("A2")
+    factory = ModuleFactory(BGG.LA)
+    component_dic = {"u": factory.build_component("u", "coad")}
+    module = LieAlgebraCompositeModule(factory, [[("u", 2, "sym")]], component_dic)
+    cache = DifferentialCache()
+
+    cohom = BGGCohomology(BGG, module, diff_cache=cache)
+    cohomology = [cohom.cohomology(i) for i in range(BGG.max_word_length + 1)]
+    num_ranks = len(cache._ranks)
+    assert num_ranks > 0
+
+    # A new instance finds everything in the cache
+    cached_cohom = BGGCohomology(BGG, module, diff_cache=cache)
+    assert cohomology == [
+        cached_cohom.cohomology(i) for i in range(BGG.max_word_length + 1)
+    ]
+    assert len(cache._ranks) == num_ranks
+
+    # Without the cache we get the same result
+    uncached_cohom = BGGCohomology(BGG, module, diff_cache=DifferentialCache(max_bytes=0))
+    assert cohomology == [
+        uncached_cohom.cohomology(i) for i in range(BGG.max_word_length + 1)
+    ]
+
+    # Ranks computed with different settings are not shared
+    certified_cohom = BGGCohomology(BGG, module, diff_cache=cache, certify_rank=True)
+    assert cohomology == [
+        certified_cohom.cohomology(i) for i in range(BGG.max_word_length + 1)
+    ]
+    assert len(cache._ranks) > num_ranks
+
+    # Neither are ranks computed with a different number of random primes
+    num_ranks = len(cache._ranks)
+    one_prime_cohom = BGGCohomology(BGG, module, diff_cache=cache, num_primes=1)
+    assert cohomology == [
+        one_prime_cohom.cohomology(i) for i in range(BGG.max_word_length + 1)
+    ]
+    assert len(cache._ranks) > num_ranks
+
+    # The default cache only keeps ranks
+    default_cohom = BGGCohomology(BGG, module)
+    assert cohomology == [
+        default_cohom.cohomology(i) for i in range(BGG.max_word_length + 1)
+    ]
+    assert len(default_cohom.diff_cache._diffs) == 0
+
+
+@pytest.mark.parametrize("root_system", ["A2", "B2"])
+def test_cohomology_all_degrees(root_system):
+    BGG = BGGComplex(root_system)
+    factory = ModuleFactory(BGG.LA)
+    component_dic = {
+        "u": factory.build_component("u", "coad"),
+        "n": factory.build_component("n", "ad"),
+    }
+    components = [[("u", 2, "sym"), ("n", 1, "wedge")]]
+    module = LieAlgebraCompositeModule(factory, components, component_dic)
+
+    cohom = BGGCohomology(BGG, module)
+    by_degree = [cohom.cohomology(i) for i in range(BGG.max_word_length + 1)]
+    all_degrees_cohom = BGGCohomology(BGG, module, diff_cache=DifferentialCache())
+    assert all_degrees_cohom.cohomology_all_degrees() == by_degree
+    assert all_degrees_cohom.cohomology_all_degrees(min_degree=1) == [[]] + by_degree[1:]
+
+    poincare = all_degrees_cohom.poincare_polynomial()
+    assert [poincare[i] for i in range(BGG.max_word_length + 1)] == [
+        cohom.betti_number(c) for c in by_degree
+    ]
+
+
+@pytest.mark.parametrize("root_system", ["A2", "B2"])
+def test_modular_coefficients(root_system):
+    """Computing the differentials modulo large primes gives the same cohomology."""
+    BGG = BGGComplex(root_system)
+    factory = ModuleFactory(BGG.LA)
+    component_dic = {
+        "u": factory.build_component("u", "coad"),
+        "n": factory.build_component("n", "ad"),
+    }
+    components = [[("u", 2, "sym"), ("n", 1, "wedge")], [("n", 2, "wedge")]]
+    module = LieAlgebraCompositeModule(factory, components, component_dic)
+
+    cohom = BGGCohomology(BGG, module)
+    modular_cohom = BGGCohomology(
+        BGG, module, primes=[1073741789, 1073741783], diff_cache=DifferentialCache()
+    )
+    for i in range(BGG.max_word_length + 1):
+        assert cohom.cohomology(i) == modular_cohom.cohomology(i)
+
+    with pytest.raises(ValueError):
+        BGGCohomology(BGG, module, primes=[2 ** 31 + 11])
+
+
+@pytest.mark.parametrize("with_coker", [False, True])
+def test_matrix_free(with_coker):
+    BGG = BGGComplex("A2")
+    if with_coker:
+        module, coker = Mjk(BGG, 2, -2), Eijk_basis(BGG, 2, -2)
+    else:
+        factory = ModuleFactory(BGG.LA)
+        component_dic = {"u": factory.build_component("u", "coad")}
+        module = LieAlgebraCompositeModule(factory, [[("u", 2, "sym")]], component_dic)
+        coker = None
+
+    cohom = BGGCohomology(BGG, module, coker=coker)
+    matrix_free_cohom = BGGCohomology(
+        BGG, module, coker=coker, matrix_free=True, num_primes=1, diff_cache=DifferentialCache()
+    )
+    assert len(matrix_free_cohom.primes) == 1
+    for i in range(BGG.max_word_length + 1):
+        assert cohom.cohomology(i) == matrix_free_cohom.cohomology(i)
+
+    # Wiedemann's algorithm is unreliable over small fields
+    with pytest.raises(ValueError):
+        BGGCohomology(BGG, module, coker=coker, matrix_free=True, primes=[3])
+
+
+@pytest.mark.parametrize("root_system", ["A2", "B2", "G2"])
+def test_rank_rows(root_system):
+    BGG = BGGComplex(root_system)
+    factory = ModuleFactory(BGG.LA)
+    component_dic = {
+        "g": factory.build_component("g", "coad"),
+        "u": factory.build_component("u", "coad"),
+        "n": factory.build_component("n", "ad"),
+    }
+    components = [
+        [("u", 2, "sym"), ("n", 2, "wedge")],
+        [("g", 1, "wedge"), ("u", 1, "sym")],
+        [("n", 3, "wedge")],
+    ]
+    module = LieAlgebraCompositeModule(factory, components, component_dic)
+    for mu, weight_components in module.weight_components.items():
+        for comp_num, basis in weight_components:
+            indices = module.rank_rows(comp_num, basis[::-1])
+            assert list(indices) == [
+                module.weight_comp_index_numbers[mu][tuple(list(row) + [comp_num])]
+                for row in basis[::-1]
+            ]
+            assert (module.unrank(comp_num, mu, indices) == basis[::-1]).all()
@@ -1,7 +1,9 @@
 from bggcohomology.quantum_center import *
+from bggcohomology.quantum_center import _compute_kernel2
 from bggcohomology.bggcomplex import BGGComplex
 from bggcohomology.la_modules import *
 
+import numpy as np
 import pytest
 
 @pytest.mark.parametrize("root_system", ["A2", "G2", "B2", "A3"])
@@ -17,4 +19,51 @@ def test_total_trivial_dim(root_system):
         cohom = BGGCohomology(BGG, Mjk(BGG,j,k),coker=coker)
         total_betti+=cohom.betti_number(cohom.cohomology(i, mu=mu))
     theoretical_dim = (2*len(BGG.neg_roots)/BGG.rank+1)**BGG.rank
-    assert theoretical_dim == total_betti
\ No newline at end of file
+    assert theoretical_dim == total_betti
+
+
+def test_coker_fingerprint():
+    """The fingerprint of a CokerCache doesn't compute any cokernels."""
+    BGG = BGGComplex("A2")
+    coker = Eijk_basis(BGG, 2, -2)
+    assert len(coker.rel_dic) > 0
+    cohom = BGGCohomology(BGG, Mjk(BGG, 2, -2), coker=coker)
+    fingerprint = cohom.coker_fingerprint()
+    assert len(coker.computed_cokernels) == 0
+
+    same = BGGCohomology(BGG, Mjk(BGG, 2, -2), coker=Eijk_basis(BGG, 2, -2))
+    assert same.coker_fingerprint() == fingerprint
+    other = BGGCohomology(BGG, Mjk(BGG, 3, -4), coker=Eijk_basis(BGG, 3, -4))
+    assert other.coker_fingerprint() != fingerprint
+
+
+def test_sparse_cokernel():
+    """Cokernels are stored as an identity block and a sparse solution block."""
+    rng = np.random.default_rng(0)
+    target_dim, source_dim = 12, 9
+    basis_indices = [1, 4, 5, 10]
+    complement = [i for i in range(target_dim) if i not in basis_indices]
+    # Relations whose span is complementary to the basis of the quotient
+    solution = rng.integers(-2, 3, size=(len(complement), len(basis_indices)))
+    relations = np.zeros((source_dim, target_dim), dtype=np.int64)
+    relations[:, complement] = np.eye(source_dim, len(complement), dtype=np.int64)
+    relations[:, basis_indices] = relations[:, complement] @ solution
+    sources, targets = np.nonzero(relations)
+    rels = np.stack([sources, targets, relations[sources, targets]], axis=1)
+
+    coker = _compute_kernel2(source_dim, target_dim, rels, basis_indices, check=True)
+    assert isinstance(coker, SparseCokernel)
+    assert (coker.nrows(), coker.ncols()) == (len(basis_indices), target_dim)
+
+    expected = np.zeros((len(basis_indices), target_dim), dtype=np.int64)
+    expected[:, basis_indices] = np.eye(len(basis_indices), dtype=np.int64)
+    expected[:, complement] = -solution.T
+    assert np.array_equal(coker.tocsc().toarray(), expected)
+    assert coker.to_matrix() == matrix(ZZ, expected.tolist())
+
+
+def test_sparse_cokernel_overflow():
+    """Cokernels with entries that don't fit in 64 bits are refused."""
+    rels = [[0, 0, 2 ** 64], [0, 1, 1]]
+    with pytest.raises(OverflowError):
+        _compute_kernel2(1, 2, rels, [0])